@@ -0,0 +1,59 @@
+import numpy as np
+
+DEFAULT_COLOR = (255, 0, 0)
+
+def parse_chunk_components(images_df, color_dict=None):
+    """ decode every bounds blob of a chunk at once and group the pixels of
+        each frame into paint runs. Consecutive rows of a frame sharing a
+        colour are merged into one run, so overlapping components are
+        still painted in row order.
+    :param images_df: chunk with image_count, component_id and bounds columns,
+        the rows of a frame being contiguous
+    :param color_dict: component_id -> BGR color, None paints DEFAULT_COLOR
+    :return: dict image_count -> list of (color, y, x)
+    """
+    rows = images_df[images_df["bounds"].notnull()]
+    if len(rows) == 0:
+        return dict()
+
+    # One buffer holding the (y, x) pairs of the whole chunk
+    blobs = rows["bounds"].to_numpy()
+    lengths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs)) // 16
+    points = np.frombuffer(b"".join(blobs), dtype=np.int64).reshape(-1, 2)
+
+    # Color index of every row, looked up once per component
+    if color_dict is None:
+        palette = np.array([DEFAULT_COLOR], dtype=np.uint8)
+        color_ids = np.zeros(len(rows), dtype=np.int64)
+    else:
+        names = list(color_dict)
+        palette = np.array([color_dict[name] for name in names], dtype=np.uint8)
+        color_ids = rows["component_id"].map({name: i for i, name in enumerate(names)})
+        if color_ids.isnull().any():
+            raise KeyError(rows["component_id"][color_ids.isnull()].iloc[0])
+        color_ids = color_ids.to_numpy(dtype=np.int64)
+
+    # A new run starts whenever the frame or the color changes
+    image_counts = rows["image_count"].to_numpy()
+    run_starts = np.flatnonzero(np.concatenate((
+        [True],
+        (image_counts[1:] != image_counts[:-1]) | (color_ids[1:] != color_ids[:-1]))))
+    run_lengths = np.add.reduceat(lengths, run_starts)
+    run_points = np.split(points, np.cumsum(run_lengths)[:-1])
+
+    components = dict()
+    for start, run in zip(run_starts, run_points):
+        components.setdefault(image_counts[start], []).append(
+            (palette[color_ids[start]], run[:, 0], run[:, 1]))
+    return components
+
+def paint_components(image_data, components):
+    """ paint the runs of one frame in place, one fancy-indexing write each.
+        image_data must be writable, e.g. the output of FrameDecoder.to_bgr.
+    """
+    if components is None:
+        return image_data
+
+    for color, y, x in components:
+        image_data[y, x] = color
+    return image_data
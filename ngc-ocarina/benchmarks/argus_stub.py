@@ -0,0 +1,134 @@
+import argparse
+from collections import defaultdict
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+class StubState:
+    # records received per stream, sessions seen, batches already stored (by X-Batch-Id) and request counters
+    def __init__(self, fail_every=0, latency=0.0):
+        self.fail_every = fail_every
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.records = defaultdict(int)
+        self.batches = set()
+        self.sessions = set()
+        self.requests = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.connections = 0
+        self.start = None
+
+    def stats(self):
+        with self.lock:
+            seconds = time.perf_counter() - self.start if self.start is not None else 0
+            return {
+                'records': dict(self.records),
+                'sessions': len(self.sessions),
+                'requests': self.requests,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'bytes': self.bytes,
+                'connections': self.connections,
+                'seconds': round(seconds, 3),
+                'records_per_second': round(sum(self.records.values()) / seconds) if seconds > 0 else 0,
+            }
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ accepts the POSTs of upload-argus.py like the ARGUS API would:
+        one JSON array of records per request, gzip'ed or not. Every
+        fail_every-th request answers 503 to exercise the client's retries.
+    """
+    # keep-alive, as the client reuses its connections
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        state = self.state
+        with state.lock:
+            if state.start is None:
+                state.start = time.perf_counter()
+            state.requests += 1
+            state.bytes += len(body)
+            fail = state.fail_every > 0 and state.requests % state.fail_every == 0
+            if fail:
+                state.failed += 1
+        if state.latency > 0:
+            time.sleep(state.latency)
+        if fail:
+            self.reply(503, {'error': 'injected failure'})
+            return
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        try:
+            records = json.loads(body)
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        stream = self.path.rstrip('/').split('/')[-1]
+        batch_id = self.headers.get('X-Batch-Id')
+        with state.lock:
+            duplicate = batch_id is not None and batch_id in state.batches
+            if duplicate:
+                state.duplicates += 1
+            else:
+                state.batches.add(batch_id)
+                state.records[stream] += len(records)
+                state.sessions.add(self.headers.get('X-Session-Id'))
+        if duplicate:
+            self.reply(200, {'stored': 0, 'duplicate': True})
+        else:
+            self.reply(200, {'stored': len(records)})
+
+    def do_GET(self):
+        # /stats reports what was received so far
+        self.reply(200, self.state.stats())
+
+    def reply(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def create_server(port=8000, fail_every=0, latency=0.0):
+    """ :return: the server (call serve_forever() on it) and its StubState """
+    state = StubState(fail_every, latency)
+    handler = type('Handler', (StubHandler,), {'state': state})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler), state
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/argus_stub.py --port 8000 --fail-every 20
+    ## python upload-argus.py -i /bar/0293_11 --url http://localhost:8000
+
+    parser = argparse.ArgumentParser(description='This scripts aims to stand in for the ARGUS API so upload-argus.py can be tested and benchmarked offline')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fail-every', type=int, default=0, help='answer 503 to every n-th request')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each request takes')
+
+    args = parser.parse_args()
+    server, state = create_server(args.port, args.fail_every, args.latency)
+    print(f"Listening on http://127.0.0.1:{args.port}, GET /stats for the totals")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(state.stats(), indent=1))
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from frame_decoder import FrameDecoder
+
+def legacy_decode(data, encoding, width, height, is_bigendian):
+    # Per-frame decoding as done by image_extractor before FrameDecoder
+    dt = np.dtype(np.uint8)
+    dt = dt.newbyteorder(">" if bool(is_bigendian) else "<")
+    num_channels = 4 if encoding == "bgra8" else 1
+    image_data = np.frombuffer(data, dtype=dt)
+    if num_channels == 4:
+        image_data = np.reshape(
+            image_data, (int(height), int(width), num_channels))
+        image_data = image_data[:, :, 0:3]
+        image_data = np.reshape(
+            image_data, (int(height), int(width), 3))
+        # Consumers (cv2 writers, box drawing) need a contiguous copy
+        image_data = np.ascontiguousarray(image_data)
+    else:
+        image_data = np.reshape(
+            image_data, (int(width), int(height)))
+        image_data = np.stack((image_data,)*3, axis=-1)
+    return image_data
+
+def frames_per_second(decode, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        decode(*frame)
+    return len(frames) / (time.perf_counter() - start)
+
+def main( num_frames: int, width: int, height: int ):
+
+    rng = np.random.default_rng(0)
+    layouts = {
+        "bgra8": rng.integers(0, 255, width * height * 4, dtype=np.uint8).tobytes(),
+        "mono8": rng.integers(0, 255, width * height, dtype=np.uint8).tobytes(),
+    }
+
+    decoder = FrameDecoder()
+    for encoding, data in layouts.items():
+        frames = [(data, encoding, width, height, 0)] * num_frames
+        out = decoder.output_buffer(decoder.raw(*frames[0]))
+
+        results = {
+            "before": frames_per_second(legacy_decode, frames),
+            "FrameDecoder": frames_per_second(decoder.decode, frames),
+            "FrameDecoder (reused output)": frames_per_second(
+                lambda *frame: decoder.decode(*frame, out=out), frames),
+        }
+        for name, fps in results.items():
+            print(f"{encoding} {width}x{height} {name}: {fps:.1f} frames/sec")
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/bench_frame_decoder.py -n 500 --width 1920 --height 1080
+
+    parser = argparse.ArgumentParser(description='Micro-benchmark of raw frame decoding, before and after FrameDecoder')
+    parser.add_argument('-n', '--frames', type=int, default=500)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+
+    args = parser.parse_args()
+    main(args.frames, args.width, args.height)
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+import columnar
+from synthetic_db import create_trial_db
+
+# (script, outputs) of the parsers writing .npz files next to their JSON
+PARSERS = [
+    ("eye-parser.py", ["eye"]),
+    ("perception-parser.py", ["detic:image"]),
+    ("reasoning-parser.py", ["egovlp:action:steps", "reasoning:check_status"]),
+]
+# outputs whose floats are stored as float32, see columnar
+FLOAT32_OUTPUTS = {"eye"}
+
+def add_nulls(database_path):
+    # the NULLs and missing bounds the real logs have, which the .npz must keep
+    conn = sqlite3.connect(database_path)
+    conn.execute("UPDATE ocarina_mission_log SET Step = NULL WHERE rowid % 7 = 0")
+    conn.execute("UPDATE ocarina_mission_log SET Event = NULL WHERE rowid % 5 = 0")
+    conn.execute("UPDATE ocarina_mission_log SET timestamp = NULL WHERE rowid % 50 = 0")
+    conn.execute("UPDATE hl2_rgb_bounding_boxes SET bounds = NULL WHERE rowid % 3 = 0")
+    conn.execute("UPDATE hl2_rgb_bounding_boxes SET component_id = NULL WHERE rowid % 11 = 0")
+    conn.commit()
+    conn.close()
+
+def as_float32(value):
+    # the JSON value as records() gives it back from a float32 column
+    if isinstance(value, dict):
+        return {key: as_float32(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [as_float32(item) for item in value]
+    if isinstance(value, float):
+        return float(str(np.float32(value)))
+    return value
+
+def check(json_path, npz_path, float32):
+    with open(json_path, 'r') as f:
+        expected = json.load(f)
+    kind, records = columnar.records(npz_path)
+    records = list(records)
+    if kind != os.path.basename(json_path):
+        return f"{npz_path} stands for {kind}"
+    if len(records) != len(expected):
+        return f"{len(records)} records instead of {len(expected)}"
+    for i, (record, expected_record) in enumerate(zip(records, expected)):
+        if float32:
+            expected_record = as_float32(expected_record)
+        # as text, so 1 and 1.0 or null and "None" differ
+        if json.dumps(record) != json.dumps(expected_record):
+            return f"record {i}: {json.dumps(record)} instead of {json.dumps(expected_record)}"
+    return None
+
+def main( minutes: float, work_dir: str ):
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix='npz-roundtrip-')
+    database_path = os.path.join(work_dir, "trial.sqlite")
+    output = os.path.join(work_dir, "outputs")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        create_trial_db(database_path, minutes, mono_every=10)
+        add_nulls(database_path)
+
+        failures = 0
+        for script, names in PARSERS:
+            subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, script), "-i", database_path, "-o", output, "-f", "both"],
+                           check=True, stdout=subprocess.DEVNULL)
+            for name in names:
+                error = check(os.path.join(output, f"{name}.json"), os.path.join(output, f"{name}.npz"), name in FLOAT32_OUTPUTS)
+                print(f"{name}: {'matches' if error is None else error}")
+                failures += error is not None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failures > 0:
+        sys.exit(f"{failures} outputs don't round trip")
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/check_npz_roundtrip.py --minutes 1
+
+    parser = argparse.ArgumentParser(description='Checks that the .npz outputs of the parsers convert back to their JSON outputs, NULL steps, events and bounds included')
+    parser.add_argument('--minutes', type=float, default=0.5, help='length of the synthetic trial')
+    parser.add_argument('-w', '--work-dir', default='', help='where the trial and outputs are written (removed afterwards), a temporary folder by default')
+
+    args = parser.parse_args()
+    main(args.minutes, args.work_dir)
@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from script_loader import load_script
+
+reasoning_parser = load_script("reasoning-parser")
+
+def legacy_get_actions_json(df, ptg_timestamps):
+    # Per-timestamp scan as done by reasoning-parser before the crosstab,
+    # with the timestamps converted the way the parser does now
+    json_values = []
+    unique_actions = df["Event"].unique()
+
+    df2 = df[df['timestamp'].notnull()] # remove null timestamps
+    df3 = df2[pd.to_datetime(df2['timestamp'], errors='coerce',format='%H:%M:%S.%f').notnull()] # check correct format
+    uniqueTs = df3['timestamp'].unique()
+    for ts in uniqueTs:
+        detected_actions_per_ts = df[df['timestamp'] == ts]['Event'].values
+        row_dic = {"timestamp": ptg_timestamps[ts] }
+        for action in unique_actions:
+            if(action in list(detected_actions_per_ts)):
+                row_dic[action] = 1
+            else:
+                row_dic[action] = 0
+        json_values.append(row_dic)
+    return sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])
+
+def legacy_get_steps_json(df, ptg_timestamps):
+    # Per-timestamp scan of the steps as done before drop_duplicates
+    json_values = []
+
+    df2 = df[df['timestamp'].notnull()] # remove null timestamps
+    df3 = df2[pd.to_datetime(df2['timestamp'], errors='coerce',format='%H:%M:%S.%f').notnull()] # check correct format
+    uniqueTs = df3['timestamp'].unique()
+    for ts in uniqueTs:
+        detected_steps_per_ts = df[df['timestamp'] == ts]['Step'].values
+        step = list(detected_steps_per_ts)[0]
+        timestamp_value = ptg_timestamps[ts]
+        row_dic = {"step_id": step,
+                    "step_status": "NEW",
+                    "step_description": "",
+                    "error_status": False,
+                    "error_description": "",
+                    "timestamp": timestamp_value
+                   }
+        json_values.append(row_dic)
+    return sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])
+
+def mission_log(rows, timestamps, events, null_rate, seed=0):
+    """ ocarina_mission_log-like frame of rows events over timestamps distinct
+        times, with NULL and malformed timestamps and null_rate NULL events
+        and steps. Steps are integers read with their NULLs, so floats with NaN
+    """
+    rng = np.random.default_rng(seed)
+    ms = np.sort(rng.choice(3600 * 1000, timestamps, replace=False))
+    times = [f"{m // 3600000 + 10:02d}:{m // 60000 % 60:02d}:{m // 1000 % 60:02d}.{m % 1000:03d}" for m in ms]
+    df = pd.DataFrame({
+        'timestamp': np.array(times, dtype=object)[np.sort(rng.integers(0, timestamps, rows))],
+        'Event': np.array([f"event_{i}" for i in range(events)], dtype=object)[rng.integers(0, events, rows)],
+        'Step': rng.integers(1, 12, rows).astype(float),
+    })
+    df.loc[rng.random(rows) < null_rate, 'Event'] = None
+    df.loc[rng.random(rows) < null_rate, 'Step'] = np.nan
+    # a few rows whose timestamp is missing or can't be parsed
+    df.loc[rng.random(rows) < 0.001, 'timestamp'] = None
+    df.loc[rng.random(rows) < 0.001, 'timestamp'] = "not a time"
+    # timestamps whose only events are NULL, and one whose first step is NULL
+    df.loc[df['timestamp'] == times[0], 'Event'] = None
+    df.loc[(df['timestamp'] == times[1]).idxmax(), 'Step'] = np.nan
+    return df
+
+def same_value(value, expected):
+    # NaN (a NULL step) is written as NaN by both versions
+    if isinstance(value, float) and isinstance(expected, float) and np.isnan(value) and np.isnan(expected):
+        return True
+    return value == expected
+
+def compare(name, rows, expected):
+    if len(rows) != len(expected):
+        sys.exit(f"{name}: {len(rows)} timestamps instead of {len(expected)}")
+    for row, expected_row in zip(rows, expected):
+        if row.keys() != expected_row.keys() or not all(same_value(row[key], expected_row[key]) for key in row):
+            sys.exit(f"{name}: mismatch at {expected_row['timestamp']}: {row} instead of {expected_row}")
+    print(f"{name}: all {len(rows)} timestamps match")
+
+def main( rows: int, timestamps: int, events: int, null_rate: float ):
+
+    df = mission_log(rows, timestamps, events, null_rate)
+    date_anchor_ms = 1672531200000
+    print(f"{len(df)} rows, {df['timestamp'].nunique()} timestamps, {df['timestamp'].isnull().sum()} NULL timestamps, "
+          f"{df['Event'].isnull().sum()} NULL events, {df['Step'].isnull().sum()} NULL steps")
+    ptg_timestamps = reasoning_parser.ptg_timestamps_by_value(reasoning_parser.get_valid_timestamps(df)['timestamp'].unique(), date_anchor_ms)
+
+    for name, function, legacy_function in [
+            ("actions", reasoning_parser.get_actions_json, legacy_get_actions_json),
+            ("steps", reasoning_parser.get_steps_json, legacy_get_steps_json)]:
+        start = time.perf_counter()
+        rows = function(df, date_anchor_ms)
+        print(f"{name}: {time.perf_counter() - start:.2f} sec")
+
+        start = time.perf_counter()
+        expected = legacy_function(df, ptg_timestamps)
+        print(f"{name} before: {time.perf_counter() - start:.2f} sec")
+        compare(name, rows, expected)
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/check_reasoning_parser.py -n 100000 --timestamps 10000
+
+    parser = argparse.ArgumentParser(description='Checks that reasoning-parser writes the same actions and steps as its per-timestamp implementation did, NULL events, steps and timestamps included')
+    parser.add_argument('-n', '--rows', type=int, default=100000)
+    parser.add_argument('--timestamps', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--null-rate', type=float, default=0.05, help='fraction of rows with a NULL Event, and of rows with a NULL Step')
+
+    args = parser.parse_args()
+    main(args.rows, args.timestamps, args.events, args.null_rate)
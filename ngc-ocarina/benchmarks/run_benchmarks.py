@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+import yaml
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+SUBJECT_ID = "bench"
+TABLES = ["hl2_gaze", "hl2_rgb", "hl2_rgb_bounding_boxes", "ocarina_mission_log"]
+
+def run_script(args, cwd):
+    """ run one parser in its own interpreter
+    :return: (wall time in seconds, peak RSS in MB, including the processes it waited for)
+        A child's peak RSS starts at the RSS of this process when it is
+        spawned, so the harness holds no trial data (see create_trial)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited with {process.returncode}")
+    # ru_maxrss is in KB on Linux
+    return wall, usage.ru_maxrss / 1024
+
+def harness_rss():
+    # peak RSS of this process in MB, the lowest peak a script can report
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def create_trial(database_path, minutes, width, height):
+    """ generate a trial with synthetic_db.py in its own interpreter, so the
+        memory it takes isn't counted in the peak RSS of the scripts
+    :return: dict of row counts per table
+    """
+    run_script([os.path.join(BENCHMARKS_DIR, "synthetic_db.py"), "-o", database_path, "--minutes", str(minutes),
+                "--width", str(width), "--height", str(height), "--mono-every", "10"], cwd=BENCHMARKS_DIR)
+    conn = sqlite3.connect(database_path)
+    counts = {table: conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0] for table in TABLES}
+    conn.close()
+    return counts
+
+def write_extractor_config(work_dir, trial_id, chunk_size):
+    # image_extractor.py reads its config from ./config relative to cwd
+    config_path = os.path.join(SCRIPTS_DIR, "config", "config_image_extractor.yaml")
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    config["database_path"] = os.path.join(work_dir, "trials") + os.sep
+    config["trial_list"] = [[SUBJECT_ID, trial_id]]
+    config["chunk_size"] = chunk_size
+    config["resume"] = False
+    for feed in config["feeds"]:
+        config["feeds"][feed].update(extract_images=False, extract_video=True)
+
+    os.makedirs(os.path.join(work_dir, "config"), exist_ok=True)
+    with open(os.path.join(work_dir, "config", "config_image_extractor.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+
+def benchmark_scale(work_dir, trial_id, minutes, width, height, chunk_size):
+    database_path = os.path.join(work_dir, "trials", SUBJECT_ID, f"{SUBJECT_ID}_{trial_id}.sqlite")
+    os.makedirs(os.path.dirname(database_path), exist_ok=True)
+    print(f"Generating {minutes} minute trial {database_path}")
+    counts = create_trial(database_path, minutes, width, height)
+
+    output = os.path.join(work_dir, "outputs", str(trial_id))
+    video_path = os.path.join(work_dir, "trials", SUBJECT_ID, "outputs", SUBJECT_ID, str(trial_id), "hl2_rgb", "hl2_rgb.mp4")
+    write_extractor_config(work_dir, trial_id, chunk_size)
+
+    # (name, command, rows read, frames read), in dependency order
+    scripts = [
+        ("eye-parser", ["eye-parser.py", "-i", database_path, "-o", output], counts["hl2_gaze"], 0),
+        ("perception-parser", ["perception-parser.py", "-i", database_path, "-o", output], counts["hl2_rgb_bounding_boxes"], 0),
+        ("reasoning-parser", ["reasoning-parser.py", "-i", database_path, "-o", output], counts["ocarina_mission_log"], 0),
+        ("image_extractor", ["image_extractor.py"], counts["hl2_rgb"] + counts["hl2_rgb_bounding_boxes"], counts["hl2_rgb"]),
+        ("generate-metadata", ["generate-metadata.py", "-i", video_path, "-o", output], 0, 0),
+        ("parse-all", ["parse-all.py", "-i", database_path, "-o", output + "_all",
+                       "--config", os.path.join(work_dir, "config", "config_image_extractor.yaml")],
+         sum(counts.values()), counts["hl2_rgb"]),
+    ]
+
+    results = []
+    for name, args, rows, frames in scripts:
+        args = [os.path.join(SCRIPTS_DIR, args[0])] + args[1:]
+        wall, peak_rss = run_script(args, cwd=work_dir)
+        result = {
+            "script": name,
+            "minutes": minutes,
+            "wall_secs": round(wall, 3),
+            "rows_per_sec": round(rows / wall, 1),
+            "frames_per_sec": round(frames / wall, 1),
+            "peak_rss_mb": round(peak_rss, 1),
+        }
+        print(f"{name:<20} {minutes:>6} min {wall:>9.2f} s {result['rows_per_sec']:>12.1f} rows/s "
+              f"{result['frames_per_sec']:>9.1f} frames/s {peak_rss:>9.1f} MB")
+        results.append(result)
+    return results
+
+def main( work_dir: str, scales: list, width: int, height: int, chunk_size: int, output: str, keep: bool ):
+
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for trial_id, minutes in enumerate(scales):
+            results.extend(benchmark_scale(work_dir, trial_id, minutes, width, height, chunk_size))
+        print(f"Harness peak RSS {harness_rss():.1f} MB, no script can report less")
+    finally:
+        if not keep:
+            shutil.rmtree(os.path.join(work_dir, "trials"), ignore_errors=True)
+            shutil.rmtree(os.path.join(work_dir, "outputs"), ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/run_benchmarks.py -w /tmp/ocarina-bench --scales 0.5 2 10 --results bench.json
+
+    parser = argparse.ArgumentParser(description='This scripts aims to benchmark every parser on synthetic Ocarina trials of several sizes')
+    parser.add_argument('-w', '--work-dir', default='./bench_work', help='where trials and outputs are written')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 2], help='trial lengths in minutes')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--chunk-size', type=int, default=1000, help='image_extractor chunk_size')
+    parser.add_argument('--results', default='', help='write the results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the generated trials and outputs')
+
+    args = parser.parse_args()
+    main(args.work_dir, args.scales, args.width, args.height, args.chunk_size, args.results, args.keep)
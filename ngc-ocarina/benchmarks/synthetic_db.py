@@ -0,0 +1,112 @@
+import argparse
+from datetime import datetime, timedelta
+import os
+import sqlite3
+
+import numpy as np
+
+COMPONENTS = ['fdvcp', 'mfd inboard', 'mfd outboard', 'cdu']
+EVENTS = [f'event_{i}' for i in range(40)]
+STEPS = [f'step_{i}' for i in range(25)]
+START_TIME = datetime(2023, 3, 20, 17, 25, 46)
+
+SCHEMA = [
+    """CREATE TABLE hl2_gaze (timestamp TEXT, origin_x REAL, origin_y REAL, origin_z REAL,
+        direction_x REAL, direction_y REAL, direction_z REAL)""",
+    """CREATE TABLE hl2_rgb (image_count INTEGER, timestamp TEXT, encoding TEXT, width INTEGER,
+        height INTEGER, is_bigendian INTEGER, data BLOB)""",
+    """CREATE TABLE hl2_rgb_bounding_boxes (image_count INTEGER, timestamp TEXT, component_id TEXT,
+        bounds BLOB)""",
+    """CREATE TABLE ocarina_mission_log (timestamp TEXT, Event TEXT, Step TEXT)""",
+]
+
+def format_timestamps(offsets_ms, fmt='%Y-%m-%d %H:%M:%S.%f'):
+    return [(START_TIME + timedelta(milliseconds=float(ms))).strftime(fmt) for ms in offsets_ms]
+
+def rectangle_outline(top, left, bottom, right):
+    # (y, x) pixels on the border of a box, the layout of the bounds blobs
+    xs = np.arange(left, right + 1)
+    ys = np.arange(top + 1, bottom)
+    y = np.concatenate((np.full(len(xs), top), np.full(len(xs), bottom), ys, ys))
+    x = np.concatenate((xs, xs, np.full(len(ys), left), np.full(len(ys), right)))
+    return np.stack((y, x), axis=1).astype(np.int64)
+
+def create_trial_db(path, minutes, fps=30, gaze_rate=30, width=640, height=360, mono_every=0, events_per_second=1, seed=0):
+    """ write a synthetic trial database with the tables the parsers read
+    :param mono_every: every n-th frame is a mono8 frame (0 for BGRA only)
+    :return: dict of row counts per table
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    duration_ms = minutes * 60 * 1000
+    counts = dict()
+
+    # gaze samples
+    offsets = np.arange(0, duration_ms, 1000 / gaze_rate)
+    values = rng.normal(size=(len(offsets), 6))
+    conn.executemany("INSERT INTO hl2_gaze VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ([ts] + row for ts, row in zip(format_timestamps(offsets), values.tolist())))
+    counts['hl2_gaze'] = len(offsets)
+
+    # frames with a few components each, written in batches to bound memory
+    frame_offsets = np.arange(0, duration_ms, 1000 / fps)
+    base_frame = rng.integers(0, 255, (height, width, 4), dtype=np.uint8)
+    outlines = [
+        rectangle_outline(*(np.array([0.1 + 0.2 * i, 0.1, 0.25 + 0.2 * i, 0.4 + 0.1 * i]) * [height, width, height, width]).astype(int))
+        for i in range(len(COMPONENTS))]
+    boxes = 0
+    for start in range(0, len(frame_offsets), 500):
+        batch = frame_offsets[start:start + 500]
+        frames = []
+        bounding_boxes = []
+        for image_count, ts in zip(range(start, start + len(batch)), format_timestamps(batch)):
+            if mono_every > 0 and image_count % mono_every == 0:
+                # mono frames carry no components
+                data = base_frame[:, :, 0].tobytes()
+                frames.append((image_count, ts, 'mono8', width, height, 0, data))
+                continue
+            frames.append((image_count, ts, 'bgra8', width, height, 0, base_frame.tobytes()))
+            for component, outline in zip(COMPONENTS, outlines):
+                if rng.random() < 0.6:
+                    bounding_boxes.append((image_count, ts, component, outline.tobytes()))
+        conn.executemany("INSERT INTO hl2_rgb VALUES (?, ?, ?, ?, ?, ?, ?)", frames)
+        conn.executemany("INSERT INTO hl2_rgb_bounding_boxes VALUES (?, ?, ?, ?)", bounding_boxes)
+        boxes += len(bounding_boxes)
+    counts['hl2_rgb'] = len(frame_offsets)
+    counts['hl2_rgb_bounding_boxes'] = boxes
+
+    # mission log, only time of day as in the real logs
+    log_offsets = np.sort(rng.uniform(0, duration_ms, int(minutes * 60 * events_per_second)))
+    log_timestamps = [ts[:-3] for ts in format_timestamps(log_offsets, '%H:%M:%S.%f')]
+    conn.executemany("INSERT INTO ocarina_mission_log VALUES (?, ?, ?)", (
+        (ts, EVENTS[rng.integers(len(EVENTS))], STEPS[min(int(i * len(STEPS) / len(log_offsets)), len(STEPS) - 1)])
+        for i, ts in enumerate(log_timestamps)))
+    counts['ocarina_mission_log'] = len(log_offsets)
+
+    conn.commit()
+    conn.close()
+    return counts
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python benchmarks/synthetic_db.py -o /tmp/0001/0001_1.sqlite --minutes 5
+
+    parser = argparse.ArgumentParser(description='This scripts aims to generate synthetic Ocarina trial SQLite files for benchmarking the parsers')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('--minutes', type=float, default=1)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--gaze-rate', type=float, default=30)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--mono-every', type=int, default=0, help='make every n-th frame a mono8 frame')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    counts = create_trial_db(args.output[0], args.minutes, args.fps, args.gaze_rate, args.width, args.height, args.mono_every, seed=args.seed)
+    print(counts)
@@ -0,0 +1,220 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import yaml
+
+import columnar
+import profiler
+from script_loader import load_script
+from session_store import video_columns
+import timestamps
+
+perception_parser = load_script("perception-parser")
+
+def load_targets(config):
+    """ :return: list of (label, [(lower, upper) HSV bounds], pixel_percentage) """
+    targets = []
+    for label, target in config["targets"].items():
+        bounds = [(np.array(lower, dtype=np.uint8), np.array(upper, dtype=np.uint8))
+                  for lower, upper in target["boundaries_hsv"]]
+        targets.append((label, bounds, target["pixel_percentage"]))
+    return targets
+
+def read_frames(video_path, stride, scale, frame_queue, errors):
+    # Background reader: decode every stride-th frame, downscale it and queue
+    # (frame number, frame), then None once the video is exhausted
+    capture = cv2.VideoCapture(video_path)
+    try:
+        frame_number = 0
+        while True:
+            if frame_number % stride != 0:
+                # skip without converting the frame
+                if not capture.grab():
+                    break
+                frame_number += 1
+                continue
+            with profiler.stage('color.decode'):
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                if scale != 1:
+                    frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+            profiler.count('frames')
+            frame_queue.put((frame_number, frame))
+            frame_number += 1
+    except Exception as e:
+        errors.append(e)
+    finally:
+        capture.release()
+        frame_queue.put(None)
+
+def detect_objects(frame, targets):
+    """ :return: list of (label, xyxyn) of the targets whose colour covers
+        more than their pixel_percentage of the frame, xyxyn being the
+        normalized bounding rectangle of the matching pixels
+    """
+    height, width = frame.shape[:2]
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    mask = np.empty((height, width), dtype=np.uint8)
+    range_mask = np.empty((height, width), dtype=np.uint8)
+
+    detected = []
+    for label, bounds, pixel_percentage in targets:
+        cv2.inRange(hsv, bounds[0][0], bounds[0][1], dst=mask)
+        for lower, upper in bounds[1:]:
+            cv2.inRange(hsv, lower, upper, dst=range_mask)
+            cv2.bitwise_or(mask, range_mask, dst=mask)
+
+        if cv2.countNonZero(mask) * 100 / mask.size > pixel_percentage:
+            x, y, w, h = cv2.boundingRect(mask)
+            detected.append((label, [round(x / width, 4), round(y / height, 4),
+                                     round((x + w) / width, 4), round((y + h) / height, 4)]))
+    return detected
+
+def detect_batch(frames, targets):
+    # the seconds spent are returned rather than recorded, the worker may be another process
+    start = time.perf_counter()
+    detected = [detect_objects(frame, targets) for frame in frames]
+    return time.perf_counter() - start, detected
+
+def detect_video(video_path, targets, stride, scale, workers=4, worker_type="thread", batch_size=16):
+    """ run the detection on a worker pool while the reader thread decodes
+        ahead, keeping at most a few batches of frames in memory
+    :return: generator of (frame number, detections) in frame order
+    """
+    frame_queue = queue.Queue(maxsize=2 * batch_size)
+    reader_errors = []
+    reader = threading.Thread(
+        target=read_frames,
+        args=(video_path, stride, scale, frame_queue, reader_errors),
+        daemon=True)
+    reader.start()
+
+    if worker_type == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    with executor:
+        pending = deque()
+        finished = False
+        while not finished or len(pending) > 0:
+            # Hand the pool another batch while it has fewer than 2 per worker
+            if not finished and len(pending) < 2 * workers:
+                frame_numbers, frames = [], []
+                while len(frames) < batch_size:
+                    item = frame_queue.get()
+                    if item is None:
+                        finished = True
+                        break
+                    frame_numbers.append(item[0])
+                    frames.append(item[1])
+                if len(frames) > 0:
+                    pending.append((frame_numbers, executor.submit(detect_batch, frames, targets)))
+                continue
+
+            frame_numbers, future = pending.popleft()
+            seconds, batch = future.result()
+            profiler.add_time('color.detect', seconds)
+            for frame_number, detected in zip(frame_numbers, batch):
+                yield frame_number, detected
+
+    reader.join()
+    if len(reader_errors) > 0:
+        raise reader_errors[0]
+
+def get_json_values(detections, frame_timestamps):
+    # one detic:image record per analysed frame, like perception-parser.py writes
+    for frame_number, detected in detections:
+        if frame_number >= len(frame_timestamps):
+            print(f"Frame {frame_number} has no timecode, stopping")
+            break
+        values = []
+        for label, xyxyn in detected:
+            values.append({
+                "xyxyn": xyxyn,
+                "confidence": 1,
+                "class_id": 1,
+                "label": label
+                })
+        yield {
+            "frame_type": 123,
+            "values": values,
+            "timestamp": frame_timestamps[frame_number]
+            }
+
+def parse( video_path: str, output: str, config: dict, timecodes_path: str = '', output_format: str = 'json' ):
+    """ write detic:image.json (and/or detic:image.npz) from the colours painted into a video
+    :return: dict with the first-entry and last-entry timestamps written
+    """
+    # Frame times come from the timecodes and origin image_extractor.py wrote next to the video
+    if( not timecodes_path ):
+        stem = os.path.splitext(os.path.basename(video_path))[0]
+        timecodes_path = os.path.join(os.path.dirname(video_path), f"{stem}_timecodes.txt")
+    frame_timestamps = timestamps.ptg_timestamps(video_columns(timecodes_path)["timestamp"])
+
+    stride = config["stride"]
+    if( stride <= 0 ):
+        # one frame per second
+        capture = cv2.VideoCapture(video_path)
+        stride = max(1, int(capture.get(cv2.CAP_PROP_FPS)))
+        capture.release()
+
+    print(f"Detecting objects in {video_path} every {stride} frames {datetime.now()}")
+    detections = detect_video(
+        video_path, load_targets(config), stride, config["scale"],
+        config["workers"], config["worker_type"], config["batch_size"])
+    entries = dict()
+    json_perception = perception_parser.track_entries(get_json_values(detections, frame_timestamps), entries)
+
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+
+    writer = None
+    labels = dict()
+    if output_format in ['npz', 'both']:
+        writer = perception_parser.new_column_writer(os.path.join(output, 'detic:image.npz'))
+        json_perception = perception_parser.collect_columns(json_perception, writer, labels)
+
+    if output_format in ['json', 'both']:
+        with open(os.path.join(output, 'detic:image.json'), 'w') as f:
+            perception_parser.write_json(json_perception, f, 'color.serialise')
+    else:
+        for _ in json_perception:
+            pass
+
+    if writer is not None:
+        writer.close(labels=np.array(list(labels), dtype=str))
+    print(f"Finished {video_path} {datetime.now()}")
+    return entries
+
+def main( input: str, output: str, config_path: str, timecodes_path: str, output_format: str, profile: str = None ):
+
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    profiler.run('color-detector', output, profile, parse, input, output, config, timecodes_path, output_format)
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python color-detector.py -i /bar/0293_11/hl2_rgb/hl2_rgb.mp4 -o /bar/0293_11
+
+    parser = argparse.ArgumentParser(description='This scripts aims to detect the Ocarina components from the colours painted into the extracted video and write them in NYU backend format')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('--config', default='./config/config_color_detector.yaml', help='stride, scale, workers and the HSV range of each component')
+    parser.add_argument('--timecodes', default='', help='timecodes of the video, <video>_timecodes.txt next to it by default')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write detic:image.json, the columnar detic:image.npz, or both')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write color-detector_profile.json with the time of each stage, and with "cprofile" also color-detector.prof')
+
+    args = parser.parse_args()
+    main(args.input[0],args.output[0],args.config,args.timecodes,args.format,args.profile)
@@ -0,0 +1,181 @@
+""" Compact columnar output, written next to (or instead of) the JSON files.
+
+    Each output is an uncompressed NumPy .npz archive with a "kind" entry
+    naming the JSON file it stands for, int64 epoch millisecond timestamps
+    and float32 vectors. Strings (labels, actions, steps) are stored as
+    fixed-width unicode arrays, so np.load never needs pickling.
+
+    records() gives back the JSON records the parsers write, value for
+    value, with one exception: the gaze origin and direction of eye.json
+    (and the hit and distance of gaze:hits.json) come back at float32
+    precision, as the shortest decimal that reads back as the same float32.
+    Values a float column holds as JSON integers (the confidence, and the
+    [0, 0, 0, 0] box of components without bounds) are flagged in an
+    "<column>_int" column, and nulls of a column typed by its other values
+    (step_id, the action names) in a "<column>_null" column.
+"""
+
+import json
+import numpy as np
+
+from timestamps import ptg_timestamps
+
+FORMAT_VERSION = 2
+OUTPUT_FORMATS = ['json', 'npz', 'both']
+
+class ColumnWriter:
+    """ collects column chunks as a parser streams them and writes the
+        whole table as one .npz when closed
+    """
+
+    def __init__(self, path, kind, **columns):
+        """ :param columns: name -> (dtype, shape of one row), so empty tables still have every column """
+        self.path = path
+        self.kind = kind
+        self.dtypes = {name: dtype for name, (dtype, _) in columns.items()}
+        self.shapes = {name: tuple(shape) for name, (_, shape) in columns.items()}
+        self.chunks = {name: [np.empty((0,) + tuple(shape), dtype)] for name, (dtype, shape) in columns.items()}
+
+    def append(self, **columns):
+        for name, values in columns.items():
+            self.chunks[name].append(np.asarray(values, dtype=self.dtypes[name]).reshape((-1,) + self.shapes[name]))
+
+    def close(self, **extra):
+        columns = {name: np.concatenate(chunks) for name, chunks in self.chunks.items()}
+        columns.update(extra)
+        save(self.path, self.kind, **columns)
+
+def save(path, kind, **columns):
+    with open(path, 'wb') as f:
+        np.savez(f, kind=np.array(kind), version=np.array(FORMAT_VERSION), **columns)
+
+def load(path):
+    """ :return: (kind, dict of column name to array) """
+    with np.load(path, allow_pickle=False) as data:
+        columns = {name: data[name] for name in data.files}
+    return str(columns.pop('kind')), columns
+
+def float_values(values):
+    # shortest decimal that reads back as the same float32
+    return values.astype(str).astype(np.float64).tolist()
+
+def is_int(value):
+    # JSON integers, not booleans (a bool is an int in Python)
+    return isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_))
+
+def mixed_values(values, integral):
+    # floats of a column, as int where the JSON value was an integer
+    return [np.asarray(value).astype(np.int64).tolist() if is_integral else value
+            for value, is_integral in zip(values, integral)]
+
+def nullable_column(values):
+    """ values of a JSON field that may be null, as one array typed by the
+        other values: str, int64, or float64 for any other mix of numbers
+    :return: (values, nulls as '' or 0, bool array marking the nulls)
+    """
+    null = np.array([value is None for value in values], dtype=bool)
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, str) for value in present):
+        dtype, fill = str, ''
+    elif all(is_int(value) for value in present):
+        dtype, fill = np.int64, 0
+    else:
+        dtype, fill = np.float64, 0.0
+    return np.array([fill if value is None else value for value in values], dtype=dtype).reshape(len(values)), null
+
+def nullable_values(values, null):
+    return [None if is_null else value for value, is_null in zip(values.tolist(), null.tolist())]
+
+def flags(columns, name, length):
+    # columns written before a flag column existed have every flag False
+    return columns[name].tolist() if name in columns else [False] * length
+
+def eye_records(columns):
+    origin = float_values(columns['origin'])
+    direction = float_values(columns['direction'])
+    for o, d, ts in zip(origin, direction, ptg_timestamps(columns['timestamp'], '-0 ')):
+        yield {
+            "GazeOrigin": {"x": o[0], "y": o[1], "z": o[2]},
+            "GazeDirection": {"x": d[0], "y": d[1], "z": d[2]},
+            "timestamp": ts
+        }
+
+def perception_records(columns):
+    # values of record i are rows value_offsets[i]:value_offsets[i + 1] of the value columns
+    labels = columns['labels'].tolist()
+    label = columns['label'].tolist()
+    xyxyn = mixed_values(float_values(columns['xyxyn']), flags(columns, 'xyxyn_int', len(label)))
+    confidence = mixed_values(float_values(columns['confidence']), flags(columns, 'confidence_int', len(label)))
+    class_id = columns['class_id'].tolist()
+    offsets = columns['value_offsets'].tolist()
+    frame_type = columns['frame_type'].tolist()
+
+    for i, ts in enumerate(ptg_timestamps(columns['timestamp'])):
+        values = [
+            {
+                "xyxyn": xyxyn[j],
+                "confidence": confidence[j],
+                "class_id": class_id[j],
+                "label": labels[label[j]]
+            }
+            for j in range(offsets[i], offsets[i + 1])]
+        yield {
+            "frame_type": frame_type[i],
+            "values": values,
+            "timestamp": ts
+        }
+
+def action_records(columns):
+    actions = columns['actions'].tolist()
+    if 'actions_null' in columns:
+        actions = nullable_values(columns['actions'], columns['actions_null'])
+    for ts, detected in zip(ptg_timestamps(columns['timestamp']), columns['detected'].astype(int).tolist()):
+        record = {"timestamp": ts}
+        record.update(zip(actions, detected))
+        yield record
+
+def step_records(columns):
+    names = ['step_id', 'step_status', 'step_description', 'error_status', 'error_description']
+    values = [columns[name].tolist() for name in names]
+    if 'step_id_null' in columns:
+        values[0] = nullable_values(columns['step_id'], columns['step_id_null'])
+    for row in zip(*values, ptg_timestamps(columns['timestamp'])):
+        yield dict(zip(names + ['timestamp'], row))
+
+def gaze_hit_records(columns):
+    # a miss has a NaN distance and no hit point, a hit outside every component has component -1
+    components = columns['components'].tolist()
+    hit = float_values(columns['hit'])
+    distance = columns['distance']
+    missed = np.isnan(distance).tolist()
+    distance = float_values(distance)
+    component = columns['component'].tolist()
+    for i, ts in enumerate(ptg_timestamps(columns['timestamp'])):
+        yield {
+            "hit": None if missed[i] else {"x": hit[i][0], "y": hit[i][1], "z": hit[i][2]},
+            "distance": None if missed[i] else distance[i],
+            "component": components[component[i]] if component[i] >= 0 else None,
+            "timestamp": ts
+        }
+
+RECORDS = {
+    'eye.json': eye_records,
+    'detic:image.json': perception_records,
+    'egovlp:action:steps.json': action_records,
+    'reasoning:check_status.json': step_records,
+    'gaze:hits.json': gaze_hit_records,
+}
+
+def records(path):
+    """ :return: (name of the JSON file, generator of its records) """
+    kind, columns = load(path)
+    return kind, RECORDS[kind](columns)
+
+def write_json(json_values, output_file):
+    # stream the array to disk one record at a time
+    output_file.write('[')
+    for i, value in enumerate(json_values):
+        if i > 0:
+            output_file.write(', ')
+        output_file.write(json.dumps(value))
+    output_file.write(']')
@@ -0,0 +1,91 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import time
+
+import cv2
+
+from frame_store import FrameStore, store_paths
+import profiler
+import timestamps
+
+IMAGE_FORMATS = ['png', 'jpg']
+
+def image_title(image_count, timestamp, image_format):
+    # same file names as image_extractor.py writes in extract_images mode
+    title = f"{image_count}_{timestamps.format_us(timestamp, '%Y-%m-%d_%H:%M:%S.%f')}.{image_format}"
+    return title.replace(":", "_")
+
+def export_range(store_path, output, start, end, image_format, quality):
+    """ write frames start:end of the store, each worker maps the store itself
+    :return: (encode seconds, bytes written)
+    """
+    store = FrameStore(store_path)
+    # without a quality images are encoded with the defaults of cv2.imwrite, as image_extractor.py does
+    params = []
+    if quality is not None:
+        params = [cv2.IMWRITE_JPEG_QUALITY if image_format == 'jpg' else cv2.IMWRITE_PNG_COMPRESSION, quality]
+    seconds, written = 0.0, 0
+    for position in range(start, end):
+        record = store.index[position]
+        path = os.path.join(output, image_title(record['image_count'], record['timestamp'], image_format))
+        encode_start = time.perf_counter()
+        if not cv2.imwrite(path, store[position], params):
+            raise Exception(
+                f"Failed to write image at path: {path}")
+        seconds += time.perf_counter() - encode_start
+        written += os.path.getsize(path)
+    store.close()
+    return seconds, written
+
+def export(input: str, output: str, image_format: str = 'png', quality: int = None, workers: int = 4, batch_size: int = 256):
+    """ write every frame of a frame store as an image file, plus the
+        {feed}_timecodes.txt image_extractor.py writes next to its images
+    """
+    store = FrameStore(input)
+    feed = os.path.basename(store_paths(input)[0])[:-len('.frames')]
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+
+    print(f"Exporting {len(store)} frames of {input} as {image_format} {datetime.now()}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_range, input, output, start, min(start + batch_size, len(store)), image_format, quality)
+                   for start in range(0, len(store), batch_size)]
+        for future in futures:
+            seconds, written = future.result()
+            profiler.add_time('frames.encode', seconds)
+            profiler.count('frames.image_bytes', written)
+    profiler.count('frames', len(store))
+
+    with open(os.path.join(output, f"{feed}_timecodes.txt"), "w") as f:
+        last_us = None
+        for image_count, current_us in zip(store.image_counts.tolist(), store.timestamps.tolist()):
+            if last_us is not None:
+                f.write(f"duration {(current_us - last_us) / 10**6}\n")
+            f.write(f"file {os.path.join(output, image_title(image_count, current_us, image_format))}\n")
+            last_us = current_us
+    store.close()
+    print(f"Finished exporting {datetime.now()}")
+
+def main( input: str, output: str, image_format: str, quality: int, workers: int, profile: str = None ):
+
+    profiler.run('export-frames', output, profile, export, input, output, image_format, quality, workers)
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python export-frames.py -i /bar/0293_11/hl2_rgb/frames/hl2_rgb.frames -o /bar/0293_11/hl2_rgb/images
+    ## python export-frames.py -i /bar/0293_11/hl2_rgb/frames/hl2_rgb.frames -o /bar/0293_11/hl2_rgb/jpg -f jpg -q 90 -w 8
+
+    parser = argparse.ArgumentParser(description='This scripts aims to write the frames of a frame store (image_extractor.py extract_frames) as PNG or JPEG files')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='', help='.frames file of a feed')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('-f', '--format', choices=IMAGE_FORMATS, default='png')
+    parser.add_argument('-q', '--quality', type=int, default=None, help='JPEG quality (0-100) or PNG compression level (0-9), cv2 defaults when not given')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='processes encoding the images')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write export-frames_profile.json with the time of each stage, and with "cprofile" also export-frames.prof')
+
+    args = parser.parse_args()
+    main(args.input[0],args.output[0],args.format,args.quality,args.workers,args.profile)
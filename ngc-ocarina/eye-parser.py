@@ -1,14 +1,30 @@
 import argparse
+import columnar
 import json
 import numpy as np
 import sqlite3
 import pandas as pd
 import os
 
-def read_db( inputPath: str ):
+import profiler
+
+def read_db( inputPath: str, chunkSize: int = 100000 ):
 
     conn = sqlite3.connect(inputPath)
-    df = pd.read_sql("SELECT timestamp, origin_x, origin_y, origin_z, direction_x, direction_y, direction_z FROM hl2_gaze", conn)
+    return read_gaze( conn, chunkSize )
+
+def read_gaze( conn, chunkSize: int = 100000 ):
+
+    chunks = pd.read_sql("SELECT timestamp, origin_x, origin_y, origin_z, direction_x, direction_y, direction_z FROM hl2_gaze", conn, chunksize=chunkSize)
+
+    for df in profiler.timed(chunks, 'eye.fetch', 'eye.rows'):
+
+        with profiler.stage('eye.decode'):
+            df = decode_gaze(df)
+
+        yield df
+
+def decode_gaze( df ):
 
     ## parsing timestamps
     df['timestamp'] = pd.to_datetime(df['timestamp'], format="%Y-%m-%d %H:%M:%S.%f", errors='coerce') 
@@ -18,36 +34,84 @@ def read_db( inputPath: str ):
     
     ## transforming into miliseconds
     df['timestamp'] = df['timestamp'].values.astype(np.int64) // 10 ** 6
+    return df
+
+def format_float_column( values ):
+
+    ## same text as json.dumps gives for each float
+    values = values.astype(np.float64)
+    formatted = [ repr(value) for value in values.tolist() ]
+    if( not np.isfinite(values).all() ):
+        formatted = [ json.dumps(value) for value in values.tolist() ]
+    return formatted
+
+def format_rows( df ):
+
+    ## formatting each column at once instead of building one dict per row
+    columns = [ format_float_column(df[column].values) for column in ['origin_x', 'origin_y', 'origin_z', 'direction_x', 'direction_y', 'direction_z'] ]
+    timestamps = df['timestamp'].values.astype(np.int64).tolist()
+
+    return [
+        f'{{"GazeOrigin": {{"x": {ox}, "y": {oy}, "z": {oz}}}, "GazeDirection": {{"x": {dx}, "y": {dy}, "z": {dz}}}, "timestamp": "{ts}-0 "}}'
+        for ox, oy, oz, dx, dy, dz, ts in zip(*columns, timestamps)
+    ]
+
+def write_json( chunks, outputFile ):
+
+    ## streaming the array to disk one chunk at a time
+    outputFile.write('[')
+    first = True
+    for df in chunks:
+        with profiler.stage('eye.serialise'):
+            rows = format_rows(df)
+            if( len(rows) == 0 ):
+                continue
+            text = ', '.join(rows)
+            if( not first ):
+                outputFile.write(', ')
+            outputFile.write(text)
+            first = False
+        profiler.count('eye.json_bytes', len(text))
+    outputFile.write(']')
+
+def collect_columns( chunks, writer ):
+
+    ## passing the chunks through while keeping typed copies for the .npz
+    for df in chunks:
+        with profiler.stage('eye.columns'):
+            writer.append(
+                timestamp = df['timestamp'].values,
+                origin = df[['origin_x', 'origin_y', 'origin_z']].values,
+                direction = df[['direction_x', 'direction_y', 'direction_z']].values)
+        yield df
+
+def parse( conn, output: str, chunkSize: int = 100000, outputFormat: str = 'json' ):
 
-    formattedObject = []
-    df.apply( lambda row: parse_row(row, formattedObject), axis=1)
-    
-    return formattedObject
-
-def parse_row( row, formattedObject ):
-
-    gazeOrigin = { 'x': row['origin_x'], 'y': row['origin_y'], 'z': row['origin_z'] }
-    gazeDirection = { 'x': row['direction_x'], 'y': row['direction_y'], 'z': row['direction_z'] }
-    timestamp = f'{int(row["timestamp"])}-0 ' 
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
 
-    currentRow = {
-        "GazeOrigin": gazeOrigin,
-        "GazeDirection": gazeDirection,
-        "timestamp": timestamp
-    }
+    chunks = read_gaze( conn, chunkSize )
 
-    formattedObject.append(currentRow)
+    writer = None
+    if( outputFormat in ['npz', 'both'] ):
+        writer = columnar.ColumnWriter(os.path.join(output, 'eye.npz'), 'eye.json',
+            timestamp=(np.int64, ()), origin=(np.float32, (3,)), direction=(np.float32, (3,)))
+        chunks = collect_columns( chunks, writer )
 
-def main( input: str, output: str ):
+    if( outputFormat in ['json', 'both'] ):
+        outputPath = os.path.join(output, 'eye.json')
+        with open(outputPath, 'w') as f:
+            write_json( chunks, f )
+    else:
+        for _ in chunks:
+            pass
 
-    eyeData = read_db( input )
+    if( writer is not None ):
+        writer.close()
 
-    outputPath = os.path.join(output, 'eye.json')
-    if( not os.path.exists(output) ):
-        os.makedirs(output)
+def main( input: str, output: str, chunkSize: int = 100000, outputFormat: str = 'json', profile: str = None ):
 
-    with open(outputPath, 'w') as f:
-        f.write(json.dumps(eyeData))
+    profiler.run( 'eye-parser', output, profile, parse, sqlite3.connect(input), output, chunkSize, outputFormat )
 
 
 if __name__ == "__main__":
@@ -58,6 +122,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This scripts aims to parse the Ocarina data stored into SQLite files to NYU backend format')
     parser.add_argument('-i', '--input', nargs=1, required=True, default='')
     parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('-c', '--chunk-size', type=int, default=100000, help='number of gaze rows read and written at a time')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write eye.json, the columnar eye.npz, or both')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write eye-parser_profile.json with the time of each stage, and with "cprofile" also eye-parser.prof')
 
     args = parser.parse_args()
-    main(args.input[0],args.output[0])
\ No newline at end of file
+    main(args.input[0],args.output[0],args.chunk_size,args.format,args.profile)
\ No newline at end of file
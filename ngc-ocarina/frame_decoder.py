@@ -0,0 +1,71 @@
+import threading
+
+import cv2
+import numpy as np
+
+class FrameDecoder:
+    """ decodes raw hl2 frame blobs into BGR images.
+
+        The dtype, shape and color conversion of every
+        (encoding, width, height, is_bigendian) layout is computed once and
+        cached. raw() is a zero-copy view of the blob, and to_bgr() converts
+        it with a single cv2.cvtColor call, optionally into a reusable
+        output buffer.
+    """
+
+    def __init__(self):
+        self._layouts = dict()
+        self._buffers = threading.local()
+
+    def layout(self, encoding, width, height, is_bigendian):
+        """ :return: (dtype, shape, cv2 conversion code) of a frame layout """
+        key = (encoding, int(width), int(height), bool(is_bigendian))
+        layout = self._layouts.get(key)
+        if layout is None:
+            dt = np.dtype(np.uint8)
+            dt = dt.newbyteorder(">" if key[3] else "<")
+            if encoding == "bgra8":
+                layout = (dt, (key[2], key[1], 4), cv2.COLOR_BGRA2BGR)
+            else:
+                # Mono frames are stored width first
+                layout = (dt, (key[1], key[2]), cv2.COLOR_GRAY2BGR)
+            self._layouts[key] = layout
+        return layout
+
+    def raw(self, data, encoding, width, height, is_bigendian):
+        # Read-only view of the blob in its stored layout, no copy
+        dt, shape, _ = self.layout(encoding, width, height, is_bigendian)
+        return np.frombuffer(data, dtype=dt).reshape(shape)
+
+    def to_bgr(self, raw, out=None):
+        """ convert a raw() view into a contiguous 3-channel BGR image.
+        :param out: preallocated (rows, cols, 3) uint8 buffer to write into,
+            see output_buffer()
+        """
+        code = cv2.COLOR_BGRA2BGR if raw.ndim == 3 else cv2.COLOR_GRAY2BGR
+        if out is None:
+            return cv2.cvtColor(raw, code)
+        return cv2.cvtColor(raw, code, dst=out)
+
+    def decode(self, data, encoding, width, height, is_bigendian, out=None):
+        return self.to_bgr(self.raw(data, encoding, width, height, is_bigendian), out)
+
+    def raw_row(self, image_row):
+        return self.raw(image_row.data, image_row.encoding,
+                        image_row.width, image_row.height, image_row.is_bigendian)
+
+    def decode_row(self, image_row, out=None):
+        return self.to_bgr(self.raw_row(image_row), out)
+
+    def output_buffer(self, raw):
+        """ BGR buffer for converting raw, one per resolution and thread.
+            Its content is only valid until the next frame of the same
+            resolution is converted into it on that thread.
+        """
+        buffers = getattr(self._buffers, "buffers", None)
+        if buffers is None:
+            buffers = self._buffers.buffers = dict()
+        shape = raw.shape[:2] + (3,)
+        if shape not in buffers:
+            buffers[shape] = np.empty(shape, dtype=np.uint8)
+        return buffers[shape]
@@ -0,0 +1,152 @@
+""" Fixed-stride store of the decoded frames of one feed.
+
+    A store is three files next to each other: <name>.frames holds the
+    BGR frames back to back, each in a slot of the same `stride` bytes, so
+    frame i starts at i * stride; <name>.index holds one INDEX_DTYPE record
+    per frame (image_count, epoch microsecond timestamp, byte offset and
+    frame shape); <name>.json holds the stride and the index layout.
+    FrameStore memory-maps both files, so reading any frame is a
+    constant-time slice of the page cache, without decoding or copying.
+"""
+
+import json
+import os
+
+import numpy as np
+
+STORE_VERSION = 1
+INDEX_DTYPE = np.dtype([('image_count', '<i8'), ('timestamp', '<i8'), ('offset', '<i8'), ('rows', '<i4'), ('cols', '<i4')])
+
+def store_paths(path):
+    """ :return: (frames, index, header) paths of the store at path, with or without its .frames extension """
+    if path.endswith('.frames'):
+        path = path[:-len('.frames')]
+    return f"{path}.frames", f"{path}.index", f"{path}.json"
+
+class FrameStoreWriter:
+    """ appends frames to a store. The stride is taken from the first frame
+        written to a new store; frames of another shape but no more bytes
+        (e.g. mono frames, stored width first) share it, zero padded.
+        Index records are buffered and only written by flush(), after the
+        frames they point at, so a store cut short by a crash never indexes
+        a frame that isn't on disk.
+    """
+
+    def __init__(self, path, frames_size=0, index_size=0):
+        """ open the store at path for appending, dropping whatever was
+            written after frames_size and index_size bytes (e.g. by an
+            interrupted run). Both 0 starts a new store.
+        """
+        self.frames_path, self.index_path, self.header_path = store_paths(path)
+        self.stride = None
+        if frames_size > 0 or index_size > 0:
+            with open(self.header_path, 'r') as f:
+                self.stride = json.load(f)['stride']
+        if index_size % INDEX_DTYPE.itemsize != 0 or (self.stride is not None and frames_size != index_size // INDEX_DTYPE.itemsize * self.stride):
+            raise ValueError(f"{self.frames_path} sizes {frames_size} and {index_size} don't match its index")
+
+        for file_path, size in [(self.frames_path, frames_size), (self.index_path, index_size)]:
+            with open(file_path, 'ab') as f:
+                if f.tell() < size:
+                    raise ValueError(f"{file_path} is shorter than {size} bytes")
+                f.truncate(size)
+        self.frames_file = open(self.frames_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        self.count = index_size // INDEX_DTYPE.itemsize
+        self.pending = []
+
+    def append(self, image_count, timestamp, image):
+        """ :param timestamp: epoch microseconds
+        :param image: (rows, cols, 3) uint8 frame, written as is
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if self.stride is None:
+            self.stride = image.nbytes
+            with open(self.header_path, 'w') as f:
+                f.write(json.dumps({'version': STORE_VERSION, 'stride': self.stride, 'channels': 3,
+                                    'index_dtype': INDEX_DTYPE.descr}))
+        if image.nbytes > self.stride:
+            raise ValueError(f"Frame {image_count} of {image.nbytes} bytes doesn't fit the {self.stride} byte stride of {self.frames_path}")
+
+        self.frames_file.write(image.data)
+        if image.nbytes < self.stride:
+            self.frames_file.write(bytes(self.stride - image.nbytes))
+        self.pending.append((int(image_count), int(timestamp), (self.count + len(self.pending)) * self.stride,
+                             image.shape[0], image.shape[1]))
+
+    def flush(self):
+        """ write the frames appended so far and their index records
+        :return: (frames, index) sizes in bytes, to reopen the store at
+        """
+        self.frames_file.flush()
+        if len(self.pending) > 0:
+            self.index_file.write(np.array(self.pending, dtype=INDEX_DTYPE).tobytes())
+            self.index_file.flush()
+            self.count += len(self.pending)
+            self.pending = []
+        return self.frames_file.tell(), self.index_file.tell()
+
+    def close(self):
+        sizes = self.flush()
+        self.frames_file.close()
+        self.index_file.close()
+        return sizes
+
+class FrameStore:
+    """ read-only view of a store, see the module docstring.
+        store[i] is the i-th frame written, as a read-only view of the
+        memory map; frame() looks a frame up by image_count and at() by time.
+    """
+
+    def __init__(self, path):
+        self.frames_path, self.index_path, self.header_path = store_paths(path)
+        with open(self.header_path, 'r') as f:
+            self.header = json.load(f)
+        self.stride = self.header['stride']
+
+        # Only frames that are both indexed and on disk, the store may still be growing
+        count = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        count = min(count, os.path.getsize(self.frames_path) // self.stride)
+        if count > 0:
+            self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(count,))
+            self.data = np.memmap(self.frames_path, dtype=np.uint8, mode='r', shape=(count * self.stride,))
+        else:
+            self.index = np.empty(0, dtype=INDEX_DTYPE)
+            self.data = np.empty(0, dtype=np.uint8)
+        self._positions = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, position):
+        record = self.index[position]
+        offset = int(record['offset'])
+        rows, cols = int(record['rows']), int(record['cols'])
+        return self.data[offset:offset + rows * cols * 3].reshape(rows, cols, 3)
+
+    @property
+    def image_counts(self):
+        return self.index['image_count']
+
+    @property
+    def timestamps(self):
+        # epoch microseconds of each frame, in the order they were written
+        return self.index['timestamp']
+
+    def frame(self, image_count):
+        # built on the first lookup, a dict lookup from then on
+        if self._positions is None:
+            self._positions = {count: position for position, count in enumerate(self.image_counts.tolist())}
+        return self[self._positions[int(image_count)]]
+
+    def at(self, timestamp):
+        """ :return: position of the last frame at or before timestamp (epoch
+            microseconds), -1 before the first frame
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1
+
+    def close(self):
+        # drop the memory maps, views handed out keep them alive until they are freed
+        self.index = np.empty(0, dtype=INDEX_DTYPE)
+        self.data = np.empty(0, dtype=np.uint8)
+        self._positions = None
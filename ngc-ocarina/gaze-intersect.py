@@ -0,0 +1,150 @@
+import argparse
+from datetime import datetime
+import json
+import os
+import sqlite3
+
+import numpy as np
+import yaml
+
+import columnar
+from mesh_bvh import BVH, load_mesh
+import profiler
+from script_loader import load_script
+
+eye_parser = load_script("eye-parser")
+
+def read_gaze(input: str, chunk_size: int):
+    """ gaze samples of an eye.npz (written with eye-parser.py -f npz/both) or
+        of the hl2_gaze table of a trial database, chunk_size at a time
+    :return: generator of (epoch ms timestamps, origins, directions)
+    """
+    if input.endswith('.npz'):
+        kind, columns = columnar.load(input)
+        if kind != 'eye.json':
+            raise ValueError(f"{input} holds {kind}, not eye.json")
+        for start in range(0, len(columns['timestamp']), chunk_size):
+            yield (columns['timestamp'][start:start + chunk_size],
+                   columns['origin'][start:start + chunk_size],
+                   columns['direction'][start:start + chunk_size])
+        return
+
+    for df in eye_parser.read_gaze(sqlite3.connect(input), chunk_size):
+        yield (df['timestamp'].values,
+               df[['origin_x', 'origin_y', 'origin_z']].values,
+               df[['direction_x', 'direction_y', 'direction_z']].values)
+
+def group_components(groups, components):
+    """ component index of each mesh group, -1 for groups of no component
+    :param components: label -> names of the mesh groups (OBJ objects or
+        groups, PLY face property values) it is made of, matched
+        case-insensitively as substrings
+    """
+    labels = list(components)
+    indices = np.full(len(groups), -1, dtype=np.int32)
+    for i, group in enumerate(groups):
+        for index, label in enumerate(labels):
+            if any(str(name).lower() in group.lower() for name in components[label]):
+                indices[i] = index
+                break
+    return indices
+
+def intersect_chunks(chunks, bvh, face_components, batch_size, max_distance):
+    # hit columns of each chunk, the rays cast batch_size at a time
+    for timestamp, origin, direction in chunks:
+        distance = np.empty(len(timestamp))
+        face = np.empty(len(timestamp), dtype=np.int64)
+        hit = np.empty((len(timestamp), 3))
+        for start in range(0, len(timestamp), batch_size):
+            end = start + batch_size
+            with profiler.stage('gaze.intersect'):
+                distance[start:end], face[start:end], hit[start:end] = bvh.intersect(
+                    origin[start:end], direction[start:end], max_distance)
+        profiler.count('gaze.rays', len(timestamp))
+        profiler.count('gaze.hits', int(np.count_nonzero(face >= 0)))
+        yield {
+            'timestamp': np.asarray(timestamp, dtype=np.int64),
+            'hit': hit.astype(np.float32),
+            'distance': np.where(face >= 0, distance, np.nan).astype(np.float32),
+            'component': np.where(face >= 0, face_components[np.maximum(face, 0)], -1).astype(np.int32),
+            'face': face,
+        }
+
+def write_json(chunks, output_file, components):
+    # stream the array to disk one chunk at a time
+    output_file.write('[')
+    first = True
+    for columns in chunks:
+        with profiler.stage('gaze.serialise'):
+            records = [json.dumps(record) for record in columnar.gaze_hit_records(dict(columns, components=components))]
+            if len(records) > 0:
+                if not first:
+                    output_file.write(', ')
+                output_file.write(', '.join(records))
+                first = False
+        yield columns
+    output_file.write(']')
+
+def parse( input: str, output: str, model_path: str, config: dict, output_format: str = 'json' ):
+    """ write gaze:hits.json (and/or gaze:hits.npz): where each gaze ray meets the model, and the component it looks at """
+    print(f"Loading {model_path} {datetime.now()}")
+    with profiler.stage('gaze.load_model'):
+        mesh = load_mesh(model_path, config.get('group_property', 'component'))
+        mesh = mesh.transformed(config.get('transform') or np.eye(4))
+    with profiler.stage('gaze.build_bvh'):
+        bvh = BVH(mesh, config['leaf_size'])
+    components = np.array(list(config['components']), dtype=str)
+    face_components = group_components(mesh.groups, config['components'])[mesh.face_groups]
+    print(f"Built BVH of {len(mesh.faces)} triangles, {bvh.depth} levels {datetime.now()}")
+
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+
+    chunks = intersect_chunks(
+        profiler.timed(read_gaze(input, config['chunk_size']), 'gaze.fetch'),
+        bvh, face_components, config['batch_size'], config.get('max_distance') or np.inf)
+
+    writer = None
+    if output_format in ['npz', 'both']:
+        writer = columnar.ColumnWriter(os.path.join(output, 'gaze:hits.npz'), 'gaze:hits.json',
+            timestamp=(np.int64, ()), hit=(np.float32, (3,)), distance=(np.float32, ()),
+            component=(np.int32, ()), face=(np.int64, ()))
+
+    json_file = open(os.path.join(output, 'gaze:hits.json'), 'w') if output_format in ['json', 'both'] else None
+    try:
+        if json_file is not None:
+            chunks = write_json(chunks, json_file, components)
+        for columns in chunks:
+            if writer is not None:
+                writer.append(**columns)
+    finally:
+        if json_file is not None:
+            json_file.close()
+
+    if writer is not None:
+        writer.close(components=components)
+    print(f"Finished gaze intersection {datetime.now()}")
+
+def main( input: str, output: str, model_path: str, config_path: str, output_format: str = 'json', profile: str = None ):
+
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    profiler.run('gaze-intersect', output, profile, parse, input, output, model_path, config, output_format)
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python gaze-intersect.py -i /foo/0293_11.sqlite -m /foo/bar/model.obj -o /bar/0293_11
+    ## python gaze-intersect.py -i /bar/0293_11/eye.npz -m /foo/bar/model.ply -o /bar/0293_11 -f both
+
+    parser = argparse.ArgumentParser(description='This scripts aims to find where each gaze ray meets the 3D model of the cockpit, and which component it looks at')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='', help='trial SQLite file, or the eye.npz of a parsed session')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('-m', '--model', nargs=1, required=True, default='', help='cockpit model as .obj or .ply')
+    parser.add_argument('--config', default='./config/config_gaze_intersect.yaml', help='model transform, component groups and batch sizes')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write gaze:hits.json, the columnar gaze:hits.npz, or both')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write gaze-intersect_profile.json with the time of each stage, and with "cprofile" also gaze-intersect.prof')
+
+    args = parser.parse_args()
+    main(args.input[0],args.output[0],args.model[0],args.config,args.format,args.profile)
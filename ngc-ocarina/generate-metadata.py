@@ -1,30 +1,111 @@
 import argparse
 import json
 import os
+import re
+import struct
 
-# required to install "pip install moviepy"
+# MP4 boxes that hold other boxes on the way to mvhd
+CONTAINER_BOXES = {b'moov'}
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp": "([^"]*)"')
 
-from moviepy.editor import VideoFileClip
-    
-def getMetadata(video_path, objects_file_path):
-    clip = VideoFileClip(video_path)
-    # Opening JSON file that contains objects (it must be sorted by timestamps)
-    file_objects = open(objects_file_path)
-    # returns JSON object as a dictionary
-    data = json.load(file_objects)
+def getVideoDuration(video_path, fast=True):
+    if( not fast ):
+        # required to install "pip install moviepy"
+        from moviepy.editor import VideoFileClip
+        clip = VideoFileClip(video_path)
+        return clip.duration
+
+    duration = getMp4Duration(video_path)
+    if( duration is None ):
+        duration = getCv2Duration(video_path)
+    return duration
+
+def getMp4Duration(video_path):
+    # read the duration from the movie header (mvhd) box, skipping over the media data
+    with open(video_path, 'rb') as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        end = fileSize
+        while( f.tell() + 8 <= end ):
+            boxStart = f.tell()
+            size, boxType = struct.unpack('>I4s', f.read(8))
+            if( size == 1 ):
+                size = struct.unpack('>Q', f.read(8))[0]
+            elif( size == 0 ):
+                size = end - boxStart
+            if( size < 8 ):
+                return None
+
+            if( boxType in CONTAINER_BOXES ):
+                # descend into the box
+                end = boxStart + size
+                continue
+            if( boxType == b'mvhd' ):
+                version = f.read(4)[0]
+                if( version == 1 ):
+                    _, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+                else:
+                    _, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+                return duration / timescale if timescale > 0 else None
+            f.seek(boxStart + size)
+    return None
+
+def getCv2Duration(video_path):
+    # fallback for containers without a readable mvhd box
+    import cv2
+    capture = cv2.VideoCapture(video_path)
+    frames = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return frames / fps if fps > 0 else 0
+
+def getJsonEntries(objects_file_path, blockSize=65536):
+    # first and last "timestamp" of a sorted JSON array, read from the head and the tail of the file only
+    with open(objects_file_path, 'rb') as f:
+        fileSize = os.fstat(f.fileno()).st_size
+
+        firstEntry = None
+        readSize = blockSize
+        while( firstEntry is None ):
+            f.seek(0)
+            match = TIMESTAMP_PATTERN.search(f.read(readSize))
+            if( match is not None ):
+                firstEntry = match.group(1).decode()
+            elif( readSize >= fileSize ):
+                return None, None
+            readSize *= 2
+
+        lastEntry = None
+        readSize = blockSize
+        while( lastEntry is None ):
+            f.seek(max(0, fileSize - readSize))
+            matches = TIMESTAMP_PATTERN.findall(f.read(readSize))
+            if( len(matches) > 0 ):
+                lastEntry = matches[-1].decode()
+            readSize *= 2
+
+    return firstEntry, lastEntry
 
+def buildMetadata(duration, first_entry, last_entry):
     metadata ={
-            "duration_secs": int(clip.duration),
-            "first-entry": data[0]["timestamp"],
-            "last-entry": data[len(data)-1]["timestamp"],
+            "duration_secs": int(duration),
+            "first-entry": first_entry,
+            "last-entry": last_entry,
         }
     return metadata
 
-def main( input: str, output: str ):
-    # input: video
-    perceptionFilePath = os.path.join(output, 'detic:image.json')
-    json_metadata = getMetadata(input, perceptionFilePath)
+def getMetadata(video_path, objects_file_path, fast=True):
+    if( fast ):
+        first_entry, last_entry = getJsonEntries(objects_file_path)
+        return buildMetadata(getVideoDuration(video_path), first_entry, last_entry)
 
+    # Opening JSON file that contains objects (it must be sorted by timestamps)
+    file_objects = open(objects_file_path)
+    # returns JSON object as a dictionary
+    data = json.load(file_objects)
+
+    return buildMetadata(getVideoDuration(video_path, fast=False), data[0]["timestamp"], data[len(data)-1]["timestamp"])
+
+def writeMetadata(json_metadata, output: str):
     outputPath = os.path.join(output, 'additional_metadata.json')
 
     if( not os.path.exists(output) ):
@@ -33,6 +114,12 @@ def main( input: str, output: str ):
     with open(outputPath, 'w') as f:
         f.write(json.dumps(json_metadata))
 
+def main( input: str, output: str, fast: bool = True ):
+    # input: video
+    perceptionFilePath = os.path.join(output, 'detic:image.json')
+    json_metadata = getMetadata(input, perceptionFilePath, fast)
+    writeMetadata(json_metadata, output)
+
 
 if __name__ == "__main__":
 
@@ -42,6 +129,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This scripts aims to generate the following metadata: duration_sec, first-entry, and last-entry, based on video and detic:image.json files')
     parser.add_argument('-i', '--input', nargs=1, required=True, default='')
     parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('--full', action='store_true', help='open the video with moviepy and parse the whole detic:image.json instead of reading headers')
 
     args = parser.parse_args()
-    main(args.input[0],args.output[0])
\ No newline at end of file
+    main(args.input[0],args.output[0],not args.full)
\ No newline at end of file
@@ -1,29 +1,44 @@
 #!/usr/bin/python
 
 # Import statements
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from annotator import paint_components, parse_chunk_components
 import cv2
 from datetime import datetime
+from frame_decoder import FrameDecoder
+from frame_store import FrameStoreWriter
+from manifest import Manifest, truncate_file
 import gc
-import numpy as np
 import os
 import pandas as pd
+import profiler
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import timestamps
 import yaml
 
+# Shared by all extraction paths, caches the layout of each frame format
+frame_decoder = FrameDecoder()
+
 def main():
+    # Truthy on failure: True when nothing could run, else the failed jobs
     # Get config parameters
     try:
         with open("./config/config_image_extractor.yaml", "r") as stream:
             config = yaml.safe_load(stream)
     except:
         print(f"Error reading config file")
-        return
+        return True
 
     # Get trial list from config file
     trial_list = config["trial_list"]
     if trial_list is None or len(trial_list) == 0:
         print(f"Invalid trial_id")
-        return
+        return True
 
     # Get bounding box colors from config file
     color_dict = dict()
@@ -32,6 +47,7 @@ def main():
 
     # Extract configuration parameters
     database_path_base = config["database_path"]
+    jobs = []
     for subject_id, trial_id in trial_list:
         # Ensure database file exists
         database_path = database_path_base + \
@@ -47,261 +63,459 @@ def main():
             os.makedirs(output_path)
 
         # Gather image and video feeds to extract for this trial
-        image_feeds_to_extract = []
-        video_feeds_to_extract = []
+        trial_jobs = []
         for feed in config["feeds"]:
-            if config["feeds"][feed]["extract_images"]:
-                image_feeds_to_extract.append(
-                    (feed, config["feeds"][feed]["include_bbs"]))
-            if config["feeds"][feed]["extract_video"]:
-                video_feeds_to_extract.append(
-                    (feed, config["feeds"][feed]["include_bbs"]))
-
-        if len(image_feeds_to_extract) == 0 and len(video_feeds_to_extract) == 0:
+            for mode in ["images", "frames", "video"]:
+                if config["feeds"][feed].get(f"extract_{mode}", False):
+                    trial_jobs.append({
+                        "subject_id": subject_id,
+                        "trial_id": trial_id,
+                        "database_path": database_path,
+                        "output_path": output_path,
+                        "feed": (feed, config["feeds"][feed]["include_bbs"]),
+                        "mode": mode})
+
+        if len(trial_jobs) == 0:
             print("Nothing to extract, check config settings")
             continue      
+        jobs.extend(trial_jobs)
+
+    return run_jobs(jobs, config, color_dict)
+
+def run_jobs(jobs, config, color_dict):
+    """ run (trial, feed, mode) jobs on a process pool. At most
+        max_concurrent_jobs run at once, and a job only starts while the
+        estimated memory of the running jobs stays within memory_budget_gb
+        (a job larger than the whole budget runs alone). A failing job is
+        reported and the remaining jobs keep going.
+    """
+    max_jobs = config.get("max_concurrent_jobs", 1)
+    memory_budget = config.get("memory_budget_gb", 0) * 1024**3
+
+    waiting = deque((job, estimate_job_memory(job, config)) for job in jobs)
+    running = dict()
+    failures = []
+    done_count = 0
+    start_time = datetime.now()
+    with ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        while len(waiting) > 0 or len(running) > 0:
+            # Start jobs while there are free slots and memory left
+            while len(waiting) > 0 and len(running) < max_jobs:
+                job, job_memory = waiting[0]
+                running_memory = sum(memory for _, memory in running.values())
+                if memory_budget > 0 and len(running) > 0 and running_memory + job_memory > memory_budget:
+                    break
+                waiting.popleft()
+                print(f"Starting {job_name(job)} (~{job_memory / 1024**2:.0f} MB)")
+                future = executor.submit(run_job, job, config, color_dict)
+                running[future] = (job, job_memory)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job, _ = running.pop(future)
+                done_count += 1
+                try:
+                    future.result()
+                    status = "done"
+                except Exception as e:
+                    failures.append((job, e))
+                    status = f"failed: {e!r}"
+                elapsed = datetime.now() - start_time
+                print(f"[{done_count}/{len(jobs)}] {job_name(job)} {status} ({elapsed})")
+
+    # Per-job failure summary
+    if len(failures) > 0:
+        print(f"{len(failures)} of {len(jobs)} jobs failed:")
+        for job, e in failures:
+            print(f"  {job_name(job)}: {e!r}")
+    else:
+        print(f"All {len(jobs)} jobs finished")
+    return failures
+
+def job_name(job):
+    return f"{job['feed'][0]} {job['mode']} extraction for {job['subject_id']}:{job['trial_id']}"
+
+def estimate_job_memory(job, config):
+    # Estimate peak memory of a job from the size of its first frame and its frame count
+    if config.get("job_memory_mb", 0) > 0:
+        # Jobs in memory-budget mode size their chunks to stay within it
+        return config["job_memory_mb"] * 1024**2
+    image_table, _ = job["feed"]
+    try:
+        con = sqlite3.connect(job["database_path"])
+        width, height = con.execute(
+            f"SELECT width, height FROM {image_table} LIMIT 1;").fetchone()
+        frame_count = con.execute(f"SELECT count(*) FROM {image_table};").fetchone()[0]
+        con.close()
+    except Exception:
+        # Let the job itself report unreadable databases
+        return 0
+    frame_bytes = int(width) * int(height) * 4
+
+    # A chunk of raw frames is held while it is decoded, no more than the table holds
+    chunk_frames = min(config["chunk_size"], frame_count)
+    chunk_bytes = chunk_frames * frame_bytes
+    if job["mode"] == "images":
+        decoded_frames = 2 * config.get("workers", 1)
+    elif job["mode"] == "frames":
+        decoded_frames = 1
+    elif config.get("video_mode", "stream") == "chunked":
+        decoded_frames = chunk_frames
+    else:
+        decoded_frames = config.get("video_queue_size", 8)
+    return chunk_bytes + decoded_frames * frame_bytes
+
+def run_job(job, config, color_dict):
+    # With profile set in the config each job writes its own profile next to its outputs
+    image_table = job["feed"][0]
+    profiler.run(
+        f"{image_table}_{job['mode']}",
+        os.path.join(job["output_path"], image_table),
+        config.get("profile"),
+        extract, job, config, color_dict)
+
+def extract(job, config, color_dict):
+    subject_id, trial_id = job["subject_id"], job["trial_id"]
+    database_path, output_path = job["database_path"], job["output_path"]
+    feed = job["feed"]
+    memory_limit = config.get("job_memory_mb", 0) * 1024**2
+
+    # Extract image feed
+    if job["mode"] == "images":
+        generate_images(
+            database_path,
+            output_path,
+            trial_id,
+            feed,
+            chunk_size=config["chunk_size"],
+            color_dict=color_dict,
+            workers=config.get("workers", 1),
+            worker_type=config.get("worker_type", "thread"),
+            reuse_buffers=config.get("reuse_frame_buffers", False),
+            resume=config.get("resume", True),
+            memory_limit=memory_limit)
+        return
 
-        # Extract image feeds
-        for image_feed in image_feeds_to_extract:
-            print(
-                f"Starting {image_feed[0]} image extraction for {subject_id}:{trial_id}")
-            generate_images(
-                database_path,
-                output_path,
-                trial_id,
-                image_feed,
-                chunk_size=config["chunk_size"],
-                color_dict=color_dict)
-
-        # Generate video feeds
-        for video_feed in video_feeds_to_extract:
+    # Write the frame store of the feed
+    if job["mode"] == "frames":
+        generate_frame_store(
+            database_path,
+            output_path,
+            trial_id,
+            feed,
+            chunk_size=config["chunk_size"],
+            color_dict=color_dict,
+            resume=config.get("resume", True),
+            memory_limit=memory_limit)
+        return
+
+    # Generate video feed
+    if config.get("video_mode", "stream") == "chunked":
+        video_tuples = generate_videos(
+            database_path,
+            output_path,
+            trial_id,
+            feed,
+            chunk_size=config["chunk_size"],
+            color_dict=color_dict,
+            resume=config.get("resume", True),
+            memory_limit=memory_limit)
+
+        if len(video_tuples) > 0:
             print(
-                f"Starting {video_feed[0]} video extraction for {subject_id}:{trial_id}")
-            video_tuples = generate_videos(
-                database_path,
-                output_path,
-                trial_id,
-                video_feed,
-                chunk_size=config["chunk_size"],
-                color_dict=color_dict)
-
-            if len(video_tuples) > 0:
-                print(
-                    f"Combining {video_feed[0]} video feeds for {subject_id}:{trial_id}")
-                combine_videos(video_tuples, output_path, video_feed)
-
-def generate_images(database_path, output_path, trial_id, image_feed, chunk_size=3000, color_dict=None):
-    # Get database connection
-    con = sqlite3.connect(database_path)
+                f"Combining {feed[0]} video feeds for {subject_id}:{trial_id}")
+            combine_videos(video_tuples, output_path, feed)
+    else:
+        stream_video(
+            database_path,
+            output_path,
+            trial_id,
+            feed,
+            chunk_size=config["chunk_size"],
+            color_dict=color_dict,
+            queue_size=config.get("video_queue_size", 8),
+            resume=config.get("resume", True),
+            memory_limit=memory_limit)
+
+def generate_images(database_path, output_path, trial_id, image_feed, chunk_size=3000, color_dict=None, workers=1, worker_type="thread", reuse_buffers=False, resume=True, con=None, memory_limit=0):
+    """ write one PNG per frame. Frames are read and decoded on this thread
+        while a pool of workers threads (or processes, with
+        worker_type="process") draws the bounding boxes and encodes them.
+        Workers convert the zero-copy frame view to BGR themselves, with
+        reuse_buffers into one preallocated buffer per resolution.
+        Finished chunks are recorded in a manifest, and with resume a rerun
+        continues after the last one (or only extracts newly added frames).
+        With memory_limit (bytes) rows are streamed, see stream_image_chunks.
+    """
+    # Get database connection, unless a shared one is given
+    if con is None:
+        con = sqlite3.connect(database_path)
 
     # Extract image table and whether bounding boxes should be drawn
     image_table, bounding_boxes = image_feed
 
-    # Get total image count
-    if bounding_boxes:
-        query = f"""SELECT COUNT(1)
-                FROM {image_table} LEFT OUTER JOIN {image_table}_bounding_boxes USING (image_count);"""
-    else:
-        query = f"SELECT COUNT(1) FROM {image_table};"
-    image_count = pd.read_sql_query(
-        query, con).iloc[0][0]
-
     # Check for and create output path for this feed
     if not os.path.exists(os.path.join(output_path, image_table, "images")):
         os.makedirs(os.path.join(output_path, image_table, "images"))
 
-    last_timestamp = None
-    current_pointer = 0
-    # Loop until full count is reached
-    while current_pointer < image_count:
-        time_list = []
-        if current_pointer+chunk_size > image_count:
-            chunk_size = image_count-current_pointer
-
-        # Query for bounding box entries, if desired
-        if bounding_boxes:
-            print(f"Running image and bounds query {datetime.now()}")
-            query = f"""SELECT {image_table}.*, {image_table}_bounding_boxes.component_id, {image_table}_bounding_boxes.bounds
-                FROM {image_table} LEFT OUTER JOIN {image_table}_bounding_boxes USING (image_count)
-                ORDER BY timestamp LIMIT {chunk_size} OFFSET {current_pointer};"""
-            images_df = pd.read_sql_query(
-                query,
-                con)
-        else:
-            print(f"Running image query {datetime.now()}")
-            query = f"SELECT * FROM {image_table} ORDER BY timestamp LIMIT {chunk_size} OFFSET {current_pointer};"
-            images_df = pd.read_sql_query(
-                query,
-                con)
-
-        # Write all images in chunk to file
-        print(f"Parsing image chunk {datetime.now()}")
-        id_group = images_df.groupby(["image_count"])
-        for _, grouping in id_group:
-            # Extract image data and convert to cv2 object
-            image_row = grouping.iloc[0]
-            dt = np.dtype(np.uint8)
-            dt = dt.newbyteorder(">" if bool(image_row.is_bigendian) else "<")
-            num_channels = 4 if image_row.encoding == "bgra8" else 1
-            image_data = np.frombuffer(image_row.data, dtype=dt)
-            if num_channels == 4:
-                image_data = np.reshape(
-                    image_data, (int(image_row.height), int(image_row.width), num_channels))
-                image_data = image_data[:, :, 0:3]
-                image_data = np.reshape(
-                    image_data, (int(image_row.height), int(image_row.width), 3))
-            else:
-                image_data = np.reshape(
-                    image_data, (int(image_row.width), int(image_row.height)))
-                image_data = np.stack((image_data,)*3, axis=-1)
-
-            # Draw bounding boxes on image
-            if bounding_boxes:
-                for _, row in grouping.iterrows():
-                    if row.bounds != None:
-                        bounds = np.frombuffer(row.bounds, dtype=np.int64)
-                        bounds = bounds.reshape(((int)(len(bounds)/2), 2))
-                        color = (255, 0, 0)
-                        if color_dict is not None:
-                            color = color_dict[row.component_id]
-
-                        image_data = draw_component(
-                            image_data,
-                            bounds,
-                            color=color)
-
-            # Create image file title
-            current_timestamp = datetime.strptime(
-                image_row.timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            current_timestamp_str = datetime.strftime(
-                current_timestamp, "%Y-%m-%d_%H:%M:%S.%f")
-
-            title = f"{image_row.image_count}_{current_timestamp_str}.png"
-            title = title.replace(":", "_")
-            path_to_image = os.path.join(output_path, image_table,
-                                         "images", title)
-
-            if last_timestamp != None:
-                time_diff_seconds = (current_timestamp -
-                                     last_timestamp).total_seconds()
-                time_list.append(f"duration {time_diff_seconds}")
-
-            time_list.append(f"file {path_to_image}")
-            last_timestamp = current_timestamp
-
-            # Write image to file
-            if not cv2.imwrite(path_to_image, image_data):
-                raise Exception(
-                    f"Failed to write image at path: {path_to_image}")
-
-        current_pointer += chunk_size
-
-        print(f"Writing second table {datetime.now()}")
-        with open(os.path.join(output_path,
-                            image_table,
-                            "images",
-                            f"{image_table}_timecodes.txt"), "a") as f:
-            for line in time_list:
-                f.write(f"{line}\n")
-        
-        # Cleanup for memory management
-        del images_df, time_list
-        gc.collect()
-
-def generate_videos(database_path, output_path, trial_id, image_feed, chunk_size=3000, rgb_fps=30, vlc_fps=5, color_dict=None):
-    # Get database connection
-    con = sqlite3.connect(database_path)
+    # Pick up after the chunks a previous run finished
+    manifest = Manifest(
+        os.path.join(output_path, image_table, "images", f"{image_table}_manifest.jsonl"),
+        {"mode": "images", "include_bbs": bounding_boxes, "color_dict": color_dict},
+        resume=resume)
+    timecodes_path = os.path.join(output_path, image_table, "images", f"{image_table}_timecodes.txt")
+    timecodes_size = manifest.chunks[-1]["timecodes_size"] if len(manifest.chunks) > 0 else 0
+    if not truncate_file(timecodes_path, timecodes_size):
+        print(f"{timecodes_path} is shorter than recorded, starting over")
+        manifest.reset()
+        truncate_file(timecodes_path, 0)
+
+    last_us = None
+    if manifest.cursor is not None:
+        print(f"Resuming {image_table} images after frame {manifest.cursor[1]}")
+        last_us = int(timestamps.epoch_us([manifest.cursor[0]])[0])
+
+    if worker_type == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    with executor:
+        # Loop over chunks of whole frames
+        for images_df in read_image_chunks(con, image_table, bounding_boxes, chunk_size, manifest.cursor, memory_limit):
+            time_list = []
+            image_paths = []
+            pending = deque()
+
+            # Write all images in chunk to file
+            print(f"Parsing image chunk {datetime.now()}")
+            components = parse_chunk_components(images_df, color_dict) if bounding_boxes else dict()
+            frame_datetimes = timestamps.to_datetimes(
+                images_df.drop_duplicates("image_count")["timestamp"])
+            frame_us = (frame_datetimes.asi8 // 10**3).tolist()
+            frame_titles = frame_datetimes.strftime("%Y-%m-%d_%H:%M:%S.%f")
+            id_group = images_df.groupby("image_count", sort=False)
+            for (_, grouping), current_us, current_timestamp_str in zip(id_group, frame_us, frame_titles):
+                # View image data, converted to BGR on the pool
+                image_row = grouping.iloc[0]
+                raw_image = raw_frame(con, image_table, image_row)
+                profiler.count("frames")
+                profiler.count("frames.raw_bytes", raw_image.nbytes)
+
+                # Create image file title
+                title = f"{image_row.image_count}_{current_timestamp_str}.png"
+                title = title.replace(":", "_")
+                path_to_image = os.path.join(output_path, image_table,
+                                             "images", title)
+
+                if last_us != None:
+                    time_diff_seconds = (current_us - last_us) / 10**6
+                    time_list.append(f"duration {time_diff_seconds}")
+
+                time_list.append(f"file {path_to_image}")
+                image_paths.append(path_to_image)
+                last_us = current_us
+
+                # Draw bounding boxes and write image to file on the pool
+                pending.append(executor.submit(
+                    annotate_and_write_image,
+                    raw_image,
+                    components.get(image_row.image_count),
+                    path_to_image,
+                    reuse_buffers))
+
+                # Bound the number of decoded frames waiting on the pool
+                while len(pending) > 2 * workers:
+                    add_image_times(pending.popleft().result())
+
+            # Timecodes are only written once the whole chunk is on disk
+            while len(pending) > 0:
+                add_image_times(pending.popleft().result())
+
+            print(f"Writing second table {datetime.now()}")
+            with profiler.stage("frames.timecodes"):
+                with open(timecodes_path, "a") as f:
+                    for line in time_list:
+                        f.write(f"{line}\n")
+
+            last_row = images_df.iloc[-1]
+            manifest.add_chunk(
+                (last_row.timestamp, last_row.image_count),
+                len(image_paths),
+                image_paths,
+                timecodes_size=os.path.getsize(timecodes_path))
+
+            # Cleanup for memory management, streamed chunks are small enough to be freed as they go
+            del images_df, time_list
+            if memory_limit == 0:
+                gc.collect()
+
+def annotate_and_write_image(raw_image, components, path_to_image, reuse_buffer=False):
+    """ :return: (decode, annotate, encode) seconds and the bytes written,
+        timed here since the worker may be another process
+    """
+    # Convert to cv2 object and draw bounding boxes on image
+    start = time.perf_counter()
+    out = frame_decoder.output_buffer(raw_image) if reuse_buffer else None
+    image_data = frame_decoder.to_bgr(raw_image, out)
+    decoded = time.perf_counter()
+    image_data = paint_components(image_data, components)
+    annotated = time.perf_counter()
+
+    # Write image to file
+    if not cv2.imwrite(path_to_image, image_data):
+        raise Exception(
+            f"Failed to write image at path: {path_to_image}")
+    return decoded - start, annotated - decoded, time.perf_counter() - annotated, os.path.getsize(path_to_image)
+
+def add_image_times(times):
+    decode_seconds, annotate_seconds, encode_seconds, image_bytes = times
+    profiler.add_time("frames.decode", decode_seconds)
+    profiler.add_time("frames.annotate", annotate_seconds)
+    profiler.add_time("frames.encode", encode_seconds)
+    profiler.count("frames.png_bytes", image_bytes)
+
+def generate_frame_store(database_path, output_path, trial_id, image_feed, chunk_size=3000, color_dict=None, resume=True, con=None, memory_limit=0):
+    """ write the annotated frames of a feed into one frame store,
+        {image_table}/frames/{image_table}.frames with its .index and .json
+        (see frame_store), instead of one PNG per frame. Frames are stored
+        raw, so nothing is compressed; export-frames.py writes PNG / JPEG
+        files from the store afterwards. With resume a rerun truncates the
+        store to the last finished chunk and appends after it.
+    """
+    # Get database connection, unless a shared one is given
+    if con is None:
+        con = sqlite3.connect(database_path)
 
     # Extract image table and whether bounding boxes should be drawn
     image_table, bounding_boxes = image_feed
 
-    # Get total image count
-    if bounding_boxes:
-        query = f"""SELECT COUNT(1)
-                FROM {image_table} LEFT OUTER JOIN {image_table}_bounding_boxes USING (image_count);"""
-    else:
-        query = f"SELECT COUNT(1) FROM {image_table};"
-    image_count = pd.read_sql_query(
-        query, con).iloc[0][0]
+    # Check for and create output path for this feed
+    frames_dir = os.path.join(output_path, image_table, "frames")
+    if not os.path.exists(frames_dir):
+        os.makedirs(frames_dir)
+
+    # Pick up after the chunks a previous run finished
+    manifest = Manifest(
+        os.path.join(frames_dir, f"{image_table}_manifest.jsonl"),
+        {"mode": "frames", "include_bbs": bounding_boxes, "color_dict": color_dict},
+        resume=resume)
+    store_path = os.path.join(frames_dir, f"{image_table}.frames")
+    sizes = (manifest.chunks[-1]["frames_size"], manifest.chunks[-1]["index_size"]) if len(manifest.chunks) > 0 else (0, 0)
+    try:
+        store = FrameStoreWriter(store_path, *sizes)
+    except (OSError, ValueError) as e:
+        print(f"Can't resume {store_path} ({e}), starting over")
+        manifest.reset()
+        store = FrameStoreWriter(store_path)
+    if manifest.cursor is not None:
+        print(f"Resuming {image_table} frames after frame {manifest.cursor[1]}")
+
+    try:
+        # Loop over chunks of whole frames
+        for images_df in read_image_chunks(con, image_table, bounding_boxes, chunk_size, manifest.cursor, memory_limit):
+            print(f"Parsing image chunk {datetime.now()}")
+            components = parse_chunk_components(images_df, color_dict) if bounding_boxes else dict()
+            id_group = images_df.groupby("image_count", sort=False)
+            frame_count = 0
+            for (_, grouping), current_us in zip(id_group, frame_times(images_df)):
+                # Decode into the reused buffer, the store copies it to disk right away
+                image_row = grouping.iloc[0]
+                with profiler.stage("frames.decode"):
+                    raw_image = raw_frame(con, image_table, image_row)
+                    image_data = frame_decoder.to_bgr(raw_image, frame_decoder.output_buffer(raw_image))
+                profiler.count("frames")
+                profiler.count("frames.raw_bytes", raw_image.nbytes)
+
+                with profiler.stage("frames.annotate"):
+                    image_data = paint_components(
+                        image_data, components.get(image_row.image_count))
+
+                with profiler.stage("frames.write"):
+                    store.append(image_row.image_count, current_us, image_data)
+                frame_count += 1
+
+            # The chunk is only recorded once its frames and index are on disk
+            with profiler.stage("frames.write"):
+                frames_size, index_size = store.flush()
+            profiler.count("frames.store_bytes", frame_count * store.stride)
+            last_row = images_df.iloc[-1]
+            manifest.add_chunk(
+                (last_row.timestamp, last_row.image_count),
+                frame_count,
+                [],
+                frames_size=frames_size,
+                index_size=index_size)
+
+            del images_df
+            if memory_limit == 0:
+                gc.collect()
+    finally:
+        store.close()
+
+def generate_videos(database_path, output_path, trial_id, image_feed, chunk_size=3000, rgb_fps=30, vlc_fps=5, color_dict=None, resume=True, con=None, memory_limit=0):
+    # Get database connection, unless a shared one is given
+    if con is None:
+        con = sqlite3.connect(database_path)
+
+    # Extract image table and whether bounding boxes should be drawn
+    image_table, bounding_boxes = image_feed
 
     # Check for and create output path
     if not os.path.exists(os.path.join(output_path, image_table, "videos")):
         os.makedirs(os.path.join(output_path, image_table, "videos"))
 
-    current_pointer = 0
-    milisecond_list = []
-    video_tuples = []
-    orig_dt_obj = None
-    loop_counter = 1
-    # Loop until full count is reached
-    while current_pointer < image_count:
-        if current_pointer+chunk_size > image_count:
-            chunk_size = image_count-current_pointer
-
-        # Query for bounding box entries, if desired
-        if bounding_boxes:
-            print(f"Running image and bounds query {datetime.now()}")
-            query = f"""SELECT {image_table}.*, {image_table}_bounding_boxes.component_id, {image_table}_bounding_boxes.bounds
-                FROM {image_table} LEFT OUTER JOIN {image_table}_bounding_boxes USING (image_count)
-                ORDER BY timestamp LIMIT {chunk_size} OFFSET {current_pointer};"""
-            images_df = pd.read_sql_query(
-                query,
-                con)
-        else:
-            print(f"Running image query {datetime.now()}")
-            query = f"SELECT * FROM {image_table} ORDER BY timestamp LIMIT {chunk_size} OFFSET {current_pointer};"
-            images_df = pd.read_sql_query(
-                query,
-                con)
+    # Keep the chunk videos a previous run finished
+    manifest = Manifest(
+        os.path.join(output_path, image_table, "videos", f"{image_table}_manifest.jsonl"),
+        {"mode": "video_chunks", "include_bbs": bounding_boxes, "color_dict": color_dict,
+         "rgb_fps": rgb_fps, "vlc_fps": vlc_fps},
+        resume=resume)
+    timecodes_path = os.path.join(output_path, image_table, f"{image_table}_timecodes.txt")
+    timecodes_size = manifest.chunks[-1]["timecodes_size"] if len(manifest.chunks) > 0 else 0
+    if not truncate_file(timecodes_path, timecodes_size):
+        print(f"{timecodes_path} is shorter than recorded, starting over")
+        manifest.reset()
+        truncate_file(timecodes_path, 0)
 
+    video_tuples = []
+    orig_us = None
+    for chunk in manifest.chunks:
+        video_path = os.path.join(output_path, image_table, "videos", chunk["video"])
+        video_tuples.append((video_path, chunk["fps"], tuple(chunk["resolution"])))
+        orig_us = int(timestamps.epoch_us([chunk["origin"]])[0])
+    if len(video_tuples) > 0:
+        print(f"Resuming {image_table} video after chunk {len(video_tuples)}")
+    loop_counter = len(video_tuples) + 1
+
+    # Loop over chunks of whole frames
+    for images_df in read_image_chunks(con, image_table, bounding_boxes, chunk_size, manifest.cursor, memory_limit):
         # Add all image data to a list
         print(f"Parsing image df {datetime.now()}")
         images = []
+        milisecond_list = []
         fps = 30
-        id_group = images_df.groupby(["image_count"])
-        for _, grouping in id_group:
+        components = parse_chunk_components(images_df, color_dict) if bounding_boxes else dict()
+        id_group = images_df.groupby("image_count", sort=False)
+        for (_, grouping), current_us in zip(id_group, frame_times(images_df)):
             # Extract frame data and convert to cv2 object
             image_row = grouping.iloc[0]
-
-            dt = np.dtype(np.uint8)
-            dt = dt.newbyteorder(">" if bool(image_row.is_bigendian) else "<")
-            num_channels = 4 if image_row.encoding == "bgra8" else 1
-            image_data = np.frombuffer(image_row.data, dtype=dt)
-            if num_channels == 4:
-                fps = rgb_fps
-                image_data = np.reshape(
-                    image_data, (int(image_row.height), int(image_row.width), num_channels))
-                image_data = image_data[:, :, 0:3]
-                image_data = np.reshape(
-                    image_data, (int(image_row.height), int(image_row.width), 3))
-            else:
-                fps = vlc_fps
-                image_data = np.reshape(
-                    image_data, (int(image_row.width), int(image_row.height)))
-                image_data = np.stack((image_data,)*3, axis=-1)
+            fps = rgb_fps if image_row.encoding == "bgra8" else vlc_fps
+            with profiler.stage("frames.decode"):
+                raw_image = raw_frame(con, image_table, image_row)
+                image_data = frame_decoder.to_bgr(raw_image)
+            profiler.count("frames")
+            profiler.count("frames.raw_bytes", raw_image.nbytes)
 
             # Draw bounding boxes on frame
-            if bounding_boxes:
-                for _, row in grouping.iterrows():
-                    if row.bounds != None:
-                        bounds = np.frombuffer(row.bounds, dtype=np.int64)
-                        bounds = bounds.reshape(((int)(len(bounds)/2), 2))
-                        color = (255, 0, 0)
-                        if color_dict is not None:
-                            color = color_dict[row.component_id]
-
-                        image_data = draw_component(
-                            image_data,
-                            bounds,
-                            color=color)
-
-            current_timestamp = datetime.strptime(
-                image_row.timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            if orig_dt_obj is None:
-                orig_dt_obj = current_timestamp
-
-            time_diff_seconds = (current_timestamp -
-                                 orig_dt_obj).total_seconds()
+            with profiler.stage("frames.annotate"):
+                image_data = paint_components(
+                    image_data, components.get(image_row.image_count))
+
+            if orig_us is None:
+                orig_us = current_us
+
+            time_diff_seconds = (current_us - orig_us) / 10**6
             time_diff_miliseconds = time_diff_seconds * 1000
             milisecond_list.append(time_diff_miliseconds)
 
@@ -319,47 +533,399 @@ def generate_videos(database_path, output_path, trial_id, image_feed, chunk_size
             resolution,
             isColor=True)
 
-        for image in images:
-            video_writer.write(image)
-        video_writer.release()
+        with profiler.stage("frames.encode"):
+            for image in images:
+                video_writer.write(image)
+            video_writer.release()
+
+        print(f"Writing milisecond table {datetime.now()}")
+        with profiler.stage("frames.timecodes"):
+            with open(timecodes_path, "a") as f:
+                for line in milisecond_list:
+                    f.write(f"{line}\n")
+
+        last_row = images_df.iloc[-1]
+        manifest.add_chunk(
+            (last_row.timestamp, last_row.image_count),
+            len(images),
+            [video_path],
+            timecodes_size=os.path.getsize(timecodes_path),
+            video=os.path.basename(video_path),
+            fps=fps,
+            resolution=resolution,
+            origin=timestamps.format_us(orig_us))
 
         video_tuples.append((video_path, fps, resolution))
-        current_pointer += chunk_size
         loop_counter += 1
 
         del images_df, images, video_writer
-        gc.collect()
+        if memory_limit == 0:
+            gc.collect()
+
+    return video_tuples
+
+def stream_video(database_path, output_path, trial_id, image_feed, chunk_size=3000, rgb_fps=30, vlc_fps=5, color_dict=None, queue_size=8, resume=True, con=None, memory_limit=0):
+    """ decode frames and encode them straight into {image_table}.mp4 with a
+        single VideoWriter running on its own thread. Decoded frames are
+        handed over through a queue of queue_size frames, so at most that
+        many are held in memory, and no per-chunk videos are written.
+        An MP4 can't be appended to, so with resume a finished video is
+        skipped when no frames were added since, and re-encoded otherwise.
+    """
+    # Get database connection, unless a shared one is given
+    if con is None:
+        con = sqlite3.connect(database_path)
+
+    # Extract image table and whether bounding boxes should be drawn
+    image_table, bounding_boxes = image_feed
+
+    # Check for and create output path
+    if not os.path.exists(os.path.join(output_path, image_table)):
+        os.makedirs(os.path.join(output_path, image_table))
+    video_path = os.path.join(output_path, image_table, f"{image_table}.mp4")
+    partial_video_path = os.path.join(output_path, image_table, f"{image_table}.partial.mp4")
+
+    manifest = Manifest(
+        os.path.join(output_path, image_table, f"{image_table}_manifest.jsonl"),
+        {"mode": "video_stream", "include_bbs": bounding_boxes, "color_dict": color_dict,
+         "rgb_fps": rgb_fps, "vlc_fps": vlc_fps},
+        resume=resume)
+    if manifest.complete is not None and os.path.exists(video_path) \
+            and not has_frames_after(con, image_table, manifest.cursor):
+        print(f"{video_path} is up to date")
+        return
+    manifest.reset()
+
+    last_row = None
+    frame_queue = queue.Queue(maxsize=queue_size)
+    writer_errors = []
+    writer_thread = None
+    milisecond_list = []
+    orig_us = None
+    try:
+        for images_df in read_image_chunks(con, image_table, bounding_boxes, chunk_size, memory_limit=memory_limit):
+            print(f"Parsing image df {datetime.now()}")
+            components = parse_chunk_components(images_df, color_dict) if bounding_boxes else dict()
+            id_group = images_df.groupby("image_count", sort=False)
+            for (_, grouping), current_us in zip(id_group, frame_times(images_df)):
+                # Extract frame data and convert to cv2 object
+                image_row = grouping.iloc[0]
+                with profiler.stage("frames.decode"):
+                    raw_image = raw_frame(con, image_table, image_row)
+                    image_data = frame_decoder.to_bgr(raw_image)
+                profiler.count("frames")
+                profiler.count("frames.raw_bytes", raw_image.nbytes)
+
+                # Draw bounding boxes on frame
+                with profiler.stage("frames.annotate"):
+                    image_data = paint_components(
+                        image_data, components.get(image_row.image_count))
+
+                # Open the writer once the first frame gives fps and resolution
+                if writer_thread is None:
+                    fps = rgb_fps if image_row.encoding == "bgra8" else vlc_fps
+                    height, width, channels = image_data.shape
+                    print(f"Writing video {video_path} {datetime.now()}")
+                    writer_thread = threading.Thread(
+                        target=write_video_frames,
+                        args=(frame_queue, partial_video_path, fps, (int(width), int(height)), writer_errors),
+                        daemon=True)
+                    writer_thread.start()
+
+                # Stop decoding as soon as the writer failed
+                with profiler.stage("frames.queue_wait"):
+                    put_frame(frame_queue, image_data, writer_thread, writer_errors)
+
+                if orig_us is None:
+                    orig_us = current_us
+
+                time_diff_seconds = (current_us - orig_us) / 10**6
+                milisecond_list.append(time_diff_seconds * 1000)
+
+            last_row = images_df.iloc[-1]
+            del images_df
+    finally:
+        # Flush the queue and close the video even if decoding failed
+        if writer_thread is not None:
+            # A failed writer still drains the queue up to the sentinel
+            while writer_thread.is_alive():
+                try:
+                    frame_queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            writer_thread.join()
+
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
 
     print(f"Writing milisecond table {datetime.now()}")
-    with open(os.path.join(output_path, image_table, f"{image_table}_timecodes.txt"), "w") as f:
-        for line in milisecond_list:
-            f.write(f"{line}\n")
+    with profiler.stage("frames.timecodes"):
+        with open(os.path.join(output_path, image_table, f"{image_table}_timecodes.txt"), "w") as f:
+            for line in milisecond_list:
+                f.write(f"{line}\n")
 
-    return video_tuples
+    # Only a fully written video replaces the previous one
+    if last_row is not None:
+        os.replace(partial_video_path, video_path)
+        manifest.mark_complete(
+            (last_row.timestamp, last_row.image_count),
+            origin=timestamps.format_us(orig_us))
+
+def frame_times(images_df):
+    # epoch microseconds of each frame of a chunk, in the order groupby("image_count", sort=False) visits them
+    return timestamps.epoch_us(images_df.drop_duplicates("image_count")["timestamp"]).tolist()
+
+def put_frame(frame_queue, frame, writer_thread, errors):
+    """ hand a frame (or the None sentinel) to the writer thread
+    :raises: the writer's error once it failed, instead of queueing more
+        frames it won't encode or blocking on a queue nobody drains
+    """
+    while True:
+        if len(errors) > 0:
+            raise errors[0]
+        if not writer_thread.is_alive():
+            raise RuntimeError("Video writer thread stopped before the last frame")
+        try:
+            frame_queue.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+def write_video_frames(frame_queue, video_path, fps, resolution, errors):
+    # Consume frames until the None sentinel, then release the writer.
+    # Every failure is recorded in errors for the producer to raise
+    video_writer = None
+    try:
+        video_writer = cv2.VideoWriter(
+            video_path,
+            cv2.VideoWriter_fourcc(*"mp4v"),
+            fps,
+            resolution,
+            isColor=True)
+        if not video_writer.isOpened():
+            raise Exception(f"Failed to open video writer at path: {video_path}")
+    except Exception as e:
+        errors.append(e)
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            break
+        # Keep draining after a failure so the producer never blocks
+        if len(errors) > 0:
+            continue
+        try:
+            with profiler.stage("frames.encode"):
+                video_writer.write(frame)
+        except Exception as e:
+            errors.append(e)
+    try:
+        if video_writer is not None:
+            video_writer.release()
+    except Exception as e:
+        errors.append(e)
+
+def ensure_timestamp_index(con, image_table, bounding_boxes):
+    """ index the cursor key (and the join key) so each chunk is a range scan
+    :return: False if the index is missing and can't be created, e.g. on a
+        read-only connection
+    """
+    indexes = [(image_table, f"{image_table}_timestamp_idx", "timestamp, image_count")]
+    if bounding_boxes:
+        indexes.append((f"{image_table}_bounding_boxes",
+                        f"{image_table}_bounding_boxes_image_count_idx", "image_count"))
 
-def draw_component(
-        image,
-        bounds,
-        color=(0, 0, 0)):
+    try:
+        for table, index, columns in indexes:
+            exists = con.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?;",
+                (index,)).fetchone()
+            if exists is None:
+                con.execute(f"CREATE INDEX {index} ON {table} ({columns});")
+        con.commit()
+    except sqlite3.OperationalError as e:
+        # Read-only databases are still readable, just without the index
+        print(f"Could not create index on {image_table}: {e}")
+        return False
+    return True
+
+def has_frames_after(con, image_table, cursor):
+    # Whether frames were added after the (timestamp, image_count) cursor
+    if cursor is None:
+        query = f"SELECT 1 FROM {image_table} WHERE timestamp IS NOT NULL LIMIT 1;"
+        params = ()
+    else:
+        query = f"SELECT 1 FROM {image_table} WHERE (timestamp, image_count) > (?, ?) LIMIT 1;"
+        params = (cursor[0], int(cursor[1]))
+    return con.execute(query, params).fetchone() is not None
+
+def image_chunk_query(image_table, bounding_boxes, cursor, limit=None, columns="*"):
+    # Frames after cursor in (timestamp, image_count) order, joined with their boxes
+    if cursor is None:
+        frames_query = f"SELECT {columns} FROM {image_table} WHERE timestamp IS NOT NULL"
+        params = ()
+    else:
+        frames_query = f"SELECT {columns} FROM {image_table} WHERE (timestamp, image_count) > (?, ?)"
+        params = (cursor[0], int(cursor[1]))
+    frames_query += " ORDER BY timestamp, image_count"
+    if limit is not None:
+        frames_query += " LIMIT ?"
+        params += (limit,)
+
+    # Query for bounding box entries, if desired
+    if bounding_boxes:
+        query = f"""SELECT {image_table}.*, {image_table}_bounding_boxes.component_id, {image_table}_bounding_boxes.bounds
+            FROM ({frames_query}) AS {image_table} LEFT OUTER JOIN {image_table}_bounding_boxes USING (image_count)
+            ORDER BY {image_table}.timestamp, image_count, {image_table}_bounding_boxes.rowid;"""
+    else:
+        query = frames_query + ";"
+    return query, params
+
+def read_image_chunks(con, image_table, bounding_boxes, chunk_size, cursor=None, memory_limit=0):
+    """ yield DataFrames holding at most chunk_size frames each, ordered by
+        (timestamp, image_count). Paging is keyset based, and the LIMIT is
+        applied to frames before the bounding box join, so the rows of one
+        image_count are never split across two chunks.
+    :param cursor: (timestamp, image_count) of the last frame already read,
+        reading starts after it. None starts from the first frame
+    :param memory_limit: bytes of RSS the job may use, 0 reads whole chunks
+        with their frames. Otherwise see stream_image_chunks
+    """
+    if memory_limit > 0:
+        yield from stream_image_chunks(con, image_table, bounding_boxes, chunk_size, memory_limit, cursor)
+        return
 
-    new_bounding_image = np.array(image)
-    y, x = np.split(bounds, [-1], axis=1)
-    new_bounding_image[y, x] = color
+    if not ensure_timestamp_index(con, image_table, bounding_boxes):
+        yield from read_image_chunks_single_pass(con, image_table, bounding_boxes, chunk_size, cursor)
+        return
 
-    return new_bounding_image
+    while True:
+        print(f"Running image query {datetime.now()}")
+        query, params = image_chunk_query(image_table, bounding_boxes, cursor, chunk_size)
+        with profiler.stage("frames.fetch"):
+            images_df = pd.read_sql_query(query, con, params=params)
+        profiler.count("frames.rows", len(images_df))
+
+        if len(images_df) == 0:
+            return
+
+        last_row = images_df.iloc[-1]
+        cursor = (last_row.timestamp, int(last_row.image_count))
+        num_frames = images_df["image_count"].nunique()
+        yield images_df
+
+        if num_frames < chunk_size:
+            return
+
+def read_image_chunks_single_pass(con, image_table, bounding_boxes, chunk_size, cursor=None):
+    """ same chunks as read_image_chunks for databases without the index:
+        the rows are sorted once by a single query and cut into chunks of
+        about chunk_size rows, holding back the last frame of each fetch
+        until the next one shows whether it has more boxes. The sort leaves
+        out the data column, each frame's blob is read by rowid when it is
+        decoded (see raw_frame).
+    """
+    print(f"Running single pass image query {datetime.now()}")
+    query, params = image_chunk_query(
+        image_table, bounding_boxes, cursor, columns=frame_columns(con, image_table))
+    pending = None
+    for images_df in profiler.timed(pd.read_sql_query(query, con, params=params, chunksize=chunk_size), "frames.fetch", "frames.rows"):
+        if pending is not None:
+            images_df = pd.concat([pending, images_df], ignore_index=True)
+        last_count = images_df["image_count"].iat[-1]
+        pending = images_df[images_df["image_count"] == last_count]
+        images_df = images_df[images_df["image_count"] != last_count]
+        if len(images_df) > 0:
+            yield images_df
+    if pending is not None:
+        yield pending
+
+def stream_image_chunks(con, image_table, bounding_boxes, chunk_size, memory_limit, cursor=None):
+    """ memory-budget version of read_image_chunks. The rows are streamed
+        from a single cursor with fetchmany and without their data column;
+        each frame's blob is only read when it is decoded (see raw_frame).
+        Every fetch is sized to the frames that fit in what is left of
+        memory_limit bytes of RSS (at most chunk_size, at least one), so
+        chunks shrink when memory runs short instead of a fixed row count.
+    """
+    size = con.execute(f"SELECT width, height FROM {image_table} WHERE timestamp IS NOT NULL LIMIT 1;").fetchone()
+    # A frame is held raw and converted to BGR at once
+    frame_bytes = max(1, int(size[0]) * int(size[1]) * 7) if size is not None else 1
+
+    print(f"Running streamed image query {datetime.now()}")
+    query, params = image_chunk_query(
+        image_table, bounding_boxes, cursor, columns=frame_columns(con, image_table))
+    rows_cursor = con.execute(query, params)
+    names = [description[0] for description in rows_cursor.description]
+    count_index = names.index("image_count")
+
+    pending = []
+    # Index in pending of the first row of each frame
+    starts = []
+    exhausted = False
+    while True:
+        available = memory_limit - profiler.current_rss()
+        num_frames = int(max(1, min(chunk_size, available // frame_bytes)))
+
+        # Fetch until pending holds num_frames whole frames, its last frame
+        # is held back as its boxes may continue in the next fetch
+        while not exhausted and len(starts) <= num_frames:
+            with profiler.stage("frames.fetch"):
+                rows = rows_cursor.fetchmany(num_frames)
+            profiler.count("frames.rows", len(rows))
+            exhausted = len(rows) == 0
+            for row in rows:
+                if len(pending) == 0 or row[count_index] != pending[-1][count_index]:
+                    starts.append(len(pending))
+                pending.append(row)
+
+        if len(pending) == 0:
+            return
+        end = starts[num_frames] if len(starts) > num_frames else len(pending)
+        yield pd.DataFrame.from_records(pending[:end], columns=names)
+        pending = pending[end:]
+        starts = [start - end for start in starts[num_frames:]]
+
+def frame_columns(con, image_table):
+    # Every column but the frame blob, plus the rowid raw_frame reads it by
+    columns = [row[1] for row in con.execute(f"PRAGMA table_info({image_table});") if row[1] != "data"]
+    return ", ".join(["rowid AS frame_rowid"] + columns)
+
+def raw_frame(con, image_table, image_row):
+    """ zero-copy view of a frame. Streamed and single pass chunks have no
+        data column, so their frame is read from its blob on its own, by rowid
+    """
+    if "frame_rowid" not in image_row.index:
+        return frame_decoder.raw_row(image_row)
+    rowid = int(image_row.frame_rowid)
+    if hasattr(con, "blobopen"):
+        with con.blobopen(image_table, "data", rowid, readonly=True) as blob:
+            data = blob.read()
+    else:
+        data = con.execute(f"SELECT data FROM {image_table} WHERE rowid = ?;", (rowid,)).fetchone()[0]
+    return frame_decoder.raw(data, image_row.encoding, image_row.width, image_row.height, image_row.is_bigendian)
 
 def combine_videos(video_tuples, output_path, image_feed):
     image_table, _ = image_feed
 
     final_video_path = os.path.join(
         output_path, image_table, f"{image_table}.mp4")
+    partial_video_path = os.path.join(
+        output_path, image_table, f"{image_table}.partial.mp4")
+
+    # Nothing to do if no chunk video changed since the last combine
+    if os.path.exists(final_video_path):
+        final_mtime = os.path.getmtime(final_video_path)
+        if all(os.path.getmtime(video_path) <= final_mtime for video_path, _, _ in video_tuples):
+            print(f"{final_video_path} is up to date")
+            return
 
     fps = video_tuples[0][1]
     resolution = video_tuples[0][2]
 
     # Create a new video
     video = cv2.VideoWriter(
-        final_video_path,
+        partial_video_path,
         cv2.VideoWriter_fourcc(*"mp4v"),
         fps,
         resolution,
@@ -377,7 +943,9 @@ def combine_videos(video_tuples, output_path, image_feed):
             video.write(frame)          # Write the frame
 
     video.release()
+    os.replace(partial_video_path, final_video_path)
 
 # Main entry
 if __name__ == "__main__":
-    main()
+    if main():
+        sys.exit(1)
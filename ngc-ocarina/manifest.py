@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+
+class Manifest:
+    """ append-only record of the chunks an extraction has finished.
+
+        The manifest is a JSON lines file: a header with the config
+        fingerprint, then one line per completed chunk holding the cursor
+        of its last frame, the files it wrote (with their sizes) and any
+        extra state needed to resume. A chunk line is only appended once
+        all of its files are on disk, so a crash loses at most the chunk
+        in progress.
+    """
+
+    def __init__(self, path, config, resume=True):
+        self.path = path
+        self.base_dir = os.path.dirname(path)
+        self.fingerprint = config_fingerprint(config)
+        self.chunks = []
+        self.complete = None
+
+        if resume:
+            self._load()
+        if len(self.chunks) == 0 and self.complete is None:
+            self.reset()
+
+    @property
+    def cursor(self):
+        # (timestamp, image_count) of the last finished frame, None when fresh
+        if self.complete is not None:
+            return tuple(self.complete["last"]) if self.complete["last"] else None
+        if len(self.chunks) > 0:
+            return tuple(self.chunks[-1]["last"])
+        return None
+
+    def add_chunk(self, last, frames, files, **state):
+        """ record a finished chunk
+        :param last: (timestamp, image_count) of the chunk's last frame
+        :param files: paths written by the chunk, stored relative to the manifest
+        """
+        chunk = {
+            "last": [last[0], int(last[1])],
+            "frames": int(frames),
+            "files": {os.path.relpath(f, self.base_dir): os.path.getsize(f) for f in files},
+        }
+        chunk.update(state)
+        self._append(chunk)
+        self.chunks.append(chunk)
+        self.complete = None
+
+    def mark_complete(self, last, **state):
+        record = {"complete": True, "last": [last[0], int(last[1])] if last else None}
+        record.update(state)
+        self._append(record)
+        self.complete = record
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            return
+        if header.get("fingerprint") != self.fingerprint:
+            print(f"Config changed since {self.path} was written, starting over")
+            return
+
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line, drop it before appending again
+                self._rewrite()
+                break
+            if record.get("complete"):
+                self.complete = record
+            else:
+                self.chunks.append(record)
+                self.complete = None
+
+        # Keep chunks up to the first one whose files are missing or changed
+        for i, chunk in enumerate(self.chunks):
+            if not self._files_intact(chunk):
+                print(f"Chunk {i + 1} of {self.path} is incomplete, resuming before it")
+                self.chunks = self.chunks[:i]
+                self.complete = None
+                self._rewrite()
+                break
+
+    def _files_intact(self, chunk):
+        for name, size in chunk["files"].items():
+            path = os.path.join(self.base_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                return False
+        return True
+
+    def reset(self):
+        # Forget all finished work
+        self.chunks = []
+        self.complete = None
+        self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+            for chunk in self.chunks:
+                f.write(json.dumps(chunk) + "\n")
+            if self.complete is not None:
+                f.write(json.dumps(self.complete) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def config_fingerprint(config):
+    # Stable hash of the parameters that shape an extraction's output
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def truncate_file(path, size):
+    """ drop whatever an interrupted run appended to path after the last
+        finished chunk
+    :return: False if path is shorter than size, i.e. it can't be resumed
+    """
+    if not os.path.exists(path):
+        open(path, "w").close()
+    if os.path.getsize(path) < size:
+        return False
+    with open(path, "r+") as f:
+        f.truncate(size)
+    return True
@@ -0,0 +1,354 @@
+""" Triangle meshes (OBJ / PLY) and a bounding volume hierarchy to cast
+    batches of rays against them.
+
+    The BVH is a complete binary tree stored level by level: every level
+    splits each node's triangles at the median centroid along the node's
+    longest axis (one batched argsort per level), down to leaves of
+    leaf_size triangles, so building it is a few vectorized NumPy passes.
+    Rays are intersected a batch at a time. Each ray first follows its
+    nearest child box down to one leaf, whose hit bounds the search; the
+    batch then walks down the tree level by level keeping the (ray, node)
+    pairs whose boxes it enters before that bound, and the candidate
+    leaves of every ray are tested nearest first, a ray dropping out once
+    its closest hit is nearer than its next leaf.
+"""
+
+import os
+
+import numpy as np
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+class Mesh:
+    """ triangles of a model, with the name of the group (OBJ object or
+        group, PLY face property value) each triangle belongs to
+    """
+
+    def __init__(self, vertices, faces, face_groups, groups):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        # index into groups of each face
+        self.face_groups = np.asarray(face_groups, dtype=np.int64)
+        self.groups = list(groups)
+
+    def transformed(self, matrix):
+        # the mesh with a 4x4 (row-major, column vector) transform applied to its vertices
+        matrix = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+        vertices = self.vertices @ matrix[:3, :3].T + matrix[:3, 3]
+        return Mesh(vertices, self.faces, self.face_groups, self.groups)
+
+def load_mesh(path, group_property='component'):
+    """ read an OBJ or PLY (ascii or binary) file, polygons fanned into triangles
+    :param group_property: PLY face property whose value names the group of a face
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.obj':
+        return load_obj(path)
+    if extension == '.ply':
+        return load_ply(path, group_property)
+    raise ValueError(f"{path}: only .obj and .ply models are supported, convert other formats first")
+
+def load_obj(path):
+    vertices = []
+    faces = []
+    face_groups = []
+    groups = {'': 0}
+    group = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('v '):
+                vertices.append(line.split()[1:4])
+            elif line.startswith('f '):
+                # "v", "v/vt", "v//vn" or "v/vt/vn", 1-based or negative (relative) indices
+                polygon = [int(corner.split('/')[0]) for corner in line.split()[1:]]
+                polygon = [index - 1 if index > 0 else len(vertices) + index for index in polygon]
+                for i in range(1, len(polygon) - 1):
+                    faces.append((polygon[0], polygon[i], polygon[i + 1]))
+                    face_groups.append(group)
+            elif line.startswith(('o ', 'g ')):
+                name = line[2:].strip()
+                group = groups.setdefault(name, len(groups))
+    return Mesh(np.array(vertices, dtype=np.float64).reshape(-1, 3), faces, face_groups, list(groups))
+
+def load_ply(path, group_property='component'):
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f"{path} is not a PLY file")
+        file_format = None
+        elements = []
+        while True:
+            line = f.readline()
+            if len(line) == 0:
+                raise ValueError(f"{path}: PLY header has no end_header")
+            words = line.decode('ascii').split()
+            if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                file_format = words[1]
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    elements[-1][2].append((words[4], PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+                else:
+                    elements[-1][2].append((words[2], PLY_TYPES[words[1]], None))
+
+        if file_format == 'ascii':
+            data = read_ply_ascii(f, elements)
+        else:
+            data = read_ply_binary(f, elements, '<' if file_format == 'binary_little_endian' else '>')
+
+    vertex = data['vertex']
+    vertices = np.stack([vertex['x'], vertex['y'], vertex['z']], axis=1).astype(np.float64)
+    face = data['face']
+    polygons = face.get('vertex_indices', face.get('vertex_index'))
+    if group_property in face:
+        names, face_groups = np.unique(face[group_property].astype(str), return_inverse=True)
+        groups = list(names)
+    else:
+        face_groups = np.zeros(len(polygons), dtype=np.int64)
+        groups = ['']
+    faces, fan_groups = fan_triangles(polygons, face_groups)
+    return Mesh(vertices, faces, fan_groups, groups)
+
+def fan_triangles(polygons, face_groups):
+    # polygons is a (faces, corners) array when every face has as many corners, a list otherwise
+    if isinstance(polygons, np.ndarray):
+        corners = polygons.shape[1]
+        triangles = [np.stack([polygons[:, 0], polygons[:, i], polygons[:, i + 1]], axis=1) for i in range(1, corners - 1)]
+        faces = np.stack(triangles, axis=1).reshape(-1, 3)
+        return faces, np.repeat(face_groups, corners - 2)
+    faces = []
+    groups = []
+    for polygon, group in zip(polygons, face_groups):
+        for i in range(1, len(polygon) - 1):
+            faces.append((polygon[0], polygon[i], polygon[i + 1]))
+            groups.append(group)
+    return np.array(faces, dtype=np.int64).reshape(-1, 3), np.array(groups, dtype=np.int64)
+
+def read_ply_ascii(f, elements):
+    data = dict()
+    for name, count, properties in elements:
+        rows = [f.readline().split() for _ in range(count)]
+        columns = {property_name: [] for property_name, _, _ in properties}
+        for row in rows:
+            position = 0
+            for property_name, value_type, index_type in properties:
+                if index_type is None:
+                    columns[property_name].append(row[position])
+                    position += 1
+                else:
+                    length = int(row[position])
+                    columns[property_name].append([int(value) for value in row[position + 1:position + 1 + length]])
+                    position += 1 + length
+        data[name] = {
+            property_name: (np.array(columns[property_name], dtype=value_type) if index_type is None
+                            else list_column(columns[property_name]))
+            for property_name, value_type, index_type in properties}
+    return data
+
+def read_ply_binary(f, elements, byte_order):
+    data = dict()
+    for name, count, properties in elements:
+        lists = [(property_name, value_type, index_type) for property_name, value_type, index_type in properties if index_type is not None]
+        if len(lists) == 0:
+            dtype = np.dtype([(property_name, byte_order + value_type) for property_name, value_type, _ in properties])
+            values = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype, count=count)
+            data[name] = {property_name: values[property_name] for property_name, _, _ in properties}
+            continue
+
+        # Faces with a fixed corner count (the usual triangles or quads) are one structured read
+        start = f.tell()
+        first_length = np.frombuffer(f.read(np.dtype(lists[0][2]).itemsize), dtype=byte_order + lists[0][2])[0] if count > 0 else 0
+        f.seek(start)
+        fields = []
+        for property_name, value_type, index_type in properties:
+            if index_type is None:
+                fields.append((property_name, byte_order + value_type))
+            else:
+                fields.append((property_name + '_length', byte_order + index_type))
+                fields.append((property_name, byte_order + value_type, (int(first_length),)))
+        dtype = np.dtype(fields)
+        if len(lists) == 1:
+            values = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype, count=count)
+            if np.all(values[lists[0][0] + '_length'] == first_length):
+                data[name] = {property_name: values[property_name] for property_name, _, _ in properties}
+                continue
+            f.seek(start)
+
+        # Variable length lists are read one element at a time
+        columns = {property_name: [] for property_name, _, _ in properties}
+        for _ in range(count):
+            for property_name, value_type, index_type in properties:
+                if index_type is None:
+                    size = np.dtype(value_type).itemsize
+                    columns[property_name].append(np.frombuffer(f.read(size), dtype=byte_order + value_type)[0])
+                else:
+                    length = int(np.frombuffer(f.read(np.dtype(index_type).itemsize), dtype=byte_order + index_type)[0])
+                    size = np.dtype(value_type).itemsize * length
+                    columns[property_name].append(np.frombuffer(f.read(size), dtype=byte_order + value_type).tolist())
+        data[name] = {
+            property_name: (np.array(columns[property_name]) if index_type is None else list_column(columns[property_name]))
+            for property_name, _, index_type in properties}
+    return data
+
+def list_column(lists):
+    # a 2D array when all lists have the same length, the lists otherwise
+    if len(lists) > 0 and all(len(values) == len(lists[0]) for values in lists):
+        return np.array(lists, dtype=np.int64)
+    return lists
+
+class BVH:
+
+    def __init__(self, mesh, leaf_size=8):
+        self.mesh = mesh
+        self.leaf_size = leaf_size
+        triangles = mesh.vertices[mesh.faces]
+
+        num_faces = len(triangles)
+        num_leaves = max(1, -(-num_faces // leaf_size))
+        self.depth = int(np.ceil(np.log2(num_leaves))) if num_leaves > 1 else 0
+        padded = 2**self.depth * leaf_size
+
+        # Median splits of all the nodes of a level at once, padding slots
+        # have infinite centroids so they sort to the end of their node
+        centroids = np.full((padded, 3), np.inf)
+        centroids[:num_faces] = triangles.mean(axis=1)
+        order = np.arange(padded)
+        for level in range(self.depth):
+            points = centroids[order].reshape(2**level, -1, 3)
+            finite = np.isfinite(points[..., :1])
+            extent = np.where(finite, points, -np.inf).max(axis=1) - np.where(finite, points, np.inf).min(axis=1)
+            axis = np.argmax(np.nan_to_num(extent, neginf=0.0), axis=1)
+            keys = np.take_along_axis(points, axis[:, None, None], axis=2)[..., 0]
+            within = np.argsort(keys, axis=1, kind='stable')
+            order = np.take_along_axis(order.reshape(2**level, -1), within, axis=1).reshape(-1)
+
+        # faces of leaf i are slots i * leaf_size ... (i + 1) * leaf_size, -1 for padding
+        self.slot_faces = np.where(order < num_faces, order, -1)
+        valid = self.slot_faces >= 0
+        sorted_triangles = np.zeros((padded, 3, 3))
+        sorted_triangles[valid] = triangles[self.slot_faces[valid]]
+        # Moller-Trumbore terms, padding triangles are degenerate and never hit
+        self.v0 = sorted_triangles[:, 0]
+        self.edge1 = sorted_triangles[:, 1] - sorted_triangles[:, 0]
+        self.edge2 = sorted_triangles[:, 2] - sorted_triangles[:, 0]
+
+        # Leaf boxes, then each level up is the union of its two children
+        lo = np.where(valid[:, None, None], sorted_triangles, np.inf).min(axis=1)
+        hi = np.where(valid[:, None, None], sorted_triangles, -np.inf).max(axis=1)
+        lo = lo.reshape(-1, leaf_size, 3).min(axis=1)
+        hi = hi.reshape(-1, leaf_size, 3).max(axis=1)
+        self.levels = [(lo, hi)]
+        while len(lo) > 1:
+            lo = lo.reshape(-1, 2, 3).min(axis=1)
+            hi = hi.reshape(-1, 2, 3).max(axis=1)
+            self.levels.insert(0, (lo, hi))
+
+    def intersect(self, origins, directions, max_distance=np.inf):
+        """ nearest hit of every ray
+        :param origins, directions: (rays, 3), directions need not be normalized
+        :return: (distance along the ray in direction units, inf when missed;
+            face index, -1 when missed; hit points, NaN when missed)
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        num_rays = len(origins)
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / directions
+
+        best = np.full(num_rays, np.inf)
+        best_slot = np.full(num_rays, -1, dtype=np.int64)
+        self.nearest_leaf_hits(origins, directions, inverse, best, best_slot)
+
+        # Walk down the levels, keeping the (ray, node) pairs whose box the ray enters before its bound
+        rays = np.arange(num_rays)
+        nodes = np.zeros(num_rays, dtype=np.int64)
+        for level, (lo, hi) in enumerate(self.levels):
+            near, far = slab(origins[rays], inverse[rays], lo[nodes], hi[nodes])
+            keep = (near <= far) & (far >= 0) & (near <= max_distance) & (near < best[rays])
+            rays, nodes, near = rays[keep], nodes[keep], near[keep]
+            if level < len(self.levels) - 1:
+                rays = np.repeat(rays, 2)
+                nodes = (2 * np.repeat(nodes, 2) + np.tile([0, 1], len(nodes)))
+
+        # Test the candidate leaves of each ray nearest first: round k tests
+        # the k-th nearest leaf of every ray whose hit so far is further away
+        order = np.lexsort((near, rays))
+        rays, leaves, near = rays[order], nodes[order], np.maximum(near[order], 0)
+        rank = np.arange(len(rays)) - np.searchsorted(rays, rays, side='left')
+        by_rank = np.argsort(rank, kind='stable')
+        round_starts = np.searchsorted(rank[by_rank], np.arange(int(rank.max()) + 2 if len(rank) > 0 else 1))
+
+        for round_start, round_end in zip(round_starts[:-1], round_starts[1:]):
+            candidates = by_rank[round_start:round_end]
+            candidates = candidates[near[candidates] < np.minimum(best[rays[candidates]], max_distance)]
+            if len(candidates) == 0:
+                break
+            self.test_leaves(origins, directions, rays[candidates], leaves[candidates], best, best_slot)
+
+        best[best > max_distance] = np.inf
+        hit = np.isfinite(best)
+        faces = np.where(hit, self.slot_faces[np.maximum(best_slot, 0)], -1)
+        points = np.where(hit[:, None], origins + directions * np.where(hit, best, 0)[:, None], np.nan)
+        return best, faces, points
+
+    def nearest_leaf_hits(self, origins, directions, inverse, best, best_slot):
+        # follow the nearest entered child of every ray down to a leaf and test it
+        rays = np.arange(len(origins))
+        lo, hi = self.levels[0]
+        near, far = slab(origins, inverse, lo[[0] * len(rays)], hi[[0] * len(rays)])
+        rays = rays[(near <= far) & (far >= 0)]
+        nodes = np.zeros(len(rays), dtype=np.int64)
+        for lo, hi in self.levels[1:]:
+            left = 2 * nodes
+            left_near, left_far = slab(origins[rays], inverse[rays], lo[left], hi[left])
+            right_near, right_far = slab(origins[rays], inverse[rays], lo[left + 1], hi[left + 1])
+            enter_left = (left_near <= left_far) & (left_far >= 0)
+            enter_right = (right_near <= right_far) & (right_far >= 0)
+            go_right = enter_right & (~enter_left | (right_near < left_near))
+            keep = enter_left | enter_right
+            rays, nodes = rays[keep], (left + go_right)[keep]
+        self.test_leaves(origins, directions, rays, nodes, best, best_slot)
+
+    def test_leaves(self, origins, directions, rays, leaves, best, best_slot):
+        # intersect each ray with the triangles of its leaf, keeping hits nearer than best (each ray once)
+        slots = leaves[:, None] * self.leaf_size + np.arange(self.leaf_size)
+        t = self.triangle_distances(origins[rays], directions[rays], slots)
+        nearest = np.argmin(t, axis=1)
+        t = t[np.arange(len(rays)), nearest]
+        closer = t < best[rays]
+        best[rays[closer]] = t[closer]
+        best_slot[rays[closer]] = slots[closer, nearest[closer]]
+
+    def triangle_distances(self, origins, directions, slots, epsilon=1e-12):
+        # Moller-Trumbore distance of each ray to each of its slots' triangles, inf when missed
+        edge1, edge2 = self.edge1[slots], self.edge2[slots]
+        directions = directions[:, None, :]
+        p = np.cross(directions, edge2)
+        determinant = np.einsum('rsk,rsk->rs', edge1, p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = 1.0 / determinant
+            s = origins[:, None, :] - self.v0[slots]
+            u = np.einsum('rsk,rsk->rs', s, p) * inverse
+            q = np.cross(s, edge1)
+            v = np.einsum('rsk,rsk->rs', directions, q) * inverse
+            t = np.einsum('rsk,rsk->rs', edge2, q) * inverse
+            hit = (np.abs(determinant) > epsilon) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+        return np.where(hit, t, np.inf)
+
+def slab(origins, inverse, lo, hi):
+    # entry and exit distances of rays through boxes, fmin/fmax drop the NaNs of 0 * inf
+    with np.errstate(invalid='ignore'):
+        t0 = (lo - origins) * inverse
+        t1 = (hi - origins) * inverse
+    near = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+    far = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+    return near, far
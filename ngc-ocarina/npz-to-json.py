@@ -0,0 +1,27 @@
+import argparse
+import os
+
+import columnar
+
+def main( input: str, output: str ):
+    # input: a .npz written with --format npz/both, output: folder for the JSON file it stands for
+    name, json_values = columnar.records(input)
+
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+
+    with open(os.path.join(output, name), 'w') as f:
+        columnar.write_json(json_values, f)
+
+
+if __name__ == "__main__":
+
+    ## Example: 
+    ## python npz-to-json.py -i /bar/0293_11/eye.npz -o /bar/0293_11
+
+    parser = argparse.ArgumentParser(description='This scripts aims to convert the columnar .npz outputs of the parsers back to the JSON files consumed by ARGUS')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+
+    args = parser.parse_args()
+    main(args.input[0],args.output[0])
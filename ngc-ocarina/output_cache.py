@@ -0,0 +1,256 @@
+""" Content-addressed cache of parser outputs, shared between trials and runs.
+
+    The key of a (trial, stream) output is a hash of what it is made from:
+    a fingerprint of each input table (row count, max rowid and a hash of
+    rows sampled across the rowid range), the settings that shape it (e.g.
+    component_color and chunk_size of config_image_extractor.yaml) and the
+    source of the scripts that write it. OutputCache.run() skips a stage
+    whose outputs are already those of its key, copies them from
+    <cache_dir>/<key> when another run made them, and otherwise runs the
+    stage and adds a copy of its outputs to the cache. Entries are copies
+    (copy-on-write clones where the filesystem supports them), never hard
+    links, as parsers write their outputs in place; each file's SHA-1 is
+    checked before an entry is used. Entries are evicted least recently
+    used first once the cache holds more than max_bytes.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_VERSION = 2
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# record of the key each stream's outputs were made with, next to the outputs
+OUTPUT_RECORD = 'output_cache.json'
+ENTRY_FILE = 'entry.json'
+# entries still being built after this long were abandoned
+STALE_SECONDS = 24 * 3600
+# ioctl cloning a whole file on btrfs and XFS (linux/fs.h)
+FICLONE = 0x40049409
+
+def table_fingerprint(conn, table, samples=16):
+    """ :return: dict with the row count, max rowid and a hash of samples
+        rows spread evenly over the rowid range, None if table doesn't exist
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if exists is None:
+        return None
+    rows, min_rowid, max_rowid = conn.execute(f"SELECT count(*), min(rowid), max(rowid) FROM {table}").fetchone()
+    digest = hashlib.sha1()
+    if rows > 0:
+        # the first and last rows and the ones in between, whole (blobs included)
+        for rowid in sorted({min_rowid + (max_rowid - min_rowid) * i // max(1, samples - 1) for i in range(samples)}):
+            row = conn.execute(f"SELECT rowid, * FROM {table} WHERE rowid >= ? ORDER BY rowid LIMIT 1", (rowid,)).fetchone()
+            for value in row:
+                digest.update(value if isinstance(value, bytes) else repr(value).encode())
+    return {'rows': rows, 'max_rowid': max_rowid, 'sample': digest.hexdigest()}
+
+def source_fingerprint(sources):
+    # hash of the scripts (file names relative to this folder) a stage runs, its parser version
+    digest = hashlib.sha1()
+    for name in sorted(sources):
+        with open(os.path.join(SCRIPTS_DIR, name), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+def cache_key(conn, stream, tables, settings, sources):
+    """ :param tables: input tables of the stream
+    :param settings: JSON-serialisable parameters its outputs depend on
+    :param sources: scripts whose code writes it
+    """
+    description = {
+        'version': CACHE_VERSION,
+        'stream': stream,
+        'tables': {table: table_fingerprint(conn, table) for table in tables},
+        'settings': settings,
+        'sources': source_fingerprint(sources),
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def clone_or_copy(source, target):
+    # copy-on-write clone where the filesystem allows it, a plain copy otherwise.
+    # Either way writing to one file never changes the other
+    if os.path.exists(target):
+        os.remove(target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            if os.path.exists(target):
+                os.remove(target)
+    shutil.copy2(source, target)
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class OutputCache:
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # max_bytes may have shrunk since the last run
+        self.evict()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def run(self, key, output, files, function, *args, **kwargs):
+        """ produce the files (paths relative to output) of one stream
+        :return: what function returned, or the value it returned when its
+            outputs were cached (it has to be JSON-serialisable)
+        """
+        record = self.output_record(output).get(key)
+        if record is not None and all(
+                os.path.exists(os.path.join(output, name)) and os.path.getsize(os.path.join(output, name)) == size
+                for name, size in record['files'].items()):
+            print(f"{', '.join(files)} in {output} up to date")
+            # keep the outputs in the cache for other runs, a no-op when the entry is there
+            self.store(key, output, files, record['result'])
+            return record['result']
+
+        entry = self.load_entry(key)
+        if entry is not None:
+            print(f"Copying {', '.join(files)} from {self.entry_dir(key)}")
+            for name in files:
+                clone_or_copy(os.path.join(self.entry_dir(key), name), os.path.join(output, name))
+            self.touch(key)
+            self.record_output(output, key, files, entry['result'])
+            return entry['result']
+
+        # outputs of another key are stale, a failing stage mustn't leave them behind
+        for name in files:
+            if os.path.exists(os.path.join(output, name)):
+                os.remove(os.path.join(output, name))
+        result = function(*args, **kwargs)
+        self.store(key, output, files, result)
+        self.record_output(output, key, files, result)
+        return result
+
+    def load_entry(self, key):
+        # the entry of key, None when it is missing or one of its files changed
+        try:
+            with open(os.path.join(self.entry_dir(key), ENTRY_FILE), 'r') as f:
+                entry = json.load(f)
+            for name, size in entry['files'].items():
+                path = os.path.join(self.entry_dir(key), name)
+                if os.path.getsize(path) != size or file_sha1(path) != entry['sha1'][name]:
+                    raise ValueError(f"{name} changed")
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self.entry_dir(key)):
+                print(f"Dropping cache entry {key} ({e})")
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            return None
+        return entry
+
+    def store(self, key, output, files, result):
+        """ add a copy of the outputs of key to the cache, then evict down to max_bytes """
+        if os.path.exists(os.path.join(self.entry_dir(key), ENTRY_FILE)):
+            self.touch(key)
+            return
+        missing = [name for name in files if not os.path.exists(os.path.join(output, name))]
+        if len(missing) > 0:
+            print(f"Not caching {key}, {', '.join(missing)} weren't written")
+            return
+
+        # built aside and renamed into place, so readers never see half an entry
+        tmp_dir = f"{self.entry_dir(key)}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for name in files:
+            clone_or_copy(os.path.join(output, name), os.path.join(tmp_dir, name))
+        entry = {
+            'files': {name: os.path.getsize(os.path.join(tmp_dir, name)) for name in files},
+            'sha1': {name: file_sha1(os.path.join(tmp_dir, name)) for name in files},
+            'result': result,
+            'created': datetime.now().isoformat(),
+        }
+        with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as f:
+            f.write(json.dumps(entry))
+        if os.path.exists(self.entry_dir(key)) and not os.path.exists(os.path.join(self.entry_dir(key), ENTRY_FILE)):
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        try:
+            os.rename(tmp_dir, self.entry_dir(key))
+        except OSError:
+            # another run stored the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def touch(self, key):
+        # entries are used in order of the mtime of their entry file
+        try:
+            os.utime(os.path.join(self.entry_dir(key), ENTRY_FILE))
+        except OSError:
+            pass
+
+    def entries(self):
+        """ :return: list of (last use, bytes, key) of every entry """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if '.tmp-' in key:
+                # left behind by a run that died while storing an entry
+                if time.time() - os.path.getmtime(self.entry_dir(key)) > STALE_SECONDS:
+                    shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                continue
+            path = os.path.join(self.entry_dir(key), ENTRY_FILE)
+            try:
+                with open(path, 'r') as f:
+                    size = sum(json.load(f)['files'].values())
+                entries.append((os.path.getmtime(path), size, key))
+            except (OSError, ValueError):
+                # entries being built or removed by another run
+                continue
+        return entries
+
+    def evict(self):
+        """ remove the least recently used entries until at most max_bytes
+            are cached. Outputs copied from an evicted entry stay where they are.
+        """
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for last_use, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                print(f"Evicting cache entry {key} ({size / 1024**2:.1f} MB, last used {datetime.fromtimestamp(last_use)})")
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total -= size
+
+    def output_record(self, output):
+        try:
+            with open(os.path.join(output, OUTPUT_RECORD), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def record_output(self, output, key, files, result):
+        # several stages of one output folder may finish at once
+        with self._lock:
+            record = {old_key: value for old_key, value in self.output_record(output).items()
+                      if not set(value['files']) & set(files)}
+            record[key] = {
+                'files': {name: os.path.getsize(os.path.join(output, name)) for name in files},
+                'result': result,
+                'time': time.time(),
+            }
+            tmp_path = os.path.join(output, OUTPUT_RECORD + '.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(record))
+            os.replace(tmp_path, os.path.join(output, OUTPUT_RECORD))
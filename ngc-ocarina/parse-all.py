@@ -0,0 +1,149 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import sqlite3
+
+import yaml
+
+import columnar
+import image_extractor
+import output_cache
+import profiler
+from script_loader import load_script
+import timestamps
+
+eye_parser = load_script("eye-parser")
+perception_parser = load_script("perception-parser")
+reasoning_parser = load_script("reasoning-parser")
+generate_metadata = load_script("generate-metadata")
+
+def open_readonly(input: str, mmap_size: int):
+    """ open the trial database once, read-only and memory-mapped, to be
+        shared by every stage (sqlite3 serialises access across threads)
+    """
+    conn = sqlite3.connect(f"file:{os.path.abspath(input)}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON;")
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    return conn
+
+def run_stage(name, function, *args, **kwargs):
+    print(f"Starting {name} {datetime.now()}")
+    with profiler.stage(name):
+        result = function(*args, **kwargs)
+    print(f"Finished {name} {datetime.now()}")
+    return result
+
+def output_files(json_names, output_format):
+    # files written for each JSON output in output_format
+    files = []
+    for name in json_names:
+        if output_format in ['json', 'both']:
+            files.append(name)
+        if output_format in ['npz', 'both']:
+            files.append(name[:-len('.json')] + '.npz')
+    return files
+
+def run_cached(cache, conn, output, stream, tables, settings, sources, files, function, *args, **kwargs):
+    """ run_stage(stream, function, ...), unless cache has the files of the
+        same tables, settings and sources (see output_cache)
+    """
+    if cache is None:
+        return run_stage(stream, function, *args, **kwargs)
+    with profiler.stage(f"{stream}.fingerprint"):
+        key = output_cache.cache_key(conn, stream, tables, settings, sources)
+    return cache.run(key, output, files, run_stage, stream, function, *args, **kwargs)
+
+def main( input: str, output: str, config_path: str, chunk_size: int, mmap_size: int, video: bool, output_format: str = 'json', date_anchor: str = 'session', cache_dir: str = '' ):
+
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    color_dict = dict(config["component_color"])
+
+    cache = None
+    cache_dir = cache_dir or config.get("cache_dir")
+    if cache_dir:
+        cache = output_cache.OutputCache(cache_dir, config.get("cache_size_gb", 100) * 1024**3)
+
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+
+    conn = open_readonly(input, mmap_size)
+    # one date for every stage, so perception and reasoning timestamps line up
+    date_anchor_ms = timestamps.resolve_date_anchor(conn, date_anchor)
+
+    # eye, perception, reasoning and video only read the database, so they run side by side
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        eye = executor.submit(
+            run_cached, cache, conn, output, "eye", ["hl2_gaze"],
+            {"format": output_format}, ["eye-parser.py", "columnar.py"],
+            output_files(["eye.json"], output_format),
+            eye_parser.parse, conn, output, chunk_size, output_format)
+        perception = executor.submit(
+            run_cached, cache, conn, output, "perception", ["hl2_rgb_bounding_boxes", "hl2_rgb"],
+            {"format": output_format, "date_anchor_ms": date_anchor_ms}, ["perception-parser.py", "columnar.py", "timestamps.py"],
+            output_files(["detic:image.json"], output_format),
+            perception_parser.parse, conn, output, chunk_size, output_format, date_anchor_ms)
+        reasoning = executor.submit(
+            run_cached, cache, conn, output, "reasoning", ["ocarina_mission_log"],
+            {"format": output_format, "date_anchor_ms": date_anchor_ms}, ["reasoning-parser.py", "columnar.py", "timestamps.py"],
+            output_files(["egovlp:action:steps.json", "reasoning:check_status.json"], output_format),
+            reasoning_parser.parse, conn, output, output_format, date_anchor_ms)
+
+        video_feeds = []
+        if video:
+            for feed in config["feeds"]:
+                if config["feeds"][feed]["extract_video"]:
+                    video_feeds.append((feed, config["feeds"][feed]["include_bbs"]))
+        videos = [
+            executor.submit(
+                run_cached, cache, conn, output, f"{feed[0]} video", [feed[0], f"{feed[0]}_bounding_boxes"] if feed[1] else [feed[0]],
+                {"feed": feed, "component_color": color_dict, "chunk_size": config["chunk_size"]},
+                ["image_extractor.py", "annotator.py", "frame_decoder.py", "manifest.py", "timestamps.py"],
+                [os.path.join(feed[0], name) for name in [f"{feed[0]}.mp4", f"{feed[0]}_timecodes.txt", f"{feed[0]}_manifest.jsonl"]],
+                image_extractor.stream_video,
+                input, output, None, feed,
+                chunk_size=config["chunk_size"],
+                color_dict=color_dict,
+                queue_size=config.get("video_queue_size", 8),
+                resume=config.get("resume", True),
+                con=conn,
+                memory_limit=config.get("job_memory_mb", 0) * 1024**2)
+            for feed in video_feeds]
+
+        for stage in [eye, perception, reasoning] + videos:
+            stage.result()
+
+    # metadata comes from the perception records already seen, not from re-reading detic:image.json
+    entries = perception.result()
+    if len(video_feeds) > 0 and len(entries) > 0:
+        image_table = video_feeds[0][0]
+        video_path = os.path.join(output, image_table, f"{image_table}.mp4")
+        json_metadata = generate_metadata.buildMetadata(
+            generate_metadata.getVideoDuration(video_path),
+            entries["first-entry"],
+            entries["last-entry"])
+        generate_metadata.writeMetadata(json_metadata, output)
+
+    conn.close()
+
+if __name__ == "__main__":
+
+    ## Example: 
+    ## python parse-all.py -i /foo/0293_11.sqlite -o /bar/0293_11
+
+    parser = argparse.ArgumentParser(description='This scripts aims to run every Ocarina parser against a single read-only connection to the trial SQLite file')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('--config', default='./config/config_image_extractor.yaml', help='image extraction settings (colors, chunk size, feeds)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=100000, help='number of rows the eye and perception stages read at a time')
+    parser.add_argument('--mmap-size', type=int, default=2**30, help='bytes of the database SQLite may memory-map')
+    parser.add_argument('--no-video', action='store_true', help='skip video extraction and metadata')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write the JSON files, their columnar .npz versions, or both')
+    parser.add_argument('--date-anchor', default='session', help='date given to perception and reasoning timestamps: "session" (date of the trial), "today" or YYYY-MM-DD')
+    parser.add_argument('--cache-dir', default='', help='shared cache of unchanged outputs, overrides cache_dir of the config')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write parse-all_profile.json with the time of each stage, and with "cprofile" also parse-all.prof')
+
+    args = parser.parse_args()
+    profiler.run('parse-all', args.output[0], args.profile,
+        main, args.input[0],args.output[0],args.config,args.chunk_size,args.mmap_size,not args.no_video,args.format,args.date_anchor,args.cache_dir)
@@ -1,6 +1,5 @@
-import datetime
-import calendar
 import sqlite3
+import numpy as np
 import pandas as pd
 
 # import packages to write a json file
@@ -8,6 +7,10 @@ import os
 import json
 import argparse
 
+import columnar
+import profiler
+import timestamps
+
 def create_connection(db_file):
     """ create a database connection to the SQLite database
         specified by the db_file
@@ -21,69 +24,236 @@ def create_connection(db_file):
         print(e)
     return conn
 
-def get_dataframe_from_sqlite(db_file, table_name):
+def get_dataframe_from_sqlite(db_file, table_name, chunk_size=100000, image_table="hl2_rgb", box_batch_size=1000):
     # read-only connection
     conn = create_connection(db_file)
-    # create the dataframe from a query
-    query = "SELECT * FROM " + table_name
-    df = pd.read_sql_query(query, conn, chunksize=100)
-    return df
-
-# Convert date string to PTG timestamp format (epoch)
-def  utc_date_to_epoch(utc_date_str):
-    # utc_date_str = '2022-09-28 17:28:35.480247'
-    datetime_value = datetime.datetime.strptime(utc_date_str, '%Y-%m-%d %H:%M:%S.%f')
-    dt_now = datetime.datetime.now()
-    # replace with current YYMMDD info so objects and actions can be synchronized.
-    # this is done because action timestamps doesnt have YYMMDD info
-    # when there is no YYMMDD info, the default YYMMDD is 1900-01-01 which generate a different epoch value
-    dt = datetime_value.replace(year=dt_now.year, month=dt_now.month, day=dt_now.day) 
-    epoch_format = calendar.timegm(dt.timetuple())
-    ptg_timestamp_format = str(epoch_format* 1000)+'-0'
-    return ptg_timestamp_format
-
-def get_json_values(sql_df):
-    
-    target_objects = ['fdvcp', 'mfd inboard', 'mfd outboard', 'cdu']
-    json_values = []
+    return get_dataframe_from_connection(conn, table_name, chunk_size, image_table, box_batch_size)
+
+def get_dataframe_from_connection(conn, table_name, chunk_size=100000, image_table="hl2_rgb", box_batch_size=1000):
+    # create the dataframe from a query, ordered so each timestamp's rows are contiguous.
+    # The size of each box's frame comes from image_table, skipping its data column
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (image_table,)).fetchone()
+    if exists is None:
+        print(f"No {image_table} table, boxes can't be normalized")
+        query = "SELECT rowid AS box_rowid, timestamp, component_id, NULL AS width, NULL AS height FROM " + table_name \
+            + " WHERE timestamp IS NOT NULL ORDER BY timestamp"
+    else:
+        query = "SELECT b.rowid AS box_rowid, b.timestamp, b.component_id, f.width, f.height FROM " + table_name + " AS b" \
+            + " LEFT OUTER JOIN (SELECT image_count, max(width) AS width, max(height) AS height FROM " + image_table \
+            + " GROUP BY image_count) AS f ON f.image_count = b.image_count" \
+            + " WHERE b.timestamp IS NOT NULL ORDER BY b.timestamp"
+    return read_boxes(conn, table_name, pd.read_sql_query(query, conn, chunksize=box_batch_size), chunk_size)
+
+def read_boxes(conn, table_name, batches, chunk_size):
+    # the bounds blobs are left out of the sort and fetched by rowid box_batch_size rows
+    # at a time, so only that many are held in memory; they are replaced by their boxes
+    # and the batches regrouped into chunks of about chunk_size rows
+    parts = []
+    rows = 0
+    for batch in profiler.timed(batches, 'perception.fetch', 'perception.rows'):
+        batch['bounds'] = None
+        if batch['width'].notnull().any():
+            with profiler.stage('perception.fetch'):
+                rowids = ",".join(str(int(rowid)) for rowid in batch['box_rowid'])
+                bounds = dict(conn.execute(f"SELECT rowid, bounds FROM {table_name} WHERE rowid IN ({rowids})").fetchall())
+                batch['bounds'] = [bounds.get(rowid) for rowid in batch['box_rowid'].tolist()]
+            profiler.count('perception.bounds_bytes', sum(len(blob) for blob in bounds.values() if blob is not None))
+        with profiler.stage('perception.decode'):
+            batch[['x0', 'y0', 'x1', 'y1']] = normalized_boxes(batch)
+        parts.append(batch.drop(columns=['box_rowid', 'bounds', 'width', 'height']))
+        rows += len(batch)
+        if rows >= chunk_size:
+            yield pd.concat(parts, ignore_index=True)
+            parts = []
+            rows = 0
+    if len(parts) > 0:
+        yield pd.concat(parts, ignore_index=True)
+
+def normalized_boxes(chunk):
+    """ xyxyn of every row's bounds blob ((y, x) int64 pixels) in one pass over
+        the chunk: min/max per row with reduceat, divided by the frame size.
+    :return: float array (rows, 4), NaN where a row has no bounds or frame size
+    """
+    boxes = np.full((len(chunk), 4), np.nan)
+    blobs = chunk['bounds'].to_numpy()
+    lengths = np.fromiter((len(blob) if blob is not None else 0 for blob in blobs), dtype=np.int64, count=len(blobs)) // 16
+    width = pd.to_numeric(chunk['width'], errors='coerce').to_numpy(dtype=float)
+    height = pd.to_numeric(chunk['height'], errors='coerce').to_numpy(dtype=float)
+    valid = (lengths > 0) & (width > 0) & (height > 0)
+    if not valid.any():
+        return boxes
+
+    points = np.frombuffer(b"".join(blobs[valid]), dtype=np.int64).reshape(-1, 2)
+    starts = np.concatenate(([0], np.cumsum(lengths[valid])[:-1]))
+    mins = np.minimum.reduceat(points, starts, axis=0)
+    maxs = np.maximum.reduceat(points, starts, axis=0)
+    # pixel (y, x) covers [x, x + 1), like cv2.boundingRect
+    boxes[valid] = np.stack((
+        mins[:, 1] / width[valid],
+        mins[:, 0] / height[valid],
+        (maxs[:, 1] + 1) / width[valid],
+        (maxs[:, 0] + 1) / height[valid]), axis=1)
+    return np.round(np.clip(boxes, 0, 1), 4)
+
+def merge_components(chunk):
+    # one row per (timestamp, component_id), its box the union of the component's boxes.
+    # NULL components are kept so a timestamp with nothing but NULL components is still written.
+    # The stable sort keeps the rows of a timestamp together wherever pandas puts the NULL groups
+    merged = chunk.groupby(['timestamp', 'component_id'], sort=False, as_index=False, dropna=False).agg(
+        ptg_timestamp=('ptg_timestamp', 'first'),
+        x0=('x0', 'min'), y0=('y0', 'min'), x1=('x1', 'max'), y1=('y1', 'max'))
+    return merged.sort_values('timestamp', kind='stable', ignore_index=True)
 
+def whole_timestamps(sql_df):
+    # re-chunk chunks ordered by timestamp so no timestamp is split between two.
+    # The last timestamp of a chunk may continue in the next one, so it is held back
+    pending = None
     for chunk in sql_df:
-        
-        df2 = chunk[chunk['timestamp'].notnull()] # remove null timestamps
-        df3 = df2[pd.to_datetime(df2['timestamp'], errors='coerce',format='%Y-%m-%d %H:%M:%S.%f').notnull()] # check correct format
-        uniqueTs = df3['timestamp'].unique()
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        last_ts = chunk['timestamp'].iat[-1]
+        is_last = (chunk['timestamp'] == last_ts).to_numpy()
+        pending = chunk[is_last]
+        if not is_last.all():
+            yield chunk[~is_last]
+    if pending is not None:
+        yield pending
+
+def get_json_values(sql_df, date_anchor_ms):
     
-        for ts in uniqueTs:
-            detected_objects_per_ts = chunk[chunk['timestamp'] == ts]['component_id'].values
+    target_objects = ['fdvcp', 'mfd inboard', 'mfd outboard', 'cdu']
+
+    for chunk in whole_timestamps(valid_chunks(sql_df, date_anchor_ms)):
+
+        # one row per component and timestamp, then plain lists for the per-timestamp loop
+        with profiler.stage('perception.group'):
+            chunk = merge_components(chunk)
+            ts = chunk['timestamp'].to_numpy()
+            starts = np.flatnonzero(np.concatenate(([True], ts[1:] != ts[:-1]))).tolist()
+            ends = starts[1:] + [len(ts)]
+            # NULL components are NaN keys, never one of target_objects
+            components = chunk['component_id'].tolist()
+            # components without bounds keep the [0,0,0,0] box
+            boxes = chunk[['x0', 'y0', 'x1', 'y1']].to_numpy()
+            no_bounds = np.isnan(boxes).any(axis=1).tolist()
+            boxes = [[0, 0, 0, 0] if missing else box for box, missing in zip(boxes.tolist(), no_bounds)]
+            ptg_timestamps = chunk['ptg_timestamp'].tolist()
+
+        for start, end in zip(starts, ends):
+            detected_objects_per_ts = dict(zip(components[start:end], boxes[start:end]))
             values = []
             for obj in target_objects:
-                if(obj in list(detected_objects_per_ts)):
+                if(obj in detected_objects_per_ts):
                     values.append({
-                        "xyxyn":[0,0,0,0],
+                        "xyxyn":detected_objects_per_ts[obj],
                         "confidence":1,
                         "class_id":1,
                         "label":obj
                         })
-            json_values.append({
+            yield {
                 "frame_type":123,
                 "values": values,
-                "timestamp": utc_date_to_epoch(ts)
-                })
+                "timestamp": ptg_timestamps[start]
+                }
+
+def valid_chunks(sql_df, date_anchor_ms):
+    # keep rows in the correct format and convert their timestamps a chunk at a time.
+    # The date is replaced by the anchor so objects and actions (which have no date) are synchronized
+    for chunk in sql_df:
+        with profiler.stage('perception.decode'):
+            datetimes = timestamps.to_datetimes(chunk['timestamp'], errors='coerce')
+            valid = datetimes.notnull()
+            chunk = chunk[valid].copy()
+            chunk['ptg_timestamp'] = timestamps.ptg_timestamps(timestamps.time_of_day_ms(datetimes[valid]) + date_anchor_ms)
+        yield chunk
+
+def write_json(json_values, output_file, stage='perception.serialise'):
+    # stream the array to disk one record at a time
+    output_file.write('[')
+    for i, value in enumerate(json_values):
+        with profiler.stage(stage):
+            if i > 0:
+                output_file.write(', ')
+            output_file.write(json.dumps(value))
+    output_file.write(']')
 
-    sorted_json_data = sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])
-    return sorted_json_data
+def track_entries(json_values, entries):
+    # record the first and last timestamps while the records go by
+    for value in json_values:
+        profiler.count('perception.records')
+        if "first-entry" not in entries:
+            entries["first-entry"] = value["timestamp"]
+        entries["last-entry"] = value["timestamp"]
+        yield value
 
-def main( input: str, output: str ):
+def collect_columns(json_values, writer, labels, batch_size=10000):
+    # pass the records through while keeping their values as typed columns for the .npz;
+    # labels maps each label seen to its index in the label column
+    batch = {name: [] for name in ['timestamp', 'frame_type', 'value_offsets', 'label', 'xyxyn', 'xyxyn_int',
+                                   'confidence', 'confidence_int', 'class_id']}
+    offset = 0
+    writer.append(value_offsets=[offset])
+    for value in json_values:
+        objects = value["values"]
+        offset += len(objects)
+        batch['timestamp'].append(int(value["timestamp"].split('-')[0]))
+        batch['frame_type'].append(value["frame_type"])
+        batch['value_offsets'].append(offset)
+        for obj in objects:
+            batch['label'].append(labels.setdefault(obj["label"], len(labels)))
+            batch['xyxyn'].append(obj["xyxyn"])
+            batch['xyxyn_int'].append(all(columnar.is_int(x) for x in obj["xyxyn"]))
+            batch['confidence'].append(obj["confidence"])
+            batch['confidence_int'].append(columnar.is_int(obj["confidence"]))
+            batch['class_id'].append(obj["class_id"])
+        if len(batch['timestamp']) >= batch_size:
+            writer.append(**batch)
+            batch = {name: [] for name in batch}
+        yield value
+    writer.append(**batch)
 
-    sql_df = get_dataframe_from_sqlite(input, "hl2_rgb_bounding_boxes")
-    json_perception = get_json_values(sql_df)
+def new_column_writer(path):
+    return columnar.ColumnWriter(path, 'detic:image.json',
+        timestamp=(np.int64, ()), frame_type=(np.int32, ()), value_offsets=(np.int64, ()),
+        label=(np.int32, ()), xyxyn=(np.float32, (4,)), xyxyn_int=(np.bool_, ()),
+        confidence=(np.float32, ()), confidence_int=(np.bool_, ()), class_id=(np.int32, ()))
+
+def parse( conn, output: str, chunk_size: int = 100000, output_format: str = 'json', date_anchor = 'session' ):
+    """ write detic:image.json (and/or detic:image.npz) from an open connection
+    :param date_anchor: see timestamps.resolve_date_anchor
+    :return: dict with the first-entry and last-entry timestamps written
+    """
+    date_anchor_ms = timestamps.resolve_date_anchor(conn, date_anchor)
+    sql_df = get_dataframe_from_connection(conn, "hl2_rgb_bounding_boxes", chunk_size)
+    entries = dict()
+    json_perception = track_entries(get_json_values(sql_df, date_anchor_ms), entries)
 
-    outputPath = os.path.join(output, 'detic:image.json')
     if( not os.path.exists(output) ):
         os.makedirs(output)
 
-    with open(outputPath, 'w') as f:
-        f.write(json.dumps(json_perception))
+    writer = None
+    labels = dict()
+    if output_format in ['npz', 'both']:
+        writer = new_column_writer(os.path.join(output, 'detic:image.npz'))
+        json_perception = collect_columns(json_perception, writer, labels)
+
+    if output_format in ['json', 'both']:
+        outputPath = os.path.join(output, 'detic:image.json')
+        with open(outputPath, 'w') as f:
+            write_json(json_perception, f)
+    else:
+        for _ in json_perception:
+            pass
+
+    if writer is not None:
+        writer.close(labels=np.array(list(labels), dtype=str))
+    return entries
+
+def main( input: str, output: str, chunk_size: int = 100000, output_format: str = 'json', date_anchor: str = 'session', profile: str = None ):
+
+    profiler.run('perception-parser', output, profile, parse, create_connection(input), output, chunk_size, output_format, date_anchor)
 
 if __name__ == "__main__":
 
@@ -93,6 +263,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This scripts aims to parse the Ocarina data stored into SQLite files to NYU backend format')
     parser.add_argument('-i', '--input', nargs=1, required=True, default='')
     parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('-c', '--chunk-size', type=int, default=100000, help='number of bounding box rows read at a time')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write detic:image.json, the columnar detic:image.npz, or both')
+    parser.add_argument('--date-anchor', default='session', help='date given to the timestamps: "session" (date of the trial), "today" or YYYY-MM-DD')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write perception-parser_profile.json with the time of each stage, and with "cprofile" also perception-parser.prof')
 
     args = parser.parse_args()
-    main(args.input[0],args.output[0])
\ No newline at end of file
+    main(args.input[0],args.output[0],args.chunk_size,args.format,args.date_anchor,args.profile)
\ No newline at end of file
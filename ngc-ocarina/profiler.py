@@ -0,0 +1,163 @@
+""" Opt-in timers and counters for the parsers.
+
+    Scripts time their stages (SQL fetch, decode, annotate, encode, JSON
+    serialise) with stage() and timed(), and add rows, frames and bytes
+    with count(). These are no-ops until enable() is called, which the
+    --profile flag of each script does through run(); the totals, wall
+    time and peak RSS are then written to <output>/<name>_profile.json.
+    With --profile cprofile the run is also wrapped in cProfile and its
+    stats written to <output>/<name>.prof (cProfile only sees the thread
+    that called run(), the timers cover every thread).
+"""
+
+import cProfile
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+PROFILE_MODES = ['timers', 'cprofile']
+
+class Profile:
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.start_time = time.perf_counter()
+        self.stages = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds, calls=1):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+
+    def count(self, counter, value):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def summary(self):
+        # stages run on several threads overlap, so their seconds may add up to more than wall_seconds.
+        # peak_rss_mb is the peak of the whole process, which for a pool worker includes its earlier jobs
+        with self._lock:
+            return {
+                'name': self.name,
+                'started': self.started.isoformat(),
+                'wall_seconds': round(time.perf_counter() - self.start_time, 6),
+                'peak_rss_mb': round(peak_rss() / 1024**2, 1),
+                'stages': {stage: {'seconds': round(totals['seconds'], 6), 'calls': totals['calls']}
+                           for stage, totals in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write(self, output):
+        path = os.path.join(output, f"{self.name}_profile.json")
+        if not os.path.exists(output):
+            os.makedirs(output)
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.summary(), indent=1))
+        return path
+
+# the profile of this process, None while profiling is off
+_profile = None
+
+def enable(name):
+    global _profile
+    _profile = Profile(name)
+    return _profile
+
+def disable():
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+def enabled():
+    return _profile is not None
+
+def stage(name):
+    """ context manager adding the time spent in its block to stage name """
+    if _profile is None:
+        return nullcontext()
+    return _timer(_profile, name)
+
+@contextmanager
+def _timer(profile, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_time(name, time.perf_counter() - start)
+
+def add_time(name, seconds, calls=1):
+    # time measured elsewhere, e.g. returned by a worker process
+    if _profile is not None:
+        _profile.add_time(name, seconds, calls)
+
+def count(counter, value=1):
+    if _profile is not None:
+        _profile.count(counter, value)
+
+def timed(iterable, name, counter=None, size=len):
+    """ pass the items of iterable through, adding the time spent producing
+        each one (e.g. a SQL fetch) to stage name and size(item) to counter
+    """
+    if _profile is None:
+        return iterable
+    return _timed(_profile, iterable, name, counter, size)
+
+def _timed(profile, iterable, name, counter, size):
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            profile.add_time(name, time.perf_counter() - start, 0)
+            return
+        profile.add_time(name, time.perf_counter() - start)
+        if counter is not None:
+            profile.count(counter, size(item))
+        yield item
+
+def peak_rss():
+    # bytes, ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def current_rss():
+    # bytes of memory the process uses right now, its peak where /proc isn't available
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+def run(name, output, mode, function, *args, **kwargs):
+    """ call function, profiled when mode is one of PROFILE_MODES """
+    if mode is None:
+        return function(*args, **kwargs)
+
+    profile = enable(name)
+    profiler = cProfile.Profile() if mode == 'cprofile' else None
+    try:
+        if profiler is not None:
+            return profiler.runcall(function, *args, **kwargs)
+        return function(*args, **kwargs)
+    finally:
+        disable()
+        print(f"Wrote {profile.write(output)} {datetime.now()}")
+        if profiler is not None:
+            stats_path = os.path.join(output, f"{name}.prof")
+            profiler.dump_stats(stats_path)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+            print(stream.getvalue())
+            print(f"Wrote {stats_path}, open it with python -m pstats or snakeviz")
@@ -0,0 +1,40 @@
+import argparse
+import json
+
+import columnar
+from session_store import SessionStore
+
+def main( input: str, stream: str, start: int, end: int, relative: bool, output: str ):
+    # input: a session output folder, as written by the parsers and image_extractor.py
+    store = SessionStore(input)
+    store.build()
+
+    if( store.streams[stream]['kind'] in columnar.RECORDS ):
+        json_values = store.records(stream, start, end, relative)
+        if( output ):
+            with open(output, 'w') as f:
+                columnar.write_json(json_values, f)
+        else:
+            print(json.dumps(list(json_values)))
+    else:
+        # video feeds resolve to frame numbers
+        frames = store.frames(stream, start, end, relative)
+        print(json.dumps(frames.tolist()))
+
+
+if __name__ == "__main__":
+
+    ## Example: 
+    ## python query-session.py -i /bar/0293_11 -s eye --start 720000 --end 840000 --relative -o /bar/eye_12_14.json
+    ## python query-session.py -i /bar/0293_11 -s hl2_rgb --start 720000 --end 840000 --relative
+
+    parser = argparse.ArgumentParser(description='This scripts aims to slice one stream of a parsed session by time, using a sorted index built next to the outputs')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('-s', '--stream', required=True, help='eye, detic:image, egovlp:action:steps, reasoning:check_status or a video feed such as hl2_rgb')
+    parser.add_argument('--start', type=int, required=True, help='epoch milliseconds (inclusive)')
+    parser.add_argument('--end', type=int, required=True, help='epoch milliseconds (exclusive)')
+    parser.add_argument('--relative', action='store_true', help='start and end are milliseconds since the start of the session')
+    parser.add_argument('-o', '--output', default='', help='write the records as JSON to this file instead of printing them')
+
+    args = parser.parse_args()
+    main(args.input[0],args.stream,args.start,args.end,args.relative,args.output)
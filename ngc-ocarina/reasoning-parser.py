@@ -1,15 +1,16 @@
 # import packages to read sqlite file
 import sqlite3
+import numpy as np
 import pandas as pd
-import time  
-import datetime
-import calendar
 import argparse
 
 # import packages to write a json file
 import os
 import json
 
+import columnar
+import profiler
+import timestamps
 
 
 def create_connection(db_file):
@@ -28,52 +29,65 @@ def create_connection(db_file):
 def get_dataframe_from_sqlite(db_file, table_name):
     # fancy read-only connection
     conn = create_connection(db_file)
+    return get_dataframe_from_connection(conn, table_name)
+
+def get_dataframe_from_connection(conn, table_name):
     # create the dataframe from a query
     query = "SELECT * FROM " + table_name
     df = pd.read_sql_query(query, conn)
     return df
 
-# Convert date string (HHMMSS) to PTG timestamp format (epoch)
-def  utc_hms_date_to_epoch(utc_date_str):
-    # utc_date_str = '17:29:43.005'
-    datetime_value = datetime.datetime.strptime(utc_date_str, '%H:%M:%S.%f')
-    dt_now = datetime.datetime.now()
-    # set year, month, day of the datetime object to current date's year, month and day via replace
-    # since there is no Year, Month, Day info (this info is required to computed a positive epoch value. otherwise it will be negative (1900-01-01))
-    dt = datetime_value.replace(year=dt_now.year, month=dt_now.month, day=dt_now.day) # replace with current YYMMDD info
-    epoch_format = calendar.timegm(dt.timetuple())
-    ptg_timestamp_format = str(epoch_format*1000)+'-0'
-    return ptg_timestamp_format   
-
-def get_actions_json(df):
-    json_values = []
-    unique_actions = df["Event"].unique()
-    
+def ptg_timestamps_by_value(values, date_anchor_ms):
+    # PTG timestamp (epoch) of each time of day string, converted in one pass.
+    # There is no Year, Month, Day info, so the times are placed on the date anchor
+    values = list(values)
+    datetimes = timestamps.to_datetimes(values, timestamps.TIME_FORMAT)
+    return dict(zip(values, timestamps.ptg_timestamps(timestamps.time_of_day_ms(datetimes) + date_anchor_ms)))
+
+# stands in for a NULL Event while counting events, it can't be an event name
+NULL_EVENT = '\0NULL'
+
+def get_valid_timestamps(df):
     df2 = df[df['timestamp'].notnull()] # remove null timestamps
     df3 = df2[pd.to_datetime(df2['timestamp'], errors='coerce',format='%H:%M:%S.%f').notnull()] # check correct format
+    return df3
+
+def sort_by_timestamp(json_values):
+    return sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])
+
+def get_actions_json(df, date_anchor_ms, unique_actions=None):
+    # one key per event of unique_actions, by default the events of df in order of appearance
+    if unique_actions is None:
+        unique_actions = df["Event"].unique()
+    
+    df3 = get_valid_timestamps(df)
     uniqueTs = df3['timestamp'].unique()
-    for ts in uniqueTs:
-        detected_actions_per_ts = df[df['timestamp'] == ts]['Event'].values
-        row_dic = {"timestamp": utc_hms_date_to_epoch(ts) } # get time from sqlite file
-        for action in unique_actions:
-            if(action in list(detected_actions_per_ts)):
-                row_dic[action] = 1
-            else:
-                row_dic[action] = 0
-        json_values.append(row_dic)        
-        sorted_json_data = sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])     
-    return sorted_json_data
-
-def get_steps_json(df):
+
+    # one-hot of the events seen at each timestamp, computed in a single pass.
+    # crosstab drops NULL events, so they are counted under a placeholder
+    events = df3['Event'].astype(object).where(df3['Event'].notnull(), NULL_EVENT)
+    columns = [NULL_EVENT if pd.isnull(action) else action for action in unique_actions]
+    detected_actions = pd.crosstab(df3['timestamp'], events) > 0
+    detected_actions = detected_actions.reindex(index=uniqueTs, columns=columns, fill_value=False)
+    detected_actions = detected_actions.to_numpy(dtype=int).tolist()
+
+    ptg_timestamps = ptg_timestamps_by_value(uniqueTs, date_anchor_ms)
+    json_values = []
+    for ts, detected in zip(uniqueTs, detected_actions):
+        row_dic = {"timestamp": ptg_timestamps[ts] } # get time from sqlite file
+        row_dic.update(zip(unique_actions, detected))
+        json_values.append(row_dic)
+    return sort_by_timestamp(json_values)
+
+def get_steps_json(df, date_anchor_ms):
     json_values = []
     
-    df2 = df[df['timestamp'].notnull()] # remove null timestamps
-    df3 = df2[pd.to_datetime(df2['timestamp'], errors='coerce',format='%H:%M:%S.%f').notnull()] # check correct format
-    uniqueTs = df3['timestamp'].unique()
-    for ts in uniqueTs:
-        detected_steps_per_ts = df[df['timestamp'] == ts]['Step'].values
-        step = list(detected_steps_per_ts)[0]
-        timestamp_value = utc_hms_date_to_epoch(ts)# get time from sqlite file
+    df3 = get_valid_timestamps(df)
+    # first step logged at each timestamp, in order of appearance
+    first_rows = df3.drop_duplicates('timestamp')
+    ptg_timestamps = ptg_timestamps_by_value(first_rows['timestamp'], date_anchor_ms)
+    for ts, step in zip(first_rows['timestamp'].tolist(), first_rows['Step'].tolist()):
+        timestamp_value = ptg_timestamps[ts]# get time from sqlite file
         row_dic = {"step_id": step,
                     "step_status": "NEW",
                     "step_description": "",
@@ -81,27 +95,66 @@ def get_steps_json(df):
                     "error_description": "",
                     "timestamp": timestamp_value
                    }
-        json_values.append(row_dic)        
-        sorted_json_data = sorted(json_values, key=lambda d: d['timestamp'].split('-')[0])     
-    return sorted_json_data
+        json_values.append(row_dic)
+    return sort_by_timestamp(json_values)
+
+def epoch_ms(json_values):
+    # "<ms>-0" timestamps as int64 for the .npz outputs
+    return np.array([int(d['timestamp'].split('-')[0]) for d in json_values], dtype=np.int64)
+
+def write_actions_npz(json_actions, actions, path):
+    detected = np.array([[d[action] for action in actions] for d in json_actions], dtype=np.uint8)
+    # a NULL event is an action too, its key is null in the JSON
+    action_names, action_nulls = columnar.nullable_column(list(actions))
+    columnar.save(path, 'egovlp:action:steps.json',
+        timestamp=epoch_ms(json_actions),
+        actions=action_names,
+        actions_null=action_nulls,
+        detected=detected.reshape(len(json_actions), len(actions)))
+
+def write_steps_npz(json_steps, path):
+    step_ids, step_id_nulls = columnar.nullable_column([d['step_id'] for d in json_steps])
+    columnar.save(path, 'reasoning:check_status.json',
+        timestamp=epoch_ms(json_steps),
+        step_id=step_ids,
+        step_id_null=step_id_nulls,
+        step_status=np.array([d['step_status'] for d in json_steps], dtype=str),
+        step_description=np.array([d['step_description'] for d in json_steps], dtype=str),
+        error_status=np.array([d['error_status'] for d in json_steps], dtype=bool),
+        error_description=np.array([d['error_description'] for d in json_steps], dtype=str))
+
+def parse( conn, output: str, output_format: str = 'json', date_anchor = 'session' ):
+
+    date_anchor_ms = timestamps.resolve_date_anchor(conn, date_anchor)
+    with profiler.stage('reasoning.fetch'):
+        sql_df = get_dataframe_from_connection(conn, "ocarina_mission_log")
+    profiler.count('reasoning.rows', len(sql_df))
+    with profiler.stage('reasoning.decode'):
+        json_actions = get_actions_json(sql_df, date_anchor_ms)
+
+        json_steps = get_steps_json(sql_df, date_anchor_ms)
+    profiler.count('reasoning.records', len(json_actions) + len(json_steps))
 
-def main( input: str, output: str ):
-
-    sql_df = get_dataframe_from_sqlite(input, "ocarina_mission_log")
-    json_actions = get_actions_json(sql_df)
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
 
-    json_steps = get_steps_json(sql_df)
+    if output_format in ['json', 'both']:
+        outputPathActions = os.path.join(output, 'egovlp:action:steps.json')
+        outputPathSteps = os.path.join(output, 'reasoning:check_status.json')
+        with profiler.stage('reasoning.serialise'):
+            with open(outputPathActions, 'w') as f:
+                f.write(json.dumps(json_actions))
+            with open(outputPathSteps, 'w') as f:
+                f.write(json.dumps(json_steps))
 
-    outputPathActions = os.path.join(output, 'egovlp:action:steps.json')
-    outputPathSteps = os.path.join(output, 'reasoning:check_status.json')
+    if output_format in ['npz', 'both']:
+        with profiler.stage('reasoning.columns'):
+            write_actions_npz(json_actions, sql_df["Event"].unique(), os.path.join(output, 'egovlp:action:steps.npz'))
+            write_steps_npz(json_steps, os.path.join(output, 'reasoning:check_status.npz'))
 
-    if( not os.path.exists(output) ):
-        os.makedirs(output)
+def main( input: str, output: str, output_format: str = 'json', date_anchor: str = 'session', profile: str = None ):
 
-    with open(outputPathActions, 'w') as f:
-        f.write(json.dumps(json_actions))
-    with open(outputPathSteps, 'w') as f:
-        f.write(json.dumps(json_steps))
+    profiler.run('reasoning-parser', output, profile, parse, create_connection(input), output, output_format, date_anchor)
 
 if __name__ == "__main__":
 
@@ -111,6 +164,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This scripts aims to parse the Ocarina data stored into SQLite files to NYU backend format')
     parser.add_argument('-i', '--input', nargs=1, required=True, default='')
     parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('-f', '--format', choices=columnar.OUTPUT_FORMATS, default='json', help='write the JSON files, their columnar .npz versions, or both')
+    parser.add_argument('--date-anchor', default='session', help='date given to the times of day: "session" (date of the trial), "today" or YYYY-MM-DD')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write reasoning-parser_profile.json with the time of each stage, and with "cprofile" also reasoning-parser.prof')
 
     args = parser.parse_args()
-    main(args.input[0],args.output[0])
\ No newline at end of file
+    main(args.input[0],args.output[0],args.format,args.date_anchor,args.profile)
\ No newline at end of file
@@ -3,9 +3,16 @@
 # outputPath='/home/joaorulff/Workspace/PTG/PTG-TA2-Parsers/data/output'
 # videoPath='/home/joaorulff/Workspace/PTG/PTG-TA2-Parsers/data/output/main.mp4'
 
-## ADD path to the 3D model
-# model='/foo/bar/model.fbx'
+## ADD path to the 3D model (.obj or .ply, export other formats such as .fbx first)
+# model='/foo/bar/model.obj'
 
+# echo "Parsing eye, perception, reasoning, video and metadata in one process"
+# python parse-all.py -i $inputDB -o $outputPath
+
+# echo "Parsing a session while it is being recorded"
+# python watch-session.py -i $inputDB -o $outputPath --idle-exit 60
+
+## Or run each parser on its own
 # echo "Generating eye data"
 # python eye-parser.py -i $inputDB -o $outputPath
 
@@ -18,7 +25,19 @@
 echo "Generating video"
 python image_extractor.py
 
+# echo "Exporting a frame store (extract_frames in the config) as images"
+# python export-frames.py -i $outputPath/hl2_rgb/frames/hl2_rgb.frames -o $outputPath/hl2_rgb/images
+
+# echo "Detecting objects from the colours painted into the video"
+# python color-detector.py -i $videoPath -o $outputPath
+
+# echo "Intersecting gaze with the 3D model"
+# python gaze-intersect.py -i $inputDB -m $model -o $outputPath
+
 # echo "Generating medatada"
 # python generate-metadata.py -i $videoPath -o $outputPath
 
+# echo "Uploading to ARGUS"
+# python upload-argus.py -i $outputPath --url http://localhost:8000
+
 
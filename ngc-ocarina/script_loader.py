@@ -0,0 +1,12 @@
+import importlib.util
+import os
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_script(name):
+    """ import one of the hyphenated parser scripts (e.g. "eye-parser") as a module """
+    path = os.path.join(SCRIPTS_DIR, name + ".py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
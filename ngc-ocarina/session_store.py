@@ -0,0 +1,181 @@
+""" Time-window index over the outputs of one parsed session.
+
+    build() copies every columnar output (the .npz files written with
+    --format npz/both) and every video's timecodes into one .npy file per
+    column under <session>/index/<stream>/, sorted by timestamp. query()
+    memory-maps those files and binary-searches the timestamp column, so
+    slicing a few minutes out of a long session only reads those minutes.
+"""
+
+import calendar
+from datetime import datetime
+import glob
+import json
+import os
+
+import numpy as np
+
+import columnar
+
+# Columns shared by every record (e.g. the label names) rather than one row per record
+TABLE_COLUMNS = {'labels', 'actions', 'actions_null', 'components'}
+# Per-object columns of detic:image, record i owns rows value_offsets[i]:value_offsets[i + 1]
+VALUE_COLUMNS = {'label', 'xyxyn', 'xyxyn_int', 'confidence', 'confidence_int', 'class_id'}
+TIMECODES = 'timecodes'
+
+class SessionStore:
+
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        self.index_dir = os.path.join(session_dir, 'index')
+        self.index_path = os.path.join(self.index_dir, 'index.json')
+        self.streams = dict()
+        self._open_columns = dict()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.streams = json.load(f)
+
+    def build(self):
+        """ (re)index every output whose source file changed since the last build
+        :return: names of the indexed streams
+        """
+        sources = dict()
+        for path in sorted(glob.glob(os.path.join(self.session_dir, '*.npz'))):
+            sources[os.path.basename(path)[:-len('.npz')]] = path
+        for path in sorted(glob.glob(os.path.join(self.session_dir, '*', '*_timecodes.txt'))):
+            sources[os.path.basename(os.path.dirname(path))] = path
+
+        for stream, path in sources.items():
+            stat = os.stat(path)
+            source = {'path': os.path.relpath(path, self.session_dir), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if self.streams.get(stream, {}).get('source') == source:
+                continue
+            print(f"Indexing {stream} {datetime.now()}")
+            if path.endswith('.npz'):
+                kind, columns = columnar.load(path)
+                columns.pop('version', None)
+            else:
+                kind, columns = TIMECODES, video_columns(path)
+            columns = sort_by_timestamp(columns)
+
+            stream_dir = os.path.join(self.index_dir, stream)
+            os.makedirs(stream_dir, exist_ok=True)
+            for name, values in columns.items():
+                np.save(os.path.join(stream_dir, f'{name}.npy'), values)
+            self._open_columns.pop(stream, None)
+            self.streams[stream] = {'kind': kind, 'columns': list(columns), 'source': source}
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.index_path, 'w') as f:
+            f.write(json.dumps(self.streams, indent=1))
+        return list(self.streams)
+
+    def columns(self, stream):
+        # memory-mapped columns of an indexed stream
+        if stream not in self.streams:
+            raise KeyError(f"{stream} is not indexed in {self.index_dir}, run build() first")
+        if stream not in self._open_columns:
+            stream_dir = os.path.join(self.index_dir, stream)
+            self._open_columns[stream] = {
+                name: np.load(os.path.join(stream_dir, f'{name}.npy'), mmap_mode='r')
+                for name in self.streams[stream]['columns']}
+        return self._open_columns[stream]
+
+    def start(self):
+        # earliest timestamp of any stream, the origin of relative queries
+        starts = [int(self.columns(stream)['timestamp'][0]) for stream in self.streams
+                  if len(self.columns(stream)['timestamp']) > 0]
+        return min(starts) if len(starts) > 0 else 0
+
+    def query(self, stream, t0, t1, relative=False):
+        """ rows of stream with t0 <= timestamp < t1
+        :param t0, t1: epoch milliseconds, or milliseconds since start() with relative
+        :return: dict of column name to array, in the layout of the .npz outputs
+        """
+        if relative:
+            t0, t1 = t0 + self.start(), t1 + self.start()
+        columns = self.columns(stream)
+        timestamps = columns['timestamp']
+        lo = int(np.searchsorted(timestamps, t0, side='left'))
+        hi = max(lo, int(np.searchsorted(timestamps, t1, side='left')))
+        return slice_columns(columns, lo, hi)
+
+    def records(self, stream, t0, t1, relative=False):
+        # the JSON records (as in the stream's .json file) of a time window
+        return columnar.RECORDS[self.streams[stream]['kind']](self.query(stream, t0, t1, relative))
+
+    def frames(self, feed, t0, t1, relative=False):
+        # frame numbers of feed's video shown in a time window
+        return self.query(feed, t0, t1, relative)['frame']
+
+def video_columns(timecodes_path):
+    """ one row per video frame: its number, its offset in the timecodes file
+        and its epoch millisecond timestamp
+    """
+    offsets = np.loadtxt(timecodes_path, dtype=np.float64, ndmin=1)
+    origin = video_origin(os.path.dirname(timecodes_path))
+    return {
+        'timestamp': (origin + np.floor(offsets)).astype(np.int64),
+        'frame': np.arange(len(offsets), dtype=np.int64),
+        'offset_ms': offsets,
+    }
+
+def video_origin(feed_dir):
+    # timecodes are relative to the first frame, whose timestamp the extraction manifest keeps
+    feed = os.path.basename(feed_dir)
+    origin = None
+    for path in [os.path.join(feed_dir, 'videos', f'{feed}_manifest.jsonl'), os.path.join(feed_dir, f'{feed}_manifest.jsonl')]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                origin = record.get('origin', origin)
+    if origin is None:
+        raise ValueError(f"no origin timestamp recorded for {feed_dir}, re-run image_extractor.py")
+    dt = datetime.strptime(origin, "%Y-%m-%d %H:%M:%S.%f")
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+def sort_by_timestamp(columns):
+    # stable sort of the rows (and of their values, for detic:image) by timestamp
+    timestamps = columns['timestamp']
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        return columns
+    order = np.argsort(timestamps, kind='stable')
+
+    sorted_columns = dict()
+    offsets = columns.get('value_offsets')
+    if offsets is not None:
+        counts = np.diff(offsets)[order]
+        starts = offsets[:-1][order]
+        new_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        value_order = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+        sorted_columns['value_offsets'] = new_offsets
+
+    for name, values in columns.items():
+        if name == 'value_offsets':
+            continue
+        if name in TABLE_COLUMNS:
+            sorted_columns[name] = values
+        elif name in VALUE_COLUMNS:
+            sorted_columns[name] = values[value_order]
+        else:
+            sorted_columns[name] = values[order]
+    return sorted_columns
+
+def slice_columns(columns, lo, hi):
+    offsets = columns.get('value_offsets')
+    sliced = dict()
+    for name, values in columns.items():
+        if name == 'value_offsets':
+            sliced[name] = np.asarray(values[lo:hi + 1]) - values[lo]
+        elif name in TABLE_COLUMNS:
+            sliced[name] = values
+        elif name in VALUE_COLUMNS:
+            sliced[name] = values[offsets[lo]:offsets[hi]]
+        else:
+            sliced[name] = values[lo:hi]
+    return sliced
@@ -0,0 +1,74 @@
+""" Timestamp conversions shared by the parsers and image_extractor.py.
+
+    Whole columns are parsed in one pandas pass (to_datetime caches the
+    conversion of repeated strings), and times are kept as integer epoch
+    microseconds / milliseconds, read as UTC like calendar.timegm did.
+    Time-of-day only values (the mission log) are placed on a date anchor
+    that is resolved once per run, by default the date of the session.
+"""
+
+from datetime import date, datetime, timedelta
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+TIME_FORMAT = '%H:%M:%S.%f'
+EPOCH = datetime(1970, 1, 1)
+# tables holding full "<date> <time>" timestamps, checked in order for the session date
+DATED_TABLES = ['hl2_gaze', 'hl2_rgb_bounding_boxes', 'hl2_rgb']
+
+def to_datetimes(values, format=DATETIME_FORMAT, errors='raise'):
+    # DatetimeIndex of a column of strings, NaT where errors='coerce' can't parse
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(values, dtype=object), format=format, errors=errors, cache=True))
+
+def epoch_us(values, format=DATETIME_FORMAT):
+    return to_datetimes(values, format).asi8 // 10**3
+
+def epoch_ms(values, format=DATETIME_FORMAT):
+    return to_datetimes(values, format).asi8 // 10**6
+
+def time_of_day_ms(datetimes):
+    # milliseconds since midnight, the only part of a time-of-day timestamp that is real
+    return (datetimes - datetimes.normalize()).asi8 // 10**6
+
+def format_us(us, format=DATETIME_FORMAT):
+    # one epoch microsecond value back to a timestamp string
+    return datetime.strftime(EPOCH + timedelta(microseconds=int(us)), format)
+
+def ptg_timestamps(ms, suffix='-0'):
+    # epoch milliseconds to the "<ms>-0" strings ARGUS reads
+    return [f'{ts}{suffix}' for ts in np.asarray(ms, dtype=np.int64).tolist()]
+
+def session_date(conn):
+    """ date of the trial, from the first dated timestamp in the database
+    :return: datetime.date, or None if no table has one
+    """
+    for table in DATED_TABLES:
+        try:
+            rows = conn.execute(f"SELECT timestamp FROM {table} WHERE timestamp IS NOT NULL LIMIT 100").fetchall()
+        except sqlite3.OperationalError:
+            continue
+        datetimes = to_datetimes([row[0] for row in rows], errors='coerce').dropna()
+        if len(datetimes) > 0:
+            return datetimes[0].date()
+    return None
+
+def resolve_date_anchor(conn, anchor='session'):
+    """ epoch milliseconds of the midnight time-of-day timestamps are placed on
+    :param anchor: "session" (date of the trial, today if the database has none),
+        "today", a "YYYY-MM-DD" date, or an already resolved anchor in milliseconds
+    """
+    if isinstance(anchor, (int, np.integer)):
+        return int(anchor)
+    if anchor == 'session':
+        day = session_date(conn)
+        if day is None:
+            print("No dated timestamps in the database, anchoring times of day on today")
+            day = date.today()
+    elif anchor == 'today':
+        day = date.today()
+    else:
+        day = datetime.strptime(anchor, '%Y-%m-%d').date()
+    return (datetime(day.year, day.month, day.day) - EPOCH) // timedelta(milliseconds=1)
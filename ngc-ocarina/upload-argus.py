@@ -0,0 +1,311 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+import yaml
+
+import profiler
+
+# JSON outputs of the parsers, uploaded as the stream named after the file
+STREAM_FILES = ['eye.json', 'detic:image.json', 'egovlp:action:steps.json', 'reasoning:check_status.json']
+# Responses worth retrying, anything else >= 300 fails the upload
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class UploadError(Exception):
+    pass
+
+class ArgusClient:
+    """ POSTs batches to the ARGUS API over keep-alive connections, one per
+        uploading thread, so every batch after the first of a thread reuses
+        its TCP connection. Failed requests (connection errors and
+        RETRY_STATUSES) are retried with exponential backoff and jitter,
+        honouring Retry-After.
+    """
+
+    def __init__(self, url, headers=None, timeout=60, retries=5, backoff=0.5):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or 'http'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self._local.conn = connection_class(self.host, self.port, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _reset_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def post(self, path, body, headers=None):
+        """ :return: (number of attempts the request took, response body) """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        for attempt in range(self.retries + 1):
+            delay = None
+            try:
+                conn = self._connection()
+                conn.request('POST', self.base_path + path, body=body, headers=request_headers)
+                response = conn.getresponse()
+                # the body has to be read before the connection can be reused
+                content = response.read()
+                if response.status < 300:
+                    return attempt + 1, content
+                if response.status not in RETRY_STATUSES:
+                    raise UploadError(f"POST {path} failed with {response.status}: {content[:200]!r}")
+                error = f"{response.status} {response.reason}"
+                delay = retry_after(response.getheader('Retry-After'))
+                if response.getheader('Connection', '').lower() == 'close':
+                    self._reset_connection()
+            except (http.client.HTTPException, OSError) as e:
+                # the server may have closed an idle keep-alive connection, reconnect
+                self._reset_connection()
+                error = repr(e)
+
+            if attempt == self.retries:
+                raise UploadError(f"POST {path} failed after {attempt + 1} attempts: {error}")
+            if delay is None:
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.0)
+            print(f"Retrying POST {path} in {delay:.2f}s ({error})")
+            time.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+def retry_after(value):
+    # seconds of a Retry-After header, None when absent or given as a date
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+def read_records(path, buffer_size=2**20):
+    """ yield the text of each record of a JSON array file, reading it
+        buffer_size characters at a time instead of loading it whole.
+        Records are passed on as written, without being re-encoded.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = ''
+        position = 0
+        started = False
+        eof = False
+        while True:
+            # skip the separators before the next record
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                if buffer[position] == '[':
+                    if started:
+                        break
+                    started = True
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError('incomplete record', buffer, position)
+                _, end = decoder.raw_decode(buffer, position)
+                # a record is only whole once the separator after it is read,
+                # a number cut by the end of the buffer still decodes
+                following = end
+                while following < len(buffer) and buffer[following] in ' \t\r\n':
+                    following += 1
+                if not eof and (following == len(buffer) or buffer[following] not in ',]'):
+                    raise json.JSONDecodeError('incomplete record', buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    if position >= len(buffer):
+                        return
+                    raise
+                data = f.read(buffer_size)
+                eof = len(data) == 0
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+            yield buffer[position:end]
+            position = end
+
+def batches(records, batch_size, max_batch_bytes):
+    # group record texts into lists of at most batch_size records and about max_batch_bytes
+    batch = []
+    size = 0
+    for record in records:
+        batch.append(record)
+        size += len(record) + 1
+        if len(batch) >= batch_size or size >= max_batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if len(batch) > 0:
+        yield batch
+
+def session_id(input):
+    """ identity of the session whose outputs are in input, the same each
+        time it is uploaded: the folder name and the first timestamp of the
+        session (from additional_metadata.json, else the first record of a
+        stream), as folders of different trials may share a name
+    """
+    first_entry = None
+    metadata_path = os.path.join(input, 'additional_metadata.json')
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as f:
+            first_entry = json.load(f).get('first-entry')
+    for file_name in STREAM_FILES:
+        if first_entry is not None:
+            break
+        if os.path.exists(os.path.join(input, file_name)):
+            for record in read_records(os.path.join(input, file_name)):
+                first_entry = json.loads(record).get('timestamp')
+                break
+    name = os.path.basename(os.path.abspath(input))
+    if first_entry is None:
+        return name
+    return f"{name}-{str(first_entry).strip().split('-')[0]}"
+
+def encode_batch(batch, compress_level):
+    """ :return: (body, uncompressed size, SHA-1 of the uncompressed JSON) of a JSON array of the batch """
+    payload = ('[' + ','.join(batch) + ']').encode('utf-8')
+    digest = hashlib.sha1(payload).hexdigest()
+    if compress_level > 0:
+        return gzip.compress(payload, compresslevel=compress_level), len(payload), digest
+    return payload, len(payload), digest
+
+def is_duplicate(content):
+    # whether the server answered that it already stored the batch
+    try:
+        reply = json.loads(content)
+    except ValueError:
+        return False
+    return isinstance(reply, dict) and reply.get('duplicate') is True
+
+def send_batch(client, path, session, stream, number, batch, compress_level):
+    with profiler.stage('upload.encode'):
+        body, raw_bytes, digest = encode_batch(batch, compress_level)
+    batch_id = f"{session}:{stream}:{number}:{digest}"
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Session-Id': session,
+        # lets the server drop a batch it already stored when a retry crosses a lost response
+        'X-Batch-Id': batch_id,
+    }
+    if compress_level > 0:
+        headers['Content-Encoding'] = 'gzip'
+    with profiler.stage('upload.send'):
+        attempts, content = client.post(path, body, headers)
+    # only a retry can find its own batch stored, otherwise the server holds
+    # other records under this id and these were never stored
+    if is_duplicate(content) and attempts == 1:
+        raise UploadError(f"POST {path} batch {batch_id} was rejected as a duplicate of a batch already stored")
+    return len(batch), raw_bytes, len(body), attempts
+
+def upload_stream(client, executor, session, stream, json_path, config):
+    """ upload the records of one JSON file, keeping at most max_in_flight
+        batches encoded or on the wire at once
+    :return: dict of records, batches, raw and sent bytes and retries
+    """
+    path = config['endpoint'].format(stream=quote(stream, safe=':'), session=quote(session, safe=''))
+    totals = {'records': 0, 'batches': 0, 'raw_bytes': 0, 'sent_bytes': 0, 'retries': 0}
+    pending = deque()
+
+    def collect(future):
+        records, raw_bytes, sent_bytes, attempts = future.result()
+        totals['records'] += records
+        totals['batches'] += 1
+        totals['raw_bytes'] += raw_bytes
+        totals['sent_bytes'] += sent_bytes
+        totals['retries'] += attempts - 1
+
+    records = profiler.timed(read_records(json_path), 'upload.read')
+    for number, batch in enumerate(batches(records, config['batch_size'], config['max_batch_mb'] * 1024**2)):
+        pending.append(executor.submit(send_batch, client, path, session, stream, number, batch, config['compress_level']))
+        while len(pending) >= config['max_in_flight']:
+            collect(pending.popleft())
+    while len(pending) > 0:
+        collect(pending.popleft())
+
+    for name, value in totals.items():
+        profiler.count(f'upload.{name}', value)
+    return totals
+
+def upload(input: str, config: dict, streams=None):
+    """ upload the parsed JSON outputs in input to the ARGUS API
+    :return: dict stream -> upload totals
+    """
+    session = config.get('session') or session_id(input)
+    print(f"Uploading session {session} {datetime.now()}")
+    headers = dict(config.get('headers') or {})
+    if os.environ.get('ARGUS_TOKEN'):
+        headers['Authorization'] = f"Bearer {os.environ['ARGUS_TOKEN']}"
+    client = ArgusClient(config['url'], headers, config['timeout'], config['retries'], config['backoff'])
+
+    results = dict()
+    with ThreadPoolExecutor(max_workers=config['concurrency']) as executor:
+        for file_name in STREAM_FILES:
+            stream = file_name[:-len('.json')]
+            json_path = os.path.join(input, file_name)
+            if (streams and stream not in streams) or not os.path.exists(json_path):
+                continue
+            print(f"Uploading {json_path} {datetime.now()}")
+            start = time.perf_counter()
+            totals = upload_stream(client, executor, session, stream, json_path, config)
+            seconds = time.perf_counter() - start
+            totals['seconds'] = round(seconds, 3)
+            print(f"Uploaded {totals['records']} {stream} records in {totals['batches']} batches, "
+                  f"{totals['raw_bytes'] / 1024**2:.1f} MB sent as {totals['sent_bytes'] / 1024**2:.1f} MB, "
+                  f"{totals['records'] / max(seconds, 1e-9):.0f} records/s, {totals['retries']} retries {datetime.now()}")
+            results[stream] = totals
+    client.close()
+    return results
+
+def main( input: str, config_path: str, url: str, streams: list, profile: str = None, session: str = '' ):
+
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    if( url ):
+        config['url'] = url
+    if( session ):
+        config['session'] = session
+    profiler.run('upload-argus', input, profile, upload, input, config, streams)
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python upload-argus.py -i /bar/0293_11 --url http://localhost:8000
+
+    parser = argparse.ArgumentParser(description='This scripts aims to upload the parsed Ocarina JSON files of a session to the ARGUS API')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('--config', default='./config/config_upload.yaml', help='API url and endpoint, batching, compression, concurrency and retries')
+    parser.add_argument('--url', default='', help='base url of the API, overrides the config')
+    parser.add_argument('-s', '--streams', nargs='*', default=None, help='only upload these streams (eye, detic:image, egovlp:action:steps, reasoning:check_status)')
+    parser.add_argument('--session', default='', help='session id sent with every batch, by default the folder name and first timestamp of the session')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write upload-argus_profile.json with the time of each stage, and with "cprofile" also upload-argus.prof')
+
+    args = parser.parse_args()
+    main(args.input[0],args.config,args.url,args.streams,args.profile,args.session)
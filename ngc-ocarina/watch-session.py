@@ -0,0 +1,303 @@
+import argparse
+from datetime import datetime
+import json
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+import profiler
+from script_loader import load_script
+import timestamps
+
+eye_parser = load_script("eye-parser")
+perception_parser = load_script("perception-parser")
+reasoning_parser = load_script("reasoning-parser")
+
+STATE_FILE = 'watch_state.json'
+OUTPUT_FILES = ['eye.json', 'detic:image.json', 'egovlp:action:steps.json', 'reasoning:check_status.json']
+
+class JsonArrayFile:
+    """ JSON array on disk that records are appended to in place: each
+        append overwrites the closing bracket and writes it again after the
+        new records, so the file is a whole array after every append and
+        nothing written before is rewritten.
+    """
+
+    def __init__(self, path, size=0, count=0):
+        """ open path for appending, dropping whatever was written after
+            size bytes holding count records. size 0 starts an empty array.
+        """
+        self.path = path
+        if size == 0 or not os.path.exists(path) or os.path.getsize(path) < size:
+            with open(path, 'w') as f:
+                f.write('[]')
+            size, count = 2, 0
+        self.file = open(path, 'r+')
+        self.file.truncate(size)
+        self.size = size
+        self.count = count
+
+    def append(self, texts):
+        if len(texts) == 0:
+            return
+        text = ', '.join(texts)
+        if self.count > 0:
+            text = ', ' + text
+        self.file.seek(self.size - 1)
+        self.file.write(text + ']')
+        self.file.flush()
+        self.size = self.file.tell()
+        self.count += len(texts)
+        profiler.count('watch.json_bytes', len(text))
+
+    def close(self):
+        self.file.close()
+
+def hold_back_last(df, column, more):
+    """ split rows sorted by column into (ready, held): the rows of the
+        last value are held while more rows may still arrive for it
+    """
+    if not more or len(df) == 0:
+        return df, df.iloc[:0]
+    is_last = (df[column] == df[column].iat[-1]).to_numpy()
+    return df[~is_last], df[is_last]
+
+class SessionWatcher:
+    """ parses the rows added to a trial database since the last poll.
+
+        Every table is read after a high-water mark, the largest rowid
+        already read (rows of a recording are only ever appended, so their
+        rowids keep growing), at most chunk_size rows per poll. New records
+        are appended to the JSON outputs. Perception and mission log records
+        group all the rows of a timestamp, so the rows of the newest
+        timestamp are held until a later row (or a poll finding nothing new)
+        shows it is complete. The marks and output sizes are saved to
+        watch_state.json after every poll, so a restarted watch carries on
+        where it stopped.
+    """
+
+    def __init__(self, input, output, chunk_size=10000, date_anchor='session', resume=True):
+        self.conn = sqlite3.connect(f"file:{os.path.abspath(input)}?mode=ro", uri=True)
+        self.input = os.path.abspath(input)
+        self.output = output
+        self.chunk_size = chunk_size
+        self.date_anchor = date_anchor
+        self.state_path = os.path.join(output, STATE_FILE)
+
+        state = dict()
+        if resume and os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state.get('input') != self.input or state.get('date_anchor') != str(date_anchor):
+                print(f"{self.state_path} belongs to another watch, starting over")
+                state = dict()
+        if len(state) > 0:
+            print(f"Resuming watch of {input} after rows {state['marks']} {datetime.now()}")
+
+        self.marks = state.get('marks', {'hl2_gaze': 0, 'hl2_rgb': 0, 'hl2_rgb_bounding_boxes': 0, 'ocarina_mission_log': 0})
+        self.date_anchor_ms = state.get('date_anchor_ms')
+        self.actions = state.get('actions', [])
+        self.frame_size = state.get('frame_size')
+        self.frame_sizes = dict()
+        sizes = state.get('files', {})
+        self.files = {name: JsonArrayFile(os.path.join(output, name), *sizes.get(name, (0, 0))) for name in OUTPUT_FILES}
+        self.pending_boxes = None
+        self.pending_log = None
+
+    def read_new(self, query, table, params=()):
+        """ rows of table after its mark, the query selects rowid AS row_id first
+        :return: (DataFrame, whether more rows are waiting)
+        """
+        try:
+            with profiler.stage('watch.fetch'):
+                df = pd.read_sql_query(query, self.conn, params=(self.marks[table],) + params + (self.chunk_size,))
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            # the recorder may not have created the table yet
+            if 'no such table' not in str(e):
+                raise
+            return None, False
+        profiler.count(f'watch.{table}.rows', len(df))
+        if len(df) > 0:
+            self.marks[table] = int(df['row_id'].iat[-1])
+        return df, len(df) == self.chunk_size
+
+    def resolve_anchor(self):
+        # times of day can only be dated once the session date is known, i.e. once a dated row is in
+        if self.date_anchor_ms is None:
+            if self.date_anchor == 'session' and timestamps.session_date(self.conn) is None:
+                return False
+            self.date_anchor_ms = timestamps.resolve_date_anchor(self.conn, self.date_anchor)
+        return True
+
+    def poll_eye(self):
+        df, more = self.read_new(
+            "SELECT rowid AS row_id, timestamp, origin_x, origin_y, origin_z, direction_x, direction_y, direction_z"
+            " FROM hl2_gaze WHERE rowid > ? ORDER BY rowid LIMIT ?", 'hl2_gaze')
+        if df is None or len(df) == 0:
+            return 0, more
+        with profiler.stage('watch.eye'):
+            df = eye_parser.decode_gaze(df.drop(columns=['row_id']))
+            self.files['eye.json'].append(eye_parser.format_rows(df))
+        return len(df), more
+
+    def poll_frame_sizes(self):
+        # sizes of the frames boxes are normalized by, the last size stands in for frames not read yet
+        df, more = self.read_new(
+            "SELECT rowid AS row_id, image_count, width, height FROM hl2_rgb WHERE rowid > ? ORDER BY rowid LIMIT ?", 'hl2_rgb')
+        if df is not None and len(df) > 0:
+            self.frame_sizes.update(zip(df['image_count'].tolist(), zip(df['width'].tolist(), df['height'].tolist())))
+            self.frame_size = [int(df['width'].iat[-1]), int(df['height'].iat[-1])]
+            if len(self.frame_sizes) > 2 * self.chunk_size:
+                self.frame_sizes = dict(list(self.frame_sizes.items())[-self.chunk_size:])
+        return more
+
+    def poll_perception(self):
+        frames_more = self.poll_frame_sizes()
+        if not self.resolve_anchor():
+            return 0, False
+        df, more = self.read_new(
+            "SELECT rowid AS row_id, image_count, timestamp, component_id FROM hl2_rgb_bounding_boxes"
+            " WHERE rowid > ? AND timestamp IS NOT NULL ORDER BY rowid LIMIT ?", 'hl2_rgb_bounding_boxes')
+        if df is None or (len(df) == 0 and self.pending_boxes is None):
+            return 0, frames_more
+
+        with profiler.stage('watch.perception'):
+            new_rows = len(df)
+            if new_rows > 0:
+                sizes = [self.frame_sizes.get(image_count, self.frame_size or (None, None)) for image_count in df['image_count'].tolist()]
+                df['width'] = [size[0] for size in sizes]
+                df['height'] = [size[1] for size in sizes]
+                df['box_rowid'] = df['row_id']
+                df = next(perception_parser.read_boxes(self.conn, 'hl2_rgb_bounding_boxes', [df], len(df)))
+            if self.pending_boxes is not None:
+                df = pd.concat([self.pending_boxes, df], ignore_index=True)
+            df = df.sort_values('timestamp', kind='stable', ignore_index=True)
+            ready, held = hold_back_last(df, 'timestamp', new_rows > 0)
+            self.pending_boxes = held if len(held) > 0 else None
+
+            records = []
+            if len(ready) > 0:
+                records = [json.dumps(value) for value in perception_parser.get_json_values([ready], self.date_anchor_ms)]
+            self.files['detic:image.json'].append(records)
+        return len(records), more or frames_more
+
+    def poll_reasoning(self):
+        if not self.resolve_anchor():
+            return 0, False
+        df, more = self.read_new(
+            "SELECT rowid AS row_id, * FROM ocarina_mission_log WHERE rowid > ? ORDER BY rowid LIMIT ?", 'ocarina_mission_log')
+        if df is None or (len(df) == 0 and self.pending_log is None):
+            return 0, more
+
+        with profiler.stage('watch.reasoning'):
+            for action in df['Event'].unique().tolist():
+                if action not in self.actions:
+                    self.actions.append(action)
+            new_rows = len(df)
+            if self.pending_log is not None:
+                df = pd.concat([self.pending_log, df], ignore_index=True)
+            df = df.sort_values('timestamp', kind='stable', na_position='first', ignore_index=True)
+            ready, held = hold_back_last(df, 'timestamp', new_rows > 0)
+            self.pending_log = held if len(held) > 0 else None
+
+            actions = steps = []
+            if len(ready) > 0:
+                # records only have keys for the events seen so far, the JSON written earlier can't grow new ones
+                actions = reasoning_parser.get_actions_json(ready, self.date_anchor_ms, self.actions)
+                steps = reasoning_parser.get_steps_json(ready, self.date_anchor_ms)
+            self.files['egovlp:action:steps.json'].append([json.dumps(value) for value in actions])
+            self.files['reasoning:check_status.json'].append([json.dumps(value) for value in steps])
+        return len(actions) + len(steps), more
+
+    def poll(self):
+        """ :return: (records appended, whether a table has more rows waiting) """
+        records, more = 0, False
+        for poll_stream in [self.poll_eye, self.poll_perception, self.poll_reasoning]:
+            stream_records, stream_more = poll_stream()
+            records += stream_records
+            more = more or stream_more
+        self.save_state()
+        return records, more
+
+    def save_state(self):
+        # rows still held are read again after a restart, so the marks are kept before them
+        marks = dict(self.marks)
+        for table, held in [('hl2_rgb_bounding_boxes', self.pending_boxes), ('ocarina_mission_log', self.pending_log)]:
+            if held is not None:
+                marks[table] = int(held['row_id'].min()) - 1
+        state = {
+            'input': self.input,
+            'date_anchor': str(self.date_anchor),
+            'date_anchor_ms': self.date_anchor_ms,
+            'marks': marks,
+            'actions': self.actions,
+            'frame_size': self.frame_size,
+            'files': {name: [f.size, f.count] for name, f in self.files.items()},
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.conn.close()
+
+def watch(input: str, output: str, interval: float = 0.25, idle_exit: float = 0, chunk_size: int = 10000, date_anchor: str = 'session', resume: bool = True):
+    """ poll input every interval seconds until it stays unchanged for
+        idle_exit seconds (0 watches until interrupted)
+    """
+    if( not os.path.exists(output) ):
+        os.makedirs(output)
+    watcher = SessionWatcher(input, output, chunk_size, date_anchor, resume)
+    print(f"Watching {input} every {interval}s {datetime.now()}")
+    last_change = time.monotonic()
+    last_report = last_change
+    try:
+        while True:
+            start = time.monotonic()
+            records, more = watcher.poll()
+            profiler.count('watch.polls')
+            if records > 0 or more:
+                last_change = start
+            elif idle_exit > 0 and start - last_change >= idle_exit:
+                print(f"No new rows for {idle_exit}s, stopping {datetime.now()}")
+                break
+            if start - last_report >= 10:
+                counts = ", ".join(f"{name} {f.count}" for name, f in watcher.files.items())
+                print(f"Records so far: {counts} {datetime.now()}")
+                last_report = start
+            # a backlog is read without waiting, chunk_size rows per table at a time
+            if not more:
+                time.sleep(max(0.0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        print(f"Stopping watch {datetime.now()}")
+    finally:
+        watcher.close()
+
+def main( input: str, output: str, interval: float, idle_exit: float, chunk_size: int, date_anchor: str, resume: bool, profile: str = None ):
+
+    profiler.run('watch-session', output, profile, watch, input, output, interval, idle_exit, chunk_size, date_anchor, resume)
+
+
+if __name__ == "__main__":
+
+    ## Example:
+    ## python watch-session.py -i /foo/0293_11.sqlite -o /bar/0293_11
+    ## python watch-session.py -i /foo/0293_11.sqlite -o /bar/0293_11 --interval 0.1 --idle-exit 60
+
+    parser = argparse.ArgumentParser(description='This scripts aims to parse a trial SQLite file while it is being recorded, appending the new rows of each poll to the ARGUS JSON files')
+    parser.add_argument('-i', '--input', nargs=1, required=True, default='')
+    parser.add_argument('-o', '--output', nargs=1, required=True, default='')
+    parser.add_argument('--interval', type=float, default=0.25, help='seconds between polls')
+    parser.add_argument('--idle-exit', type=float, default=0, help='stop after this many seconds without new rows, 0 watches until interrupted')
+    parser.add_argument('-c', '--chunk-size', type=int, default=10000, help='most rows read from each table per poll')
+    parser.add_argument('--date-anchor', default='session', help='date given to the timestamps: "session" (date of the trial), "today" or YYYY-MM-DD')
+    parser.add_argument('--restart', action='store_true', help='ignore watch_state.json and rewrite the outputs from the first row')
+    parser.add_argument('--profile', nargs='?', const='timers', choices=profiler.PROFILE_MODES, help='write watch-session_profile.json with the time of each stage, and with "cprofile" also watch-session.prof')
+
+    args = parser.parse_args()
+    main(args.input[0],args.output[0],args.interval,args.idle_exit,args.chunk_size,args.date_anchor,not args.restart,args.profile)